@@ -0,0 +1 @@
+"""Mock LLM server and throughput benchmark harness."""
@@ -0,0 +1,225 @@
+"""
+End-to-end throughput benchmark of process_file / process_folder against the local mock LLM server.
+
+A synthetic corpus is generated from the reference token file (OCR confusions injected into a share
+of the lines, which get a low confidence), the pipeline is run against bench.mock_llm started as a
+subprocess, and items/s, batch latency percentiles, retries and peak RSS are reported. Run from src/:
+
+    python -m bench.benchmark --files 8 --lines 5000 --latency lognormal:0.8:0.4 --rate-429 0.02 --json bench.json
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import resource
+import tempfile
+import subprocess
+import urllib.request
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+SRC_DIR = Path(__file__).resolve().parent.parent
+DEFAULT_REFERENCE = SRC_DIR.parent / "resources" / "sampled_gts_unique_700_long_300_short.txt"
+DEFAULT_KB = SRC_DIR.parent / "resources" / "knowledge_base_v1.json"
+
+# Misreads injected into low-confidence lines (inverse of the corrections the prompt allows)
+_MISREADS = {"0": "O", "O": "0", "1": "l", "I": "1", "5": "S", "S": "5", "8": "B", "B": "8", "2": "Z", "9": "g"}
+
+
+def _misread(token: str, rng: random.Random, max_swaps: int = 2) -> str:
+    chars = list(token)
+    positions = [i for i, ch in enumerate(chars) if ch in _MISREADS]
+    for i in rng.sample(positions, min(len(positions), rng.randint(1, max_swaps))):
+        chars[i] = _MISREADS[chars[i]]
+    if rng.random() < 0.2:
+        return "".join(chars).lower()
+    return "".join(chars)
+
+
+def generate_corpus(out_dir: Path, reference: Path, n_files: int, n_lines: int,
+                    low_conf_ratio: float, threshold: float, seed: int = 0) -> List[Path]:
+    """Write n_files input files of n_lines 'gt||pred conf' lines each."""
+    with open(reference, "r", encoding="utf-8") as f:
+        tokens = [line.strip() for line in f if line.strip()]
+    rng = random.Random(seed)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    paths = []
+    for n in range(n_files):
+        path = out_dir / f"bench_{n:03d}.txt"
+        with open(path, "w", encoding="utf-8") as f:
+            for _ in range(n_lines):
+                gt = rng.choice(tokens)
+                if rng.random() < low_conf_ratio:
+                    pred, conf = _misread(gt, rng), rng.uniform(0.2, threshold)
+                else:
+                    pred, conf = gt, rng.uniform(threshold, 1.0)
+                f.write(f"{gt}||{pred} {conf:.4f}\n")
+        paths.append(path)
+    return paths
+
+
+def _percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    pos = (len(values) - 1) * q
+    lo = int(pos)
+    hi = min(lo + 1, len(values) - 1)
+    return values[lo] + (values[hi] - values[lo]) * (pos - lo)
+
+
+def _start_mock(args) -> Tuple[subprocess.Popen, str]:
+    cmd = [sys.executable, "-m", "bench.mock_llm", "--port", "0", "--latency", args.latency,
+           "--rate-429", str(args.rate_429), "--rate-5xx", str(args.rate_5xx),
+           "--drop-line", str(args.drop_line), "--chatter", str(args.chatter),
+           "--mode", args.mock_mode, "--lexicon", str(args.reference),
+           "--retry-after", str(args.retry_after), "--seed", str(args.seed)]
+    proc = subprocess.Popen(cmd, cwd=str(SRC_DIR), stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+    url = proc.stdout.readline().strip()
+    if not url.startswith("http"):
+        proc.kill()
+        raise RuntimeError("mock LLM server did not start")
+    return proc, url
+
+
+def _configure_env(args, url: str, work_dir: Path):
+    """Point both providers at the mock; must run before config is imported."""
+    env = {
+        "OPENAI_API_KEY": "mock", "OPENAI_BASE_URL": url, "OPENAI_MODEL": "mock-gpt",
+        "DEEPSEEK_API_KEY": "mock", "DEEPSEEK_BASE_URL": url, "DEEPSEEK_MODEL": "mock-deepseek",
+        "LLM_PROVIDER": args.provider,
+        "BATCH_SIZE": str(args.batch_size),
+        "CONFIDENCE_THRESHOLD": str(args.threshold),
+        "MAX_INFLIGHT_BATCHES": str(args.inflight),
+        "MAX_CONCURRENT_FILES": str(args.concurrent_files),
+        "RAG_KB_PATH": str(args.kb),
+        "REFERENCE_TOKENS_PATH": str(args.reference),
+        "CORRECTION_CACHE": "true" if args.cache else "false",
+        "CORRECTION_CACHE_PATH": str(work_dir / "cache.sqlite"),
+        "CHECKPOINT_JOURNAL": "false",
+        "LOCAL_CORRECTION": "false" if args.no_local else "true",
+        "LLM_STREAM": "true" if args.stream else "false",
+    }
+    os.environ.update(env)
+    for name, default in {"INPUT_PATH": str(work_dir / "in"), "OUTPUT_PATH": str(work_dir / "out"),
+                          "INCLUDE_GT_IN_PROMPT": "false", "REFERENCE_MAX_TOKENS": "120",
+                          "VERBOSITY": "0", "LOG_FILE": str(work_dir / "bench.log")}.items():
+        os.environ.setdefault(name, default)
+
+
+def run_benchmark(args) -> Dict:
+    work_dir = Path(tempfile.mkdtemp(prefix="pcbtagent-bench-"))
+    proc, url = _start_mock(args)
+    try:
+        _configure_env(args, url, work_dir)
+        sys.path.insert(0, str(SRC_DIR))
+        import pipeline
+        from llm_clients import get_client
+        from utils.logging_setup import setup_logging_original_fix
+
+        setup_logging_original_fix(verbosity=args.verbosity)
+        n_files = args.files if args.target == "folder" else 1
+        inputs = generate_corpus(work_dir / "in", args.reference, n_files, args.lines,
+                                 args.low_conf_ratio, args.threshold, args.seed)
+        n_lines = n_files * args.lines
+        n_low = 0
+        for path in inputs:
+            with open(path, "r", encoding="utf-8") as f:
+                n_low += sum(1 for line in f if float(line.rsplit(" ", 1)[1]) < args.threshold)
+
+        # Time every batch as the dispatcher sees it (LLM call incl. retries and re-asks)
+        latencies: List[float] = []
+        timed = pipeline._timed_correct_batch
+
+        def _probe(*args, **kwargs):
+            corrected, dt = timed(*args, **kwargs)
+            latencies.append(dt)
+            return corrected, dt
+
+        pipeline._timed_correct_batch = _probe
+
+        kwargs = dict(provider=args.provider, batch_size=args.batch_size, threshold=args.threshold,
+                      include_gt_in_prompt=False, max_inflight_batches=args.inflight, streaming=args.streaming)
+        t0 = time.perf_counter()
+        if args.target == "folder":
+            pipeline.process_folder(str(work_dir / "in"), str(work_dir / "out"),
+                                    max_concurrent_files=args.concurrent_files, incremental=False, **kwargs)
+        else:
+            pipeline.process_file(str(inputs[0]), str(work_dir / "out.txt"), **kwargs)
+        wall = time.perf_counter() - t0
+
+        with urllib.request.urlopen(url.rsplit("/v1/", 1)[0] + "/stats") as resp:
+            server = json.load(resp)
+        usage = get_client(args.provider).usage()
+        return {
+            "target": args.target,
+            "files": n_files,
+            "lines": n_lines,
+            "low_conf_items": n_low,
+            "wall_s": round(wall, 3),
+            "lines_per_s": round(n_lines / wall, 1),
+            "items_per_s": round(n_low / wall, 2),
+            "batches": len(latencies),
+            "batch_latency_p50_s": round(_percentile(latencies, 0.50), 3),
+            "batch_latency_p95_s": round(_percentile(latencies, 0.95), 3),
+            "requests": server.get("requests", 0),
+            # Every request beyond the first of each batch: HTTP retries, re-asks and split batches
+            "retries": max(0, server.get("requests", 0) - len(latencies)),
+            "injected_429": server.get("429", 0),
+            "injected_5xx": server.get("5xx", 0),
+            "dropped_lines": server.get("dropped_line", 0),
+            "prompt_tokens": usage["prompt_tokens"],
+            "completion_tokens": usage["completion_tokens"],
+            "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        }
+    finally:
+        proc.terminate()
+        proc.wait(timeout=10)
+        if not args.keep:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def main(argv: Optional[List[str]] = None):
+    ap = argparse.ArgumentParser(description="Throughput benchmark against the local mock LLM server.")
+    ap.add_argument("--target", choices=("file", "folder"), default="folder")
+    ap.add_argument("--files", type=int, default=4, help="input files (folder target)")
+    ap.add_argument("--lines", type=int, default=2000, help="lines per input file")
+    ap.add_argument("--low-conf-ratio", type=float, default=0.3)
+    ap.add_argument("--threshold", type=float, default=0.95)
+    ap.add_argument("--provider", default="gpt")
+    ap.add_argument("--batch-size", type=int, default=20)
+    ap.add_argument("--inflight", type=int, default=4)
+    ap.add_argument("--concurrent-files", type=int, default=4)
+    ap.add_argument("--streaming", action="store_true", help="bounded-memory file processing")
+    ap.add_argument("--stream", action="store_true", help="stream LLM answers (SSE)")
+    ap.add_argument("--cache", action="store_true", help="enable the correction cache (cold, per run)")
+    ap.add_argument("--no-local", action="store_true", help="send every low-confidence item to the LLM")
+    ap.add_argument("--latency", default="lognormal:0.5:0.3")
+    ap.add_argument("--rate-429", type=float, default=0.0)
+    ap.add_argument("--rate-5xx", type=float, default=0.0)
+    ap.add_argument("--drop-line", type=float, default=0.0)
+    ap.add_argument("--chatter", type=float, default=0.0)
+    ap.add_argument("--retry-after", type=float, default=1.0)
+    ap.add_argument("--mock-mode", choices=("echo", "correct"), default="correct")
+    ap.add_argument("--reference", type=Path, default=DEFAULT_REFERENCE)
+    ap.add_argument("--kb", type=Path, default=DEFAULT_KB)
+    ap.add_argument("--seed", type=int, default=0)
+    ap.add_argument("--verbosity", type=int, default=0)
+    ap.add_argument("--keep", action="store_true", help="keep the generated corpus and outputs")
+    ap.add_argument("--json", type=Path, help="also write the report to this file")
+    args = ap.parse_args(argv)
+
+    report = run_benchmark(args)
+    width = max(len(k) for k in report)
+    for key, value in report.items():
+        print(f"{key:<{width}}  {value}")
+    if args.json:
+        args.json.write_text(json.dumps(report, indent=2) + "\n", encoding="utf-8")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,280 @@
+"""
+Local OpenAI-compatible chat completion server that stands in for a real provider.
+
+Point OPENAI_BASE_URL / DEEPSEEK_BASE_URL at http://<host>:<port>/v1/chat/completions. Answers are
+deterministic for a given request: the OCR tokens of the prompt are echoed or corrected back in the
+requested format (ID<TAB>token or one token per line), as one JSON body or, for "stream": true, as
+server-sent events one line at a time. Latency, 429/5xx errors, wrong line counts and chatter are
+injected with configurable rates. Standalone, self-contained (no project imports):
+
+    python -m bench.mock_llm --port 8765 --latency lognormal:0.8:0.4 --rate-429 0.02 --drop-line 0.05
+"""
+
+import re
+import sys
+import json
+import time
+import random
+import hashlib
+import argparse
+import threading
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Iterable, List, Optional, Tuple
+
+_INDEXED_ITEM_RE = re.compile(r"^(\d+)\tOCR: (.*?) ; LEN", re.MULTILINE)
+_ITEM_RE = re.compile(r"OCR: (.*?) ; LEN")
+
+# Share of the sampled latency spent before the first line of a streamed answer
+STREAM_FIRST_LINE_SHARE = 0.3
+
+# Fold of the OCR confusions the prompt allows to correct (O<->0, I/l<->1, S<->5, B<->8, Z<->2, g/q<->9)
+_FOLD = str.maketrans({"O": "0", "I": "1", "L": "1", "S": "5", "B": "8", "Z": "2", "G": "9", "Q": "9", " ": "_"})
+
+
+def _fold(token: str) -> str:
+    return token.upper().translate(_FOLD)
+
+
+def parse_latency(spec: str) -> Tuple[str, float, float]:
+    """
+    Latency distribution spec: "fixed:S", "uniform:LO:HI" or "lognormal:MEDIAN:SIGMA" (seconds).
+    """
+    kind, *args = spec.split(":")
+    values = [float(a) for a in args]
+    if kind == "fixed" and len(values) == 1:
+        return kind, values[0], 0.0
+    if kind in {"uniform", "lognormal"} and len(values) == 2:
+        return kind, values[0], values[1]
+    raise ValueError(f"invalid latency spec {spec!r} (fixed:S | uniform:LO:HI | lognormal:MEDIAN:SIGMA)")
+
+
+class MockBehavior:
+    """
+    What the server does with a request. Rates are probabilities per request.
+      mode="echo"     answer every token unchanged
+      mode="correct"  answer the lexicon spelling of tokens that fold to a lexicon entry, else echo
+    """
+
+    def __init__(self, latency: str = "fixed:0.2", rate_429: float = 0.0, rate_5xx: float = 0.0,
+                 drop_line: float = 0.0, extra_line: float = 0.0, chatter: float = 0.0, mode: str = "echo",
+                 lexicon: Iterable[str] = (), retry_after: float = 1.0, seed: int = 0):
+        if mode not in {"echo", "correct"}:
+            raise ValueError(f"mode must be 'echo' or 'correct', got {mode!r}")
+        self.latency = parse_latency(latency)
+        self.rate_429 = rate_429
+        self.rate_5xx = rate_5xx
+        self.drop_line = drop_line
+        self.extra_line = extra_line
+        self.chatter = chatter
+        self.mode = mode
+        self.lexicon: Dict[str, str] = {_fold(tok): tok for tok in lexicon}
+        self.retry_after = retry_after
+        self.seed = seed
+
+    def sample_latency(self, rng: random.Random) -> float:
+        kind, a, b = self.latency
+        if kind == "fixed":
+            return a
+        if kind == "uniform":
+            return rng.uniform(a, b)
+        return a * rng.lognormvariate(0.0, b)
+
+    def correct(self, token: str) -> str:
+        # Like a model following the prompt, tokens of length <= 2 come back unchanged
+        if self.mode == "correct" and len(token.strip()) > 2:
+            return self.lexicon.get(_fold(token), token)
+        return token
+
+
+class MockLLMServer(ThreadingHTTPServer):
+    """HTTP server holding the behavior and the request statistics."""
+
+    daemon_threads = True
+
+    def __init__(self, address: Tuple[str, int], behavior: MockBehavior):
+        super().__init__(address, _Handler)
+        self.behavior = behavior
+        self.stats: Counter = Counter()
+        self._attempts: Counter = Counter()
+        self._lock = threading.Lock()
+
+    @property
+    def url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/v1/chat/completions"
+
+    def request_rng(self, body: bytes) -> random.Random:
+        """
+        Random source of one request: the same request body gets the same sequence of outcomes,
+        and its n-th retry differs from its first attempt.
+        """
+        digest = hashlib.sha256(body).hexdigest()
+        with self._lock:
+            attempt = self._attempts[digest]
+            self._attempts[digest] += 1
+        return random.Random(f"{self.behavior.seed}:{digest}:{attempt}")
+
+    def count(self, name: str):
+        with self._lock:
+            self.stats[name] += 1
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, status: int, payload: dict, headers: Optional[Dict[str, str]] = None):
+        data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path.rstrip("/") == "/stats":
+            self._send(200, dict(self.server.stats))
+        else:
+            self._send(404, {"error": {"message": "not found"}})
+
+    def do_POST(self):
+        server: MockLLMServer = self.server
+        behavior = server.behavior
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        server.count("requests")
+        try:
+            messages = json.loads(body)["messages"]
+        except (ValueError, KeyError, TypeError):
+            server.count("bad_requests")
+            self._send(400, {"error": {"message": "invalid request body"}})
+            return
+
+        rng = server.request_rng(body)
+        stream = bool(json.loads(body).get("stream"))
+        latency = behavior.sample_latency(rng)
+        # A streamed answer starts after a share of the latency and spreads the rest over its lines
+        time.sleep(latency * STREAM_FIRST_LINE_SHARE if stream else latency)
+
+        roll = rng.random()
+        if roll < behavior.rate_429:
+            server.count("429")
+            self._send(429, {"error": {"message": "rate limited (mock)"}},
+                       headers={"Retry-After": f"{behavior.retry_after:g}"})
+            return
+        if roll < behavior.rate_429 + behavior.rate_5xx:
+            server.count("5xx")
+            self._send(rng.choice((500, 502, 503)), {"error": {"message": "server error (mock)"}})
+            return
+
+        content = self._answer(messages, rng)
+        prompt_chars = sum(len(m.get("content", "")) for m in messages)
+        usage = {"prompt_tokens": prompt_chars // 4, "completion_tokens": len(content) // 4,
+                 "total_tokens": (prompt_chars + len(content)) // 4}
+        if stream:
+            self._send_stream(content, usage, latency * (1 - STREAM_FIRST_LINE_SHARE))
+            return
+        self._send(200, {
+            "id": "mock-" + hashlib.sha1(body).hexdigest()[:12],
+            "object": "chat.completion",
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+            "usage": usage,
+        })
+
+    def _send_stream(self, content: str, usage: dict, spread: float):
+        """Send content as chat.completion.chunk events, one line per event, then usage and [DONE]."""
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+        lines = content.split("\n")
+        try:
+            for n, line in enumerate(lines):
+                delta = line + ("\n" if n < len(lines) - 1 else "")
+                chunk = {"object": "chat.completion.chunk",
+                         "choices": [{"index": 0, "delta": {"content": delta}, "finish_reason": None}]}
+                self.wfile.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode("utf-8"))
+                self.wfile.flush()
+                time.sleep(spread / len(lines))
+            final = {"object": "chat.completion.chunk", "choices": [], "usage": usage}
+            self.wfile.write(f"data: {json.dumps(final)}\n\ndata: [DONE]\n\n".encode("utf-8"))
+        except (BrokenPipeError, ConnectionResetError):
+            # The client aborted the stream
+            self.server.count("stream_aborted_by_client")
+
+    def _answer(self, messages: List[dict], rng: random.Random) -> str:
+        server: MockLLMServer = self.server
+        behavior = server.behavior
+        user = messages[-1].get("content", "")
+        indexed = _INDEXED_ITEM_RE.findall(user)
+        if indexed:
+            lines = [f"{item_id}\t{behavior.correct(tok)}" for item_id, tok in indexed]
+        else:
+            lines = [behavior.correct(tok) for tok in _ITEM_RE.findall(user)]
+
+        if len(lines) > 1 and rng.random() < behavior.drop_line:
+            server.count("dropped_line")
+            del lines[rng.randrange(len(lines))]
+        elif lines and rng.random() < behavior.extra_line:
+            server.count("extra_line")
+            lines.append("Note: all tokens corrected.")
+        if lines and rng.random() < behavior.chatter:
+            server.count("chatter")
+            lines.insert(rng.randrange(len(lines)), "Sure! Here are the corrected tokens:")
+        return "\n".join(lines)
+
+
+def start_server(behavior: MockBehavior, host: str = "127.0.0.1", port: int = 0) -> MockLLMServer:
+    """Start a server in a background thread (port 0 picks a free port, see server.url)."""
+    server = MockLLMServer((host, port), behavior)
+    threading.Thread(target=server.serve_forever, name="mock-llm", daemon=True).start()
+    return server
+
+
+def _load_lexicon(path: Optional[str]) -> List[str]:
+    if not path:
+        return []
+    with open(path, "r", encoding="utf-8") as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+def main(argv: Optional[List[str]] = None):
+    ap = argparse.ArgumentParser(description="OpenAI-compatible mock LLM server for benchmarks.")
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=8765, help="0 picks a free port")
+    ap.add_argument("--latency", default="fixed:0.2", help="fixed:S | uniform:LO:HI | lognormal:MEDIAN:SIGMA")
+    ap.add_argument("--rate-429", type=float, default=0.0)
+    ap.add_argument("--rate-5xx", type=float, default=0.0)
+    ap.add_argument("--drop-line", type=float, default=0.0, help="rate of answers missing one line")
+    ap.add_argument("--extra-line", type=float, default=0.0, help="rate of answers with an extra line")
+    ap.add_argument("--chatter", type=float, default=0.0, help="rate of answers with a chatter line inside")
+    ap.add_argument("--mode", choices=("echo", "correct"), default="echo")
+    ap.add_argument("--lexicon", help="token file used by --mode correct")
+    ap.add_argument("--retry-after", type=float, default=1.0)
+    ap.add_argument("--seed", type=int, default=0)
+    args = ap.parse_args(argv)
+
+    behavior = MockBehavior(latency=args.latency, rate_429=args.rate_429, rate_5xx=args.rate_5xx,
+                            drop_line=args.drop_line, extra_line=args.extra_line, chatter=args.chatter,
+                            mode=args.mode,
+                            lexicon=_load_lexicon(args.lexicon), retry_after=args.retry_after, seed=args.seed)
+    server = MockLLMServer((args.host, args.port), behavior)
+    # First line of stdout is the endpoint, so a parent process can read the chosen port
+    print(server.url, flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print(json.dumps(dict(server.stats)), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
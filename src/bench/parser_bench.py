@@ -0,0 +1,134 @@
+"""
+Microbenchmark of the bulk parser/writer (utils.parser.parse_lines / rebuild_lines) against the
+per-line parse_line / rebuild_line, and of the column-based read/write of process_file against the
+per-line record loop it replaced. The corpus is synthetic with a share of irregular lines (no '||',
+extra whitespace, non-numeric conf); all variants must give the same fields and byte-identical
+output. Run from src/:
+
+    python -m bench.parser_bench --lines 2000000 --repeat 3
+"""
+
+import sys
+import time
+import random
+import argparse
+import tempfile
+from pathlib import Path
+from typing import Dict, List, Optional
+
+SRC_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(SRC_DIR))
+
+from bench.benchmark import DEFAULT_REFERENCE, generate_corpus
+from utils.parser import parse_line, parse_lines, rebuild_line, rebuild_lines
+
+# Lines parse_line handles through its fallbacks or whitespace normalization
+_IRREGULAR = ["R12 R12 0.5", "GND", "", "VCC||3V3", "U1||  U 1   0.8123", " C5 || C5\t0.9", "D2||D2 n/a",
+              "Q1||Q1 1e-2", "J3||J3 0.77  ", "SW1|||SW1 0.4"]
+
+
+def _corpus(path: Path, n_lines: int, irregular: float, seed: int) -> str:
+    generate_corpus(path.parent, DEFAULT_REFERENCE, 1, n_lines, low_conf_ratio=0.3, threshold=0.95, seed=seed)
+    rng = random.Random(seed)
+    with open(path.parent / "bench_000.txt", "r", encoding="utf-8") as f:
+        lines = f.readlines()
+    for i in rng.sample(range(n_lines), int(n_lines * irregular)):
+        lines[i] = rng.choice(_IRREGULAR) + "\n"
+    path.write_text("".join(lines), encoding="utf-8")
+    return str(path)
+
+
+def _records_read(path: str, threshold: float):
+    """The per-line record loop process_file used before parse_lines (progress bar aside)."""
+    with open(path, "r", encoding="utf-8") as f:
+        raw_lines = f.readlines()
+    parsed: List[Dict] = []
+    to_fix: List[Dict] = []
+    for i, line in enumerate(raw_lines):
+        gt, pred, conf = parse_line(line)
+        parsed.append({"i": i, "gt": gt, "pred": pred, "conf": conf})
+        if conf < threshold:
+            to_fix.append({"idx": i, "pred": pred, "gt": gt, "conf": conf})
+    return parsed, to_fix
+
+
+def _records_write(parsed: List[Dict], to_fix: List[Dict]) -> str:
+    idx_to_corrected = {item["idx"]: item["pred"].upper() for item in to_fix}
+    out_lines = [rebuild_line(rec["gt"], rec["pred"], rec["conf"], idx_to_corrected.get(rec["i"], rec["pred"]))
+                 for rec in parsed]
+    return "".join(line + "\n" for line in out_lines)
+
+
+def _columns_read(path: str, threshold: float):
+    with open(path, "r", encoding="utf-8") as f:
+        gts, preds, confs = parse_lines(f.read())
+    to_fix = [{"idx": i, "pred": preds[i], "gt": gts[i], "conf": conf}
+              for i, conf in enumerate(confs) if conf < threshold]
+    return (gts, preds, confs), to_fix
+
+
+def _columns_write(columns, to_fix: List[Dict]) -> str:
+    gts, preds, confs = columns
+    corrected = list(preds)
+    for item in to_fix:
+        corrected[item["idx"]] = item["pred"].upper()
+    return rebuild_lines(gts, preds, confs, corrected)
+
+
+def _best(fn, repeat: int) -> float:
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - t0)
+    return min(times)
+
+
+def main(argv: Optional[List[str]] = None):
+    ap = argparse.ArgumentParser(description="Bulk vs per-line parse/rebuild microbenchmark.")
+    ap.add_argument("--lines", type=int, default=1000000)
+    ap.add_argument("--irregular", type=float, default=0.01, help="share of lines that are not plain")
+    ap.add_argument("--threshold", type=float, default=0.95)
+    ap.add_argument("--repeat", type=int, default=3, help="best of N runs")
+    ap.add_argument("--seed", type=int, default=0)
+    args = ap.parse_args(argv)
+
+    with tempfile.TemporaryDirectory(prefix="pcbtagent-parser-") as tmp:
+        path = _corpus(Path(tmp) / "corpus.txt", args.lines, args.irregular, args.seed)
+        with open(path, "r", encoding="utf-8") as f:
+            lines = f.readlines()
+        text = "".join(lines)
+
+        rows = [parse_line(line) for line in lines]
+        gts, preds, confs = parse_lines(text)
+        # repr() so that a "nan" conf compares equal to itself
+        if repr(rows) != repr(list(zip(gts, preds, confs))):
+            sys.exit("parse_lines differs from parse_line")
+        per_line_out = "".join(rebuild_line(g, p, c, p) + "\n" for g, p, c in rows)
+        if rebuild_lines(gts, preds, confs, preds).encode("utf-8") != per_line_out.encode("utf-8"):
+            sys.exit("rebuild_lines output differs from rebuild_line")
+        records, records_fix = _records_read(path, args.threshold)
+        columns, columns_fix = _columns_read(path, args.threshold)
+        if _records_write(records, records_fix) != _columns_write(columns, columns_fix):
+            sys.exit("column write differs from the record loop")
+
+        results = {name: _best(fn, args.repeat) for name, fn in (
+            ("parse_line", lambda: [parse_line(line) for line in lines]),
+            ("parse_lines", lambda: parse_lines(text)),
+            ("rebuild_line", lambda: "".join(rebuild_line(g, p, c, p) + "\n" for g, p, c in rows)),
+            ("rebuild_lines", lambda: rebuild_lines(gts, preds, confs, preds)),
+            ("read records", lambda: _records_read(path, args.threshold)),
+            ("read columns", lambda: _columns_read(path, args.threshold)),
+            ("write records", lambda: _records_write(records, records_fix)),
+            ("write columns", lambda: _columns_write(columns, columns_fix)))}
+
+    print(f"{args.lines} lines, {args.irregular:.1%} irregular, best of {args.repeat}; output byte-identical")
+    for name, dt in results.items():
+        print(f"{name:<14} {dt:8.3f}s  {args.lines / dt / 1e6:6.2f} M lines/s")
+    for before, after in (("parse_line", "parse_lines"), ("rebuild_line", "rebuild_lines"),
+                          ("read records", "read columns"), ("write records", "write columns")):
+        print(f"{after} vs {before}: {results[before] / results[after]:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
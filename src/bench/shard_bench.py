@@ -0,0 +1,134 @@
+"""
+Sharded folder run with several local worker processes against the mock LLM server.
+
+A synthetic corpus is corrected once by a single worker (the reference), then again by --workers
+`main.py` processes started together on the same input and output directories with SHARDED=true.
+With --kill, one worker is killed (SIGKILL) after --kill-after seconds, so its leases go stale and
+are taken over. The outputs must be byte-identical to the reference, every file must be done and no
+lease, journal or temporary file may be left. Per-worker throughput comes from the workers' stats.
+Run from src/:
+
+    python -m bench.shard_bench --workers 4 --files 16 --lines 3000 --kill --lease-seconds 3
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import signal
+import argparse
+import tempfile
+import subprocess
+from pathlib import Path
+from typing import Dict, List, Optional
+
+SRC_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(SRC_DIR))
+
+from bench.benchmark import DEFAULT_KB, DEFAULT_REFERENCE, _start_mock, generate_corpus
+from sharding import SHARD_DIR_NAME
+
+
+def _worker_env(args, url: str, in_dir: Path, out_dir: Path, worker: str) -> Dict[str, str]:
+    env = dict(os.environ)
+    env.update({
+        "OPENAI_API_KEY": "mock", "OPENAI_BASE_URL": url, "OPENAI_MODEL": "mock-gpt", "LLM_PROVIDER": "gpt",
+        "INPUT_PATH": str(in_dir), "OUTPUT_PATH": str(out_dir),
+        "BATCH_SIZE": str(args.batch_size), "CONFIDENCE_THRESHOLD": str(args.threshold),
+        "MAX_CONCURRENT_FILES": str(args.concurrent_files),
+        "RAG_KB_PATH": str(DEFAULT_KB), "REFERENCE_TOKENS_PATH": str(args.reference),
+        "CORRECTION_CACHE": "false", "CHECKPOINT_JOURNAL": "true", "INCREMENTAL": "true",
+        "SHARDED": "true", "SHARD_WORKER_ID": worker, "SHARD_LEASE_SECONDS": str(args.lease_seconds),
+        "SHARD_POLL_SECONDS": str(args.lease_seconds / 3), "VERBOSITY": "1", "LOG_FILE": "",
+        "LLM_RECORD_PATH": "", "METRICS_JSON_PATH": "", "METRICS_PROMETHEUS_PATH": "",
+    })
+    return env
+
+
+def _run_workers(args, url: str, in_dir: Path, out_dir: Path, names: List[str],
+                 kill: Optional[str] = None) -> float:
+    """Start one main.py process per name, optionally SIGKILL one, and wait for the rest."""
+    t0 = time.perf_counter()
+    procs = {}
+    for name in names:
+        log = open(out_dir.parent / f"{out_dir.name}-{name}.log", "w")
+        procs[name] = subprocess.Popen([sys.executable, "main.py"], cwd=str(SRC_DIR), stdout=log,
+                                       stderr=subprocess.STDOUT, env=_worker_env(args, url, in_dir, out_dir, name))
+    if kill:
+        time.sleep(args.kill_after)
+        procs[kill].send_signal(signal.SIGKILL)
+        print(f"killed worker {kill} after {args.kill_after:g}s")
+    for name, proc in procs.items():
+        code = proc.wait()
+        if name != kill and code != 0:
+            sys.exit(f"worker {name} exited with {code}; see {out_dir.parent}/{out_dir.name}-{name}.log")
+    return time.perf_counter() - t0
+
+
+def _outputs(out_dir: Path) -> Dict[str, bytes]:
+    return {str(p.relative_to(out_dir)): p.read_bytes() for p in sorted(out_dir.rglob("*.txt"))}
+
+
+def main(argv: Optional[List[str]] = None):
+    ap = argparse.ArgumentParser(description="Sharded multi-process folder run against the mock LLM server.")
+    ap.add_argument("--workers", type=int, default=4)
+    ap.add_argument("--files", type=int, default=16)
+    ap.add_argument("--lines", type=int, default=2000)
+    ap.add_argument("--concurrent-files", type=int, default=1, help="files per worker at a time")
+    ap.add_argument("--batch-size", type=int, default=20)
+    ap.add_argument("--threshold", type=float, default=0.95)
+    ap.add_argument("--lease-seconds", type=float, default=3.0)
+    ap.add_argument("--kill", action="store_true", help="SIGKILL one worker mid-run")
+    ap.add_argument("--kill-after", type=float, default=2.0)
+    ap.add_argument("--latency", default="lognormal:0.3:0.3")
+    ap.add_argument("--reference", type=Path, default=DEFAULT_REFERENCE)
+    ap.add_argument("--seed", type=int, default=0)
+    ap.add_argument("--keep", action="store_true", help="keep the corpus, outputs and worker logs")
+    args = ap.parse_args(argv)
+    # Mock settings shared with bench.benchmark: no injected faults, so answers depend on the token only
+    args.rate_429 = args.rate_5xx = args.drop_line = args.chatter = 0.0
+    args.retry_after, args.mock_mode = 1.0, "correct"
+
+    work_dir = Path(tempfile.mkdtemp(prefix="pcbtagent-shards-"))
+    proc, url = _start_mock(args)
+    try:
+        in_dir = work_dir / "in"
+        generate_corpus(in_dir, args.reference, args.files, args.lines, 0.3, args.threshold, args.seed)
+        t_ref = _run_workers(args, url, in_dir, work_dir / "ref", ["ref"])
+        names = [f"w{n}" for n in range(args.workers)]
+        wall = _run_workers(args, url, in_dir, work_dir / "out", names, kill=names[-1] if args.kill else None)
+
+        reference, outputs = _outputs(work_dir / "ref"), _outputs(work_dir / "out")
+        shard_dir = work_dir / "out" / SHARD_DIR_NAME
+        leftovers = ([str(p) for p in (shard_dir / "leases").iterdir()] + [str(p) for p in (shard_dir / "journals").iterdir()]
+                     + [str(p) for p in (work_dir / "out").rglob("*.tmp")])
+        n_done = sum(not json.loads(p.read_text()).get("partial") for p in (shard_dir / "done").glob("*.json"))
+        stats = [json.loads(p.read_text()) for p in sorted((shard_dir / "workers").glob("*.json"))]
+
+        print(f"{args.files} file(s) x {args.lines} line(s); 1 worker {t_ref:.1f}s, "
+              f"{args.workers} worker(s) {wall:.1f}s ({t_ref / wall:.2f}x)")
+        for st in stats:
+            print(f"  {st['worker']}: {st['files']} file(s), {st['takeovers']} takeover(s), {st['lines']} line(s), "
+                  f"{st['lines_per_s']} lines/s")
+        problems = []
+        if outputs != reference:
+            differing = sorted(rel for rel in reference if outputs.get(rel) != reference[rel])
+            problems.append(f"{len(differing)} output(s) differ from the single-worker run: {differing[:5]}")
+        if n_done != args.files:
+            problems.append(f"{n_done}/{args.files} file(s) marked done")
+        if leftovers:
+            problems.append(f"left over: {leftovers[:5]}")
+        if problems:
+            sys.exit("FAILED: " + "; ".join(problems))
+        print("OK: outputs byte-identical, every file done, no leases/journals/temp files left")
+    finally:
+        proc.kill()
+        if args.keep:
+            print(f"kept {work_dir}")
+        else:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+"""
+Spending caps of a budgeted run: LLM tokens, LLM requests and a wall-clock deadline, shared by all
+batches of one file or of a whole folder run (BUDGET_SCOPE).
+"""
+
+import time
+import logging
+import threading
+from typing import Optional
+
+from config import *
+
+logger = logging.getLogger("pcb-ocr-corrector.budget")
+
+
+class Budget:
+    """
+    Caps of 0 are unlimited. A batch is only started if its estimated tokens fit next to what was
+    spent and what started batches have reserved; spending is charged per HTTP attempt from the
+    provider's usage, so retries, re-asks and hedges count too.
+    """
+
+    def __init__(self, max_tokens: int = 0, max_requests: int = 0, deadline_seconds: float = 0.0,
+                 scope: str = "run"):
+        self.max_tokens = max_tokens
+        self.max_requests = max_requests
+        self.deadline_seconds = deadline_seconds
+        self.scope = scope
+        self.started = time.monotonic()
+        self.tokens = 0
+        self.requests = 0
+        self.reserved_tokens = 0
+        self.reserved_requests = 0
+        self.stop_reason: Optional[str] = None
+        self._lock = threading.Lock()
+
+    def _check(self, tokens: int, requests: int) -> Optional[str]:
+        """Name of the cap that `tokens` and `requests` in total would exceed, or None."""
+        if self.deadline_seconds and time.monotonic() - self.started >= self.deadline_seconds:
+            return f"deadline {self.deadline_seconds:g}s"
+        if self.max_tokens and tokens > self.max_tokens:
+            return f"{self.max_tokens} tokens"
+        if self.max_requests and requests > self.max_requests:
+            return f"{self.max_requests} requests"
+        return None
+
+    def try_reserve(self, tokens: int) -> bool:
+        """Reserve one request of `tokens` estimated tokens; False (for good) once a cap would be exceeded."""
+        with self._lock:
+            if self.stop_reason is None:
+                self.stop_reason = self._check(self.tokens + self.reserved_tokens + tokens,
+                                               self.requests + self.reserved_requests + 1)
+            if self.stop_reason is not None:
+                return False
+            self.reserved_tokens += tokens
+            self.reserved_requests += 1
+            return True
+
+    def release(self, tokens: int):
+        """Return the reservation of a finished batch; its actual spending was charged meanwhile."""
+        with self._lock:
+            self.reserved_tokens -= tokens
+            self.reserved_requests -= 1
+
+    def charge(self, tokens: int = 0, requests: int = 0):
+        with self._lock:
+            self.tokens += tokens
+            self.requests += requests
+
+    @property
+    def exhausted(self) -> bool:
+        """True once the spending itself reached a cap: not even a re-ask of a started batch is sent."""
+        with self._lock:
+            reason = self._check(self.tokens + 1, self.requests + 1)
+            if reason is not None and self.stop_reason is None:
+                self.stop_reason = reason
+            return reason is not None
+
+    def summary(self) -> str:
+        with self._lock:
+            spent = f"{self.tokens} token(s), {self.requests} request(s), {time.monotonic() - self.started:.1f}s"
+        caps = [f"{self.max_tokens} tokens" if self.max_tokens else "",
+                f"{self.max_requests} requests" if self.max_requests else "",
+                f"{self.deadline_seconds:g}s" if self.deadline_seconds else ""]
+        return f"spent {spent} of {', '.join(c for c in caps if c)} per {self.scope}"
+
+
+def new_budget(scope: str, settings: Optional[Settings] = None) -> Optional[Budget]:
+    """
+    A fresh Budget from the budget_* settings (default: get_settings()) if budgeting is on for `scope`
+    ('file' or 'run'), else None.
+    """
+    s = settings or get_settings()
+    if not (s.budget_max_tokens or s.budget_max_requests or s.budget_deadline_seconds) or s.budget_scope != scope:
+        return None
+    return Budget(s.budget_max_tokens, s.budget_max_requests, s.budget_deadline_seconds, scope)
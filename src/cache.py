@@ -0,0 +1,144 @@
+"""
+Persistent SQLite cache of LLM corrections, shared across runs, files and threads.
+"""
+
+import time
+import sqlite3
+import hashlib
+import logging
+import threading
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional
+
+from config import *
+from prompting import confidence_bucket, prompt_fingerprint
+
+logger = logging.getLogger("pcb-ocr-corrector.cache")
+
+
+def make_cache_key(pred: str, conf: float, provider: str, model: str, gt: Optional[str] = None) -> str:
+    """
+    Key of one correction: OCR token, confidence bucket, provider/model and prompt fingerprint.
+    gt is only part of the key when it was shown to the LLM.
+    """
+    fields = [pred, confidence_bucket(conf), provider, model or "", prompt_fingerprint(), gt or ""]
+    return hashlib.sha256("\x1f".join(fields).encode("utf-8")).hexdigest()
+
+
+class CorrectionCache:
+    """
+    Key/value store of corrected tokens with size-based LRU eviction.
+    The row count is kept in memory (counted once on open, re-counted only when it looks over the
+    limit), and the last-used times of hits are buffered and written with the next put, once
+    TOUCH_FLUSH_SIZE hits are pending, or on close; reads never write.
+    The hit/miss counters cover the lifetime of this instance.
+    """
+
+    TOUCH_FLUSH_SIZE = 1000
+
+    def __init__(self, path: Path, max_entries: int):
+        self.path = Path(path)
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(self.path), timeout=30, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS corrections ("
+            " key TEXT PRIMARY KEY, corrected TEXT NOT NULL, last_used REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_last_used ON corrections(last_used)")
+        self._conn.commit()
+        (self._n_rows,) = self._conn.execute("SELECT COUNT(*) FROM corrections").fetchone()
+        # key -> last hit time, not yet written
+        self._touched: Dict[str, float] = {}
+
+    def _select(self, keys: List[str], columns: str) -> List[tuple]:
+        rows = []
+        # Stay well below SQLite's bound-parameter limit
+        for i in range(0, len(keys), 500):
+            chunk = keys[i:i + 500]
+            marks = ",".join("?" * len(chunk))
+            rows += self._conn.execute(f"SELECT {columns} FROM corrections WHERE key IN ({marks})", chunk).fetchall()
+        return rows
+
+    def _flush_touched(self):
+        """Write the buffered last-used times (caller holds the lock and commits)."""
+        if self._touched:
+            self._conn.executemany("UPDATE corrections SET last_used = ? WHERE key = ?",
+                                   [(t, k) for k, t in self._touched.items()])
+            self._touched.clear()
+
+    def get_many(self, keys: Iterable[str]) -> Dict[str, str]:
+        """Look up several keys at once; the LRU timestamp of the hits is refreshed lazily."""
+        keys = list(dict.fromkeys(keys))
+        now = time.time()
+        with self._lock:
+            found: Dict[str, str] = dict(self._select(keys, "key, corrected"))
+            self._touched.update(dict.fromkeys(found, now))
+            if len(self._touched) >= self.TOUCH_FLUSH_SIZE:
+                self._flush_touched()
+                self._conn.commit()
+            self.hits += len(found)
+            self.misses += len(keys) - len(found)
+        return found
+
+    def put_many(self, entries: Dict[str, str]):
+        """Store corrections and evict the least recently used rows above max_entries."""
+        if not entries:
+            return
+        now = time.time()
+        with self._lock:
+            n_existing = len(self._select(list(entries), "key"))
+            self._flush_touched()
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO corrections (key, corrected, last_used) VALUES (?, ?, ?)",
+                [(k, v, now) for k, v in entries.items()],
+            )
+            self._n_rows += len(entries) - n_existing
+            if self.max_entries > 0 and self._n_rows > self.max_entries:
+                # Other processes may share the file: count for real before evicting
+                (self._n_rows,) = self._conn.execute("SELECT COUNT(*) FROM corrections").fetchone()
+                overflow = self._n_rows - self.max_entries
+                if overflow > 0:
+                    self._conn.execute(
+                        "DELETE FROM corrections WHERE key IN "
+                        "(SELECT key FROM corrections ORDER BY last_used ASC LIMIT ?)", (overflow,)
+                    )
+                    self._n_rows -= overflow
+                    logger.debug(f"Evicted {overflow} least recently used cache entries.")
+            self._conn.commit()
+
+    def stats(self) -> Dict[str, float]:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+    def close(self):
+        with self._lock:
+            self._flush_touched()
+            self._conn.commit()
+            self._conn.close()
+
+
+_cache: Optional[CorrectionCache] = None
+_cache_lock = threading.Lock()
+
+
+def get_correction_cache() -> Optional[CorrectionCache]:
+    """Return the process-wide correction cache (None if CORRECTION_CACHE is disabled)."""
+    global _cache
+    settings = get_settings()
+    if not settings.correction_cache:
+        return None
+    with _cache_lock:
+        if _cache is None:
+            _cache = CorrectionCache(settings.correction_cache_path, settings.correction_cache_max_entries)
+            logger.info(f"Correction cache: {settings.correction_cache_path}")
+        return _cache
@@ -1,72 +1,295 @@
 # Refactored by: spn on 2025-09-22
 
 """
-Centralized management of API keys, knowledge bases, prompt references, 
+Centralized management of API keys, knowledge bases, prompt references,
 and other global configurations.
+
+Nothing is read at import. get_settings() builds the process-wide Settings from the environment
+(and the .env file of the repo) on first use, and modules read it (or the Settings they are given)
+when they need a value. The upper-case module names (config.BATCH_SIZE, ...) are served from it on
+access but are not exported by `from config import *`. Reference tokens and the knowledge base are read from
+disk only when first needed and memoized per path. Callers that need other settings than the
+environment's build their own Settings (Settings(...), Settings.from_env() or settings.replace(...)).
 """
 
+import json
 import logging
 import os
+import threading
+from dataclasses import dataclass, field, fields, replace
+from functools import lru_cache
 from pathlib import Path
-from typing import List
-from pathlib import Path
+from typing import Dict, List, Optional, get_args
 from dotenv import load_dotenv
-load_dotenv(Path(__file__).resolve().parent.parent / ".env")
 
 # ----------------------------------------------------------------------
 # Project paths
 # ----------------------------------------------------------------------
 
 PROJECT_ROOT = Path(__file__).resolve().parent.parent.parent    # JLC_Text_Parser
-INPUT_PATH = PROJECT_ROOT / Path(os.getenv("INPUT_PATH"))
-OUTPUT_PATH = PROJECT_ROOT / Path(os.getenv("OUTPUT_PATH"))
+DOTENV_PATH = Path(__file__).resolve().parent.parent / ".env"
 
-RAG_KB_PATH = Path(os.getenv(
-    "RAG_KB_PATH",
-    PROJECT_ROOT / r"PCBTagent/resources/knowledge_base_v1.json"
-))
+_TRUE = {"1", "true", "yes"}
 
-REFERENCE_TOKENS_PATH = Path(os.getenv(
-    "REFERENCE_TOKENS_PATH",
-    PROJECT_ROOT / r"PCBTagent/resources/sampled_gts_unique_700_long_300_short.txt"
-))
 
-# ----------------------------------------------------------------------
-# Processing parameters (env override)
-# ----------------------------------------------------------------------
+def _provider_from_env(prefix: str) -> dict:
+    """
+    Settings of an OpenAI-compatible provider read from <PREFIX>_API_KEY / _BASE_URL / _MODEL,
+    plus its rate limits <PREFIX>_RPM / _TPM shared by all concurrent files/batches (0 = unlimited).
+    """
+    return {
+        "api_key": os.getenv(f"{prefix}_API_KEY"),
+        "base_url": os.getenv(f"{prefix}_BASE_URL"),
+        "model": os.getenv(f"{prefix}_MODEL"),
+        "rpm": int(os.getenv(f"{prefix}_RPM") or "0"),
+        "tpm": int(os.getenv(f"{prefix}_TPM") or "0"),
+    }
 
-BATCH_SIZE = int(os.getenv("BATCH_SIZE"))
-CONFIDENCE_THRESHOLD = float(os.getenv("CONFIDENCE_THRESHOLD"))
-INCLUDE_GT_IN_PROMPT = bool(os.getenv("INCLUDE_GT_IN_PROMPT").lower()) in {"1","true","yes"}
-REFERENCE_MAX_TOKENS = int(os.getenv("REFERENCE_MAX_TOKENS"))
 
-# ----------------------------------------------------------------------
-# Logging
-# ----------------------------------------------------------------------
+def _providers_from_env() -> Dict[str, dict]:
+    # All providers known by name. Any other OpenAI-compatible endpoint is added by listing it in
+    # LLM_EXTRA_PROVIDERS (e.g. "qwen") and setting QWEN_API_KEY, QWEN_BASE_URL, QWEN_MODEL, ...
+    providers = {
+        "gpt": _provider_from_env("OPENAI"),
+        "deepseek": _provider_from_env("DEEPSEEK"),
+    }
+    for name in filter(None, (n.strip() for n in os.getenv("LLM_EXTRA_PROVIDERS", "").split(","))):
+        providers[name] = _provider_from_env(name.upper())
+    return providers
 
-VERBOSITY = int(os.getenv("VERBOSITY"))
-LOG_FILE = Path(os.getenv("LOG_FILE"))
 
-# ----------------------------------------------------------------------
-# LLM Provider
-# ----------------------------------------------------------------------
+@dataclass(frozen=True)
+class Settings:
+    """
+    Typed settings of the corrector. Every field is read from the environment variable of its
+    upper-case name (metadata "env" where it differs); unset or empty variables keep the default.
+    Paths with metadata "under_root" are relative to PROJECT_ROOT.
+    """
+
+    # --- Project paths ---
+    input_path: Optional[Path] = field(default=None, metadata={"under_root": True})
+    output_path: Optional[Path] = field(default=None, metadata={"under_root": True})
+    rag_kb_path: Path = PROJECT_ROOT / "PCBTagent/resources/knowledge_base_v1.json"
+    reference_tokens_path: Path = PROJECT_ROOT / "PCBTagent/resources/sampled_gts_unique_700_long_300_short.txt"
+
+    # --- Processing parameters ---
+    batch_size: int = 50
+    # Same default as .env.example: every item is sent (confidences are at most 1.0)
+    confidence_threshold: float = 1.01
+    include_gt_in_prompt: bool = False
+    reference_max_tokens: int = 120
+
+    # Per-batch retrieval of similar reference tokens and applicable KB sections
+    # (off: every batch gets the first reference_max_tokens references and the whole KB)
+    prompt_retrieval: bool = True
+    reference_per_item: int = 3
+
+    # Resolve easy tokens locally (prompt rules, reference lexicon, pin/refdes patterns) before the LLM
+    local_correction: bool = True
+
+    # Check every LLM answer against the hard constraints of the prompt (length, swaps, symbols, ...);
+    # answers that break one are re-asked and finally fall back to the OCR token
+    output_validation: bool = True
+
+    # Upper bound of correct_batch calls in flight at the same time within one file
+    max_inflight_batches: int = 4
+
+    # Adaptive batching: batches are cut by estimated prompt tokens (starting around batch_size items)
+    # within [batch_min_tokens, batch_max_tokens]; the budget halves on failures or slow batches and
+    # grows by batch_budget_growth after fast, clean ones. Failed items are split in two and re-queued
+    # up to batch_split_depth times.
+    adaptive_batching: bool = True
+    batch_min_tokens: int = 100
+    batch_max_tokens: int = 4000
+    batch_latency_target: float = 20.0
+    batch_budget_growth: float = 1.25
+    batch_split_depth: int = 2
+
+    # Streaming mode: read lazily and write output incrementally in bounded memory (for multi-GB inputs).
+    # stream_window_lines caps the lines held while waiting for the oldest unresolved one.
+    streaming: bool = False
+    stream_window_lines: int = 100000
+
+    # Number of files process_folder works on at the same time
+    max_concurrent_files: int = 4
+
+    # Budgeted mode: cap the LLM tokens / requests / wall-clock seconds (0 = no cap) per file or per folder
+    # run (budget_scope "file" | "run"). Items are sent lowest confidence first; those left when the budget
+    # runs out keep their OCR token and the file is not recorded as done, so a later run continues it.
+    budget_max_tokens: int = 0
+    budget_max_requests: int = 0
+    budget_deadline_seconds: float = 0.0
+    budget_scope: str = "run"
+
+    # Sharded folder runs: several workers, on one or many machines sharing INPUT_PATH and OUTPUT_PATH,
+    # claim files through lease files in the output directory (see sharding.py). A worker that stops
+    # renewing its leases for shard_lease_seconds is considered dead and its files are taken over;
+    # idle workers look for such files every shard_poll_seconds. shard_worker_id defaults to host-pid.
+    sharded: bool = False
+    shard_worker_id: Optional[str] = None
+    shard_lease_seconds: float = 60.0
+    shard_poll_seconds: float = 5.0
+
+    # Checkpoint journal of batch results and finished files; resume replays it after an interrupted run
+    checkpoint_journal: bool = True
+    resume: bool = False
+
+    # Skip input files whose content and settings are unchanged since their output was written
+    incremental: bool = True
+
+    # --- Correction service (service.py) ---
+    service_host: str = "127.0.0.1"
+    service_port: int = 8080
+    # Listen on this Unix socket instead of TCP when set
+    service_socket: Optional[str] = None
+    # Low-confidence items of concurrent requests are merged into one batch of up to service_max_batch
+    # items (default: batch_size); a partial batch is sent once its oldest item has waited
+    # service_batch_window_ms
+    service_max_batch: Optional[int] = None
+    service_batch_window_ms: float = 50.0
+    service_max_body_bytes: int = 16 * 1024 * 1024
+
+    # --- Correction cache (persistent across runs and files) ---
+    correction_cache: bool = True
+    correction_cache_path: Path = Path(__file__).resolve().parent.parent / ".cache" / "corrections.sqlite"
+    correction_cache_max_entries: int = 500000
+
+    # --- Logging ---
+    verbosity: int = 1
+    log_file: Optional[Path] = None
+
+    # Run metrics (stage timings, retries, fallbacks, tokens): JSON summary and/or Prometheus text file
+    metrics_json_path: Optional[str] = None
+    metrics_prometheus_path: Optional[str] = None
+
+    # Append every raw LLM answer per item to this JSONL file for offline replay by evaluate.py (None = off)
+    llm_record_path: Optional[str] = None
 
-PROVIDER = os.getenv("LLM_PROVIDER")
+    # --- LLM provider ---
+    provider: str = field(default="deepseek", metadata={"env": "LLM_PROVIDER"})
+    # Provider name -> {api_key, base_url, model, rpm, tpm}, see _provider_from_env
+    llm_providers: Dict[str, dict] = field(default_factory=dict, metadata={"env": None})
 
-OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
-OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL")
-OPENAI_MODEL = os.getenv("OPENAI_MODEL")
+    # Connections kept alive per provider (default: the maximum number of concurrent requests)
+    llm_pool_size: Optional[int] = None
 
-DEEPSEEK_API_KEY = os.getenv("DEEPSEEK_API_KEY")
-DEEPSEEK_BASE_URL = os.getenv("DEEPSEEK_BASE_URL")
-DEEPSEEK_MODEL = os.getenv("DEEPSEEK_MODEL")
+    # Adaptive concurrency per provider: halved on 429/503/timeouts, raised by one per window of successes
+    # (defaults: max = llm_pool_size, initial = max)
+    llm_concurrency_max: Optional[int] = None
+    llm_concurrency_min: int = 1
+    llm_concurrency_initial: Optional[int] = None
+
+    # Routing: spread requests over several providers by weight ("gpt:3,deepseek:1"; empty = provider only)
+    # and fail over between them. Hedging sends a duplicate of a request that is still unanswered after the
+    # hedge_quantile latency of its provider (hedge_initial_delay until hedge_min_samples are seen) to the
+    # next provider; at most hedge_max_rate of all requests are hedged.
+    llm_route_weights: str = ""
+    hedge_enabled: bool = False
+    hedge_quantile: float = 0.95
+    hedge_min_samples: int = 20
+    hedge_initial_delay: float = 15.0
+    hedge_min_delay: float = 1.0
+    hedge_max_rate: float = 0.1
+
+    # Stream LLM answers (SSE) and parse them line by line: items are reported as they arrive and a bad
+    # answer (chatter, unknown IDs, too many lines) is cut off early and its missing items re-asked
+    llm_stream: bool = False
+
+    # Circuit breaker per provider: open after N consecutive failed calls (0 = off), probe again after S seconds
+    circuit_failure_threshold: int = 5
+    circuit_reset_seconds: float = 30.0
+
+    # Fields filled from the others because they were not set (see __post_init__)
+    _derived: frozenset = field(default=frozenset(), init=False, repr=False, compare=False)
+
+    def __post_init__(self):
+        # Frozen: normalized and derived values are filled in through object.__setattr__
+        object.__setattr__(self, "budget_scope", self.budget_scope.strip().lower())
+        if self.budget_scope not in {"file", "run"}:
+            raise ValueError(f"BUDGET_SCOPE must be 'file' or 'run', got {self.budget_scope!r}")
+        derived = {"service_max_batch": lambda: self.batch_size,
+                   "llm_pool_size": lambda: self.max_inflight_batches * self.max_concurrent_files,
+                   "llm_concurrency_max": lambda: self.llm_pool_size,
+                   "llm_concurrency_initial": lambda: self.llm_concurrency_max}
+        unset = [name for name in derived if getattr(self, name) is None]
+        for name in unset:
+            object.__setattr__(self, name, derived[name]())
+        # Recomputed by replace() unless given explicitly
+        object.__setattr__(self, "_derived", frozenset(unset))
+
+    @classmethod
+    def from_env(cls, dotenv_path: Optional[Path] = DOTENV_PATH, **overrides) -> "Settings":
+        """
+        Settings from the environment, after loading dotenv_path (variables already set win).
+        Keyword overrides replace single fields.
+        """
+        if dotenv_path:
+            load_dotenv(dotenv_path)
+        values = {"llm_providers": _providers_from_env()}
+        for f in fields(cls):
+            env_name = f.metadata.get("env", f.name.upper())
+            raw = os.getenv(env_name, "").strip() if env_name else ""
+            if raw:
+                values[f.name] = _parse_env(f.type, raw, env_name, f.metadata.get("under_root", False))
+        values.update(overrides)
+        return cls(**values)
+
+    def replace(self, **changes) -> "Settings":
+        """A copy with some fields changed, e.g. settings.replace(confidence_threshold=0.9)."""
+        return replace(self, **{**dict.fromkeys(self._derived), **changes})
+
+    @property
+    def reference_corpus(self) -> List[str]:
+        """Full reference token file (searched per batch when prompt_retrieval is on), read on first use."""
+        return load_reference_tokens(self.reference_tokens_path)
+
+    @property
+    def reference_tokens(self) -> List[str]:
+        """Static head of the reference file used when prompt_retrieval is off."""
+        return self.reference_corpus[:self.reference_max_tokens]
+
+    @property
+    def knowledge_base(self) -> dict:
+        """Correction knowledge base, read on first use."""
+        return load_knowledge_base(self.rag_kb_path)
+
+
+def _parse_env(tp, raw: str, env_name: str, under_root: bool):
+    """Convert an environment value to the (Optional-unwrapped) field type."""
+    tp = next((arg for arg in get_args(tp) if arg is not type(None)), tp)
+    if tp is bool:
+        return raw.lower() in _TRUE
+    try:
+        value = tp(raw)
+    except ValueError:
+        raise ValueError(f"{env_name}={raw!r} is not a valid {tp.__name__}") from None
+    return PROJECT_ROOT / value if under_root else value
+
+
+_settings: Optional[Settings] = None
+_settings_lock = threading.Lock()
+
+
+def get_settings() -> Settings:
+    """Return the process-wide settings, read from the environment on first use."""
+    global _settings
+    if _settings is not None:
+        return _settings
+    with _settings_lock:
+        if _settings is None:
+            _settings = Settings.from_env()
+        return _settings
 
 # ----------------------------------------------------------------------
 # Prompt References
 # ----------------------------------------------------------------------
 
-def load_reference_tokens(path: Path, max_n: int) -> List[str]:
-    """Load reference word list from given path for few-shot prompts."""
+@lru_cache(maxsize=8)
+def load_reference_tokens(path: Path, max_n: int = 0) -> List[str]:
+    """
+    Load reference word list from given path for few-shot prompts (max_n <= 0: no limit).
+    Memoized per (path, max_n); callers must not modify the returned list.
+    """
     if not path.exists():
         logging.warning(f"[ref] tokens file not found: {path}")
         return []
@@ -76,11 +299,37 @@ def load_reference_tokens(path: Path, max_n: int) -> List[str]:
             token = line.strip()
             if token:
                 tokens.append(token)
-                if len(tokens) >= max_n:
+                if 0 < max_n <= len(tokens):
                     break
     return tokens
 
-REFERENCE_TOKENS = load_reference_tokens(REFERENCE_TOKENS_PATH, REFERENCE_MAX_TOKENS)
+@lru_cache(maxsize=8)
+def load_knowledge_base(path: Path) -> dict:
+    """Load the correction knowledge base (JSON) from given path. Memoized per path; read-only."""
+    if not path.exists():
+        logging.warning(f"[kb] knowledge base file not found: {path}")
+        return {}
+    with open(path, "r", encoding="utf-8") as file:
+        return json.load(file)
+
+# ----------------------------------------------------------------------
+# Module-level names (read from get_settings() on each access)
+# ----------------------------------------------------------------------
+
+# config.BATCH_SIZE -> get_settings().batch_size, ...; PROVIDER keeps its historical name for LLM_PROVIDER.
+# Not part of `from config import *`, which would read the settings at import: modules call
+# get_settings() (or use the Settings they are given) when they need a value.
+_SETTING_NAMES = {f.name.upper(): f.name for f in fields(Settings)}
+# Loaded from disk when accessed
+_RESOURCE_NAMES = {"REFERENCE_CORPUS": "reference_corpus", "REFERENCE_TOKENS": "reference_tokens",
+                   "KNOWLEDGE_BASE": "knowledge_base"}
+
+
+def __getattr__(name: str):
+    attr = _SETTING_NAMES.get(name) or _RESOURCE_NAMES.get(name)
+    if attr is None:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    return getattr(get_settings(), attr)
 
 # ----------------------------------------------------------------------
 # OCR related
@@ -109,3 +358,6 @@ TEXT_CLASSES = {
     # 原理图中的自由文本（例如注释、标题栏信息等）
     'free_text': 1
 }
+
+__all__ = ["PROJECT_ROOT", "DOTENV_PATH", "Settings", "get_settings", "load_reference_tokens",
+           "load_knowledge_base", "MIN_FONT_SIZE_TO_DRAW", "TEXT_CLASSES"]
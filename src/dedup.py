@@ -0,0 +1,84 @@
+"""
+Deduplication of identical low-confidence items, within one file and across the files of a folder run.
+"""
+
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Dict, Hashable, Iterable, List, Optional, Tuple
+
+from prompting import confidence_bucket
+
+logger = logging.getLogger("pcb-ocr-corrector.dedup")
+
+
+def dedup_key(item: Dict, include_gt: bool) -> Tuple[str, str, str]:
+    """Items with the same key get the same prompt line (up to CONF digits), so one answer serves them all."""
+    return item["pred"], confidence_bucket(item["conf"]), item["gt"] if include_gt else ""
+
+
+def group_items(items: List[Dict], include_gt: bool) -> Dict[Tuple[str, str, str], List[Dict]]:
+    """Group items by dedup_key, keeping first-occurrence order; also stores the key on each item."""
+    groups: Dict[Tuple[str, str, str], List[Dict]] = {}
+    for item in items:
+        item["key"] = dedup_key(item, include_gt)
+        groups.setdefault(item["key"], []).append(item)
+    return groups
+
+
+class CorrectionMemo:
+    """
+    Run-wide memo shared by all files of one process_folder run.
+    The first file that claims a key owns it and sends it to the LLM; files claiming
+    the same key later wait on the owner's result instead of sending it again.
+    With max_resolved > 0 only that many resolved keys are kept, least recently claimed dropped first,
+    so that memory follows the keys in flight rather than every distinct key of a run (streaming mode);
+    a dropped key is claimed and owned afresh. Keys still waiting for a result are never dropped.
+    """
+
+    def __init__(self, max_resolved: int = 0):
+        self._lock = threading.Lock()
+        self._futures: Dict[Hashable, Future] = {}
+        self.max_resolved = max_resolved
+        # Resolved keys in least recently claimed order (only with max_resolved)
+        self._resolved: "OrderedDict[Hashable, None]" = OrderedDict()
+        self.shared = 0
+
+    def claim(self, keys: Iterable[Hashable]) -> Tuple[List[Hashable], Dict[Hashable, Future]]:
+        """Return (keys owned by the caller, futures of keys owned by someone else)."""
+        owned: List[Hashable] = []
+        foreign: Dict[Hashable, Future] = {}
+        with self._lock:
+            for key in keys:
+                fut = self._futures.get(key)
+                if fut is None:
+                    self._futures[key] = Future()
+                    owned.append(key)
+                else:
+                    foreign[key] = fut
+                    if key in self._resolved:
+                        self._resolved.move_to_end(key)
+            self.shared += len(foreign)
+        return owned, foreign
+
+    def resolve(self, key: Hashable, corrected: Optional[str]):
+        """Publish the result of an owned key. None (no valid answer) lets a later claimer retry."""
+        with self._lock:
+            fut = self._futures.get(key)
+            if corrected is None:
+                self._futures.pop(key, None)
+            elif self.max_resolved > 0 and fut is not None:
+                self._resolved[key] = None
+                while len(self._resolved) > self.max_resolved:
+                    self._futures.pop(self._resolved.popitem(last=False)[0], None)
+        if fut is not None and not fut.done():
+            fut.set_result(corrected)
+
+    def release(self, keys: Iterable[Hashable]):
+        """Resolve owned keys that never got a result, so that no waiter blocks forever."""
+        for key in keys:
+            with self._lock:
+                fut = self._futures.get(key)
+            if fut is not None and not fut.done():
+                self.resolve(key, None)
@@ -0,0 +1,249 @@
+"""
+Offline evaluator of recorded LLM answers (see recording.py, LLM_RECORD_PATH). The GT column of the
+input files scores exact match and character error rate (CER) before and after correction. A sweep
+over confidence thresholds and batch sizes then reports accuracy against the LLM calls a run would
+make. Recorded answers are replayed instead of asking a provider, so nothing goes over the network.
+Files are scored by a pool of worker processes. Run from src/:
+
+    python evaluate.py --input ../data/in --recording ../answers.jsonl --thresholds 0.5:1.0:0.05 --batch-sizes 10,20,40
+
+Replay mirrors the pipeline: the local corrector goes first, then the latest recorded answer of the
+item's dedup key that passes output validation; anything else keeps its OCR token. Items below a
+threshold with no recorded answer are reported as unrecorded and scored as kept.
+"""
+
+import os
+import json
+import math
+import logging
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+from config import *
+from dedup import dedup_key
+from local_correct import get_local_corrector
+from recording import read_recording
+from utils.parser import parse_line
+from validation import check_correction
+
+logger = logging.getLogger("pcb-ocr-corrector.evaluate")
+
+# Per worker process, set by _init_worker
+_ANSWERS: Dict[Tuple, str] = {}
+_LOCAL = None
+_INCLUDE_GT = False
+
+
+def edit_distance(a: str, b: str) -> int:
+    """Levenshtein distance in characters."""
+    if len(a) < len(b):
+        a, b = b, a
+    prev = list(range(len(b) + 1))
+    for i, ca in enumerate(a, start=1):
+        cur = [i]
+        for j, cb in enumerate(b, start=1):
+            cur.append(min(prev[j] + 1, cur[j - 1] + 1, prev[j - 1] + (ca != cb)))
+        prev = cur
+    return prev[-1]
+
+
+def parse_thresholds(spec: str) -> List[float]:
+    """Thresholds as "LO:HI:STEP" (both ends included) or a comma-separated list."""
+    if ":" in spec:
+        lo, hi, step = (float(x) for x in spec.split(":"))
+        if step <= 0 or hi < lo:
+            raise ValueError(f"invalid threshold range {spec!r}")
+        return [round(lo + n * step, 6) for n in range(int(round((hi - lo) / step)) + 1)]
+    return sorted(float(x) for x in spec.split(",") if x.strip())
+
+
+def load_answers(path: Path, include_gt: bool, validate: bool) -> Tuple[Dict[Tuple, str], int, int]:
+    """
+    Latest usable answer per dedup key of a recording; answers failing validation are skipped.
+    Returns (answers, records read, records rejected).
+    """
+    answers: Dict[Tuple, str] = {}
+    n_records = n_rejected = 0
+    for rec in read_recording(path):
+        n_records += 1
+        answer = (rec.get("answer") or "").strip()
+        if not answer:
+            continue
+        if validate and check_correction(rec["pred"], rec["conf"], answer) is not None:
+            n_rejected += 1
+            continue
+        answers[dedup_key(rec, include_gt)] = answer
+    return answers, n_records, n_rejected
+
+
+def _init_worker(answers: Dict[Tuple, str], use_local: bool, include_gt: bool):
+    global _ANSWERS, _LOCAL, _INCLUDE_GT
+    _ANSWERS = answers
+    _LOCAL = get_local_corrector() if use_local else None
+    _INCLUDE_GT = include_gt
+
+
+def _evaluate_file(path: str, thresholds: List[float]) -> Dict:
+    """
+    Score one input file at every threshold. Besides the counts, returns the lowest confidence of
+    every dedup key that would go to the LLM, for the parent to count calls across files.
+    """
+    top = max(thresholds)
+    n_lines = n_scored = gt_chars = exact_before = edits_before = 0
+    rows = [{"below": 0, "local": 0, "llm": 0, "unrecorded": 0, "exact": 0, "edits": 0} for _ in thresholds]
+    resolved: Dict[Tuple, Tuple[str, str]] = {}
+    sent: Dict[Tuple, float] = {}
+
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            gt, pred, conf = parse_line(line)
+            n_lines += 1
+            scored = bool(gt)
+            if scored:
+                n_scored += 1
+                gt_chars += len(gt)
+                d_pred = edit_distance(pred, gt)
+                exact_before += pred == gt
+                edits_before += d_pred
+            if conf >= top:
+                for row in rows:
+                    row["exact"] += scored and pred == gt
+                    row["edits"] += d_pred if scored else 0
+                continue
+
+            item = {"pred": pred, "conf": conf, "gt": gt}
+            key = dedup_key(item, _INCLUDE_GT)
+            if key not in resolved:
+                fixed = _LOCAL.resolve(pred, conf) if _LOCAL else None
+                if fixed is not None:
+                    resolved[key] = (fixed, "local")
+                elif key in _ANSWERS:
+                    resolved[key] = (_ANSWERS[key], "llm")
+                else:
+                    resolved[key] = (pred, "unrecorded")
+            fixed, source = resolved[key]
+            if source != "local":
+                sent[key] = min(conf, sent.get(key, conf))
+            d_fixed = edit_distance(fixed, gt) if scored else 0
+
+            for t, row in zip(thresholds, rows):
+                if conf < t:
+                    row["below"] += 1
+                    row[source] += 1
+                    row["exact"] += scored and fixed == gt
+                    row["edits"] += d_fixed
+                else:
+                    row["exact"] += scored and pred == gt
+                    row["edits"] += d_pred if scored else 0
+
+    return {"path": path, "lines": n_lines, "scored": n_scored, "gt_chars": gt_chars,
+            "exact_before": exact_before, "edits_before": edits_before, "rows": rows, "sent": sent}
+
+
+def evaluate(paths: List[str], answers: Dict[Tuple, str], thresholds: List[float], batch_sizes: List[int],
+             workers: int = 1, use_local: Optional[bool] = None, include_gt: Optional[bool] = None) -> Dict:
+    """
+    Score `paths` at every threshold with `workers` processes. LLM items and calls are counted like a
+    folder run: a dedup key is sent once, by the first file holding it, and every file cuts its own
+    items into batches of the batch size (re-asks and adaptive batching aside).
+    use_local and include_gt default to LOCAL_CORRECTION and INCLUDE_GT_IN_PROMPT.
+    """
+    settings = get_settings()
+    use_local = settings.local_correction if use_local is None else use_local
+    include_gt = settings.include_gt_in_prompt if include_gt is None else include_gt
+    if workers > 1 and len(paths) > 1:
+        with ProcessPoolExecutor(max_workers=min(workers, len(paths)), initializer=_init_worker,
+                                 initargs=(answers, use_local, include_gt)) as pool:
+            results = list(pool.map(_evaluate_file, paths, repeat(thresholds)))
+    else:
+        _init_worker(answers, use_local, include_gt)
+        results = [_evaluate_file(path, thresholds) for path in paths]
+
+    total = {name: sum(r[name] for r in results)
+             for name in ("lines", "scored", "gt_chars", "exact_before", "edits_before")}
+    scored = max(total["scored"], 1)
+    gt_chars = max(total["gt_chars"], 1)
+    report = {"files": len(paths), "lines": total["lines"], "scored_lines": total["scored"],
+              "recorded_keys": len(answers),
+              "exact_before": round(total["exact_before"] / scored, 4),
+              "cer_before": round(total["edits_before"] / gt_chars, 4),
+              "sweep": []}
+    for n, t in enumerate(thresholds):
+        rows = [r["rows"][n] for r in results]
+        seen = set()
+        calls = dict.fromkeys(batch_sizes, 0)
+        for r in results:
+            new = [key for key, conf in r["sent"].items() if conf < t and key not in seen]
+            seen.update(new)
+            for bs in batch_sizes:
+                calls[bs] += math.ceil(len(new) / bs)
+        point = {"threshold": t,
+                 "below": sum(row["below"] for row in rows),
+                 "local": sum(row["local"] for row in rows),
+                 "replayed": sum(row["llm"] for row in rows),
+                 "unrecorded": sum(row["unrecorded"] for row in rows),
+                 "llm_items": len(seen)}
+        point.update({f"llm_calls_b{bs}": calls[bs] for bs in batch_sizes})
+        point["exact_after"] = round(sum(row["exact"] for row in rows) / scored, 4)
+        point["cer_after"] = round(sum(row["edits"] for row in rows) / gt_chars, 4)
+        report["sweep"].append(point)
+    return report
+
+
+def _input_files(path: Path) -> List[str]:
+    if path.is_file():
+        return [str(path)]
+    return sorted(os.path.join(root, f) for root, _, files in os.walk(path) for f in files
+                  if f.lower().endswith(".txt"))
+
+
+def main(argv: Optional[List[str]] = None):
+    settings = get_settings()
+    ap = argparse.ArgumentParser(description="Offline accuracy / LLM-call evaluation of recorded answers.")
+    ap.add_argument("--input", type=Path, default=settings.input_path, help="input file or folder (gt||pred conf lines)")
+    ap.add_argument("--recording", type=Path, default=settings.llm_record_path,
+                    help="answers recorded with LLM_RECORD_PATH")
+    ap.add_argument("--thresholds", default=str(settings.confidence_threshold), help="LO:HI:STEP or a comma-separated list")
+    ap.add_argument("--batch-sizes", default=str(settings.batch_size), help="comma-separated batch sizes to count calls for")
+    ap.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="worker processes")
+    ap.add_argument("--include-gt", action="store_true", default=settings.include_gt_in_prompt,
+                    help="dedup keys include the GT, as for a run with INCLUDE_GT_IN_PROMPT")
+    ap.add_argument("--no-local", action="store_true", help="replay without the local corrector")
+    ap.add_argument("--no-validation", action="store_true", help="replay answers that fail output validation too")
+    ap.add_argument("--json", type=Path, help="also write the report to this file")
+    args = ap.parse_args(argv)
+
+    logging.basicConfig(level=logging.WARNING, format="%(levelname)s %(name)s: %(message)s")
+    if not args.recording or not Path(args.recording).exists():
+        ap.error("a recording is needed (--recording or LLM_RECORD_PATH)")
+    if not args.input:
+        ap.error("an input is needed (--input or INPUT_PATH)")
+    paths = _input_files(args.input)
+    if not paths:
+        ap.error(f"no .txt input under {args.input}")
+
+    answers, n_records, n_rejected = load_answers(args.recording, args.include_gt,
+                                                  validate=settings.output_validation and not args.no_validation)
+    report = evaluate(paths, answers, parse_thresholds(args.thresholds),
+                      [int(x) for x in args.batch_sizes.split(",") if x.strip()], args.workers,
+                      use_local=settings.local_correction and not args.no_local, include_gt=args.include_gt)
+    report["recorded_answers"] = n_records
+    report["rejected_answers"] = n_rejected
+
+    print(f"{report['files']} file(s), {report['lines']} line(s), {report['scored_lines']} with GT; "
+          f"{n_records} recorded answer(s), {n_rejected} rejected, {report['recorded_keys']} usable key(s)")
+    print(f"before correction: exact {report['exact_before']:.2%}, CER {report['cer_before']:.2%}")
+    columns = list(report["sweep"][0])
+    print("  ".join(f"{c:>12}" for c in columns))
+    for point in report["sweep"]:
+        print("  ".join(f"{point[c]:>12.2%}" if c in {"exact_after", "cer_after"} else f"{point[c]:>12}"
+                        for c in columns))
+    if args.json:
+        args.json.write_text(json.dumps(report, indent=2) + "\n", encoding="utf-8")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,185 @@
+"""
+Adaptive admission control shared by every LLM call made to the same provider:
+an AIMD concurrency limit that honours Retry-After, and a circuit breaker.
+"""
+
+import time
+import logging
+import threading
+from email.utils import parsedate_to_datetime
+from typing import Dict, Optional
+
+from config import *
+from metrics import METRICS
+
+logger = logging.getLogger("pcb-ocr-corrector.flow_control")
+
+# Cap on a provider-requested pause, so a bogus Retry-After cannot stall a run for hours
+MAX_RETRY_AFTER = 300.0
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Seconds to wait from a Retry-After header (delta-seconds or HTTP-date), None if absent/invalid."""
+    if not value:
+        return None
+    value = value.strip()
+    try:
+        seconds = float(value)
+    except ValueError:
+        try:
+            seconds = parsedate_to_datetime(value).timestamp() - time.time()
+        except (TypeError, ValueError):
+            return None
+    return min(max(0.0, seconds), MAX_RETRY_AFTER)
+
+
+class CircuitOpenError(ConnectionError):
+    """Raised instead of calling a provider whose circuit breaker is open."""
+
+
+class AIMDController:
+    """
+    Concurrency limit of one provider: additive increase (+1 per `limit` successful calls),
+    multiplicative decrease on overload (429/503/timeouts), at most once per `cooldown` seconds so a
+    burst of failures from one congested window counts once. A Retry-After pauses all callers.
+    """
+
+    def __init__(self, name: str, initial: int, min_limit: int = 1, max_limit: int = 16,
+                 decrease: float = 0.5, cooldown: float = 1.0):
+        self.name = name
+        self.min_limit = max(1, min_limit)
+        self.max_limit = max(self.min_limit, max_limit)
+        self.limit = float(min(max(initial, self.min_limit), self.max_limit))
+        self.decrease = decrease
+        self.cooldown = cooldown
+        self.inflight = 0
+        self.paused_until = 0.0
+        self._last_decrease = 0.0
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        """Block until a request slot is free and no Retry-After pause is active."""
+        with self._cond:
+            while True:
+                pause = self.paused_until - time.monotonic()
+                if pause > 0:
+                    self._cond.wait(pause)
+                elif self.inflight >= int(self.limit):
+                    self._cond.wait()
+                else:
+                    self.inflight += 1
+                    return
+
+    def release(self):
+        with self._cond:
+            self.inflight -= 1
+            self._cond.notify()
+
+    def on_success(self):
+        with self._cond:
+            if self.limit < self.max_limit:
+                self.limit = min(self.max_limit, self.limit + 1.0 / self.limit)
+                self._cond.notify()
+
+    def on_overload(self, retry_after: Optional[float] = None):
+        with self._cond:
+            now = time.monotonic()
+            if retry_after:
+                self.paused_until = max(self.paused_until, now + retry_after)
+                logger.warning(f"[{self.name}] provider asked to retry after {retry_after:.1f}s; pausing all calls.")
+            if now - self._last_decrease >= self.cooldown:
+                self._last_decrease = now
+                old = self.limit
+                self.limit = max(self.min_limit, self.limit * self.decrease)
+                METRICS.inc("concurrency_decreases")
+                logger.info(f"[{self.name}] overload: concurrency limit {old:.1f} -> {self.limit:.1f}")
+            self._cond.notify_all()
+
+
+class CircuitBreaker:
+    """
+    closed -> open after `threshold` consecutive failures; open calls fail fast for `reset_timeout`
+    seconds; then half-open lets one probe through, which closes the circuit on success or reopens it.
+    """
+
+    def __init__(self, name: str, threshold: int = 5, reset_timeout: float = 30.0):
+        self.name = name
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def before_call(self):
+        """Raise CircuitOpenError unless a call may go through now."""
+        if self.threshold <= 0:
+            return
+        with self._lock:
+            if self.state == "closed":
+                return
+            if self.state == "open" and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.state = "half_open"
+                self._probing = False
+            if self.state == "half_open" and not self._probing:
+                self._probing = True
+                return
+            raise CircuitOpenError(f"{self.name}: circuit open after {self.failures} consecutive failure(s)")
+
+    def on_success(self):
+        with self._lock:
+            if self.state != "closed":
+                logger.info(f"[{self.name}] circuit closed.")
+            self.state = "closed"
+            self.failures = 0
+            self._probing = False
+
+    def on_failure(self):
+        if self.threshold <= 0:
+            return
+        with self._lock:
+            self.failures += 1
+            if self.state == "half_open" or (self.state == "closed" and self.failures >= self.threshold):
+                self.state = "open"
+                self.opened_at = time.monotonic()
+                self._probing = False
+                METRICS.inc("circuit_opened")
+                logger.error(f"[{self.name}] circuit opened after {self.failures} consecutive failure(s); "
+                             f"failing fast for {self.reset_timeout:.0f}s.")
+
+    def release_probe(self):
+        """End a half-open probe that neither proved nor disproved the provider's health (e.g. a 429)."""
+        with self._lock:
+            self._probing = False
+
+    @property
+    def is_open(self) -> bool:
+        with self._lock:
+            return self.state == "open" and time.monotonic() - self.opened_at < self.reset_timeout
+
+
+_controllers: Dict[str, AIMDController] = {}
+_breakers: Dict[str, CircuitBreaker] = {}
+_lock = threading.Lock()
+
+
+def get_controller(provider: str) -> AIMDController:
+    """Return the process-wide concurrency controller of a provider."""
+    with _lock:
+        if provider not in _controllers:
+            settings = get_settings()
+            _controllers[provider] = AIMDController(provider, initial=settings.llm_concurrency_initial,
+                                                    min_limit=settings.llm_concurrency_min,
+                                                    max_limit=settings.llm_concurrency_max)
+        return _controllers[provider]
+
+
+def get_circuit_breaker(provider: str) -> CircuitBreaker:
+    """Return the process-wide circuit breaker of a provider."""
+    with _lock:
+        if provider not in _breakers:
+            settings = get_settings()
+            _breakers[provider] = CircuitBreaker(provider, threshold=settings.circuit_failure_threshold,
+                                                 reset_timeout=settings.circuit_reset_seconds)
+        return _breakers[provider]
@@ -0,0 +1,91 @@
+"""
+Append-only checkpoint journal of completed batch results and finished files, used to resume interrupted runs.
+"""
+
+import os
+import json
+import logging
+import threading
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+logger = logging.getLogger("pcb-ocr-corrector.journal")
+
+
+class Journal:
+    """
+    One JSON object per line, fsynced after every write:
+      {"t": "run", "fingerprint": ...}        settings the journal is valid for
+      {"t": "batch", "corr": [[key, token]]}  LLM answers of one batch, key = dedup key
+      {"t": "file", "path": ...}              an input file whose output is complete
+    With resume=True an existing journal written with the same fingerprint is replayed and appended to;
+    otherwise a new journal is started.
+    """
+
+    def __init__(self, path: Path, fingerprint: str, resume: bool = False):
+        self.path = Path(path)
+        self.fingerprint = fingerprint
+        self.corrections: Dict[Tuple, str] = {}
+        self.completed_files = set()
+        self._lock = threading.Lock()
+
+        replay = resume and self.path.exists() and self._load()
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._fh = open(self.path, "a" if replay else "w", encoding="utf-8")
+        if replay:
+            logger.info(f"Resuming from {self.path}: {len(self.corrections)} correction(s), "
+                        f"{len(self.completed_files)} finished file(s).")
+        else:
+            self._append({"t": "run", "fingerprint": fingerprint})
+
+    def _load(self) -> bool:
+        with open(self.path, "r", encoding="utf-8") as f:
+            for n, line in enumerate(f):
+                try:
+                    rec = json.loads(line)
+                except ValueError:
+                    # Torn last line of a crashed run
+                    continue
+                if n == 0:
+                    if rec.get("t") != "run" or rec.get("fingerprint") != self.fingerprint:
+                        logger.warning(f"Journal {self.path} was written with other settings; starting over.")
+                        return False
+                elif rec.get("t") == "batch":
+                    for key, token in rec["corr"]:
+                        self.corrections[tuple(key)] = token
+                elif rec.get("t") == "file":
+                    self.completed_files.add(rec["path"])
+        return True
+
+    def _append(self, rec: dict):
+        with self._lock:
+            self._fh.write(json.dumps(rec, ensure_ascii=False) + "\n")
+            self._fh.flush()
+            os.fsync(self._fh.fileno())
+
+    def record_batch(self, batch: List[Dict], corrected: List[Optional[str]]):
+        """
+        Persist the valid answers of one batch before they are used. They are only written: lookup()
+        serves what an earlier run journaled, while answers of this run are shared through the
+        CorrectionMemo, so memory does not grow with every key answered.
+        """
+        corr = [[list(item["key"]), c] for item, c in zip(batch, corrected) if c]
+        if corr:
+            self._append({"t": "batch", "corr": corr})
+
+    def record_file(self, input_path: str):
+        self._append({"t": "file", "path": os.path.abspath(input_path)})
+        with self._lock:
+            self.completed_files.add(os.path.abspath(input_path))
+
+    def lookup(self, key: Tuple) -> Optional[str]:
+        with self._lock:
+            return self.corrections.get(key)
+
+    def is_file_done(self, input_path: str) -> bool:
+        with self._lock:
+            return os.path.abspath(input_path) in self.completed_files
+
+    def close(self):
+        with self._lock:
+            self._fh.close()
@@ -2,71 +2,269 @@
 The client interacting with the LLM API includes retry and exponential backoff logic.
 """
 
+import json
 import time
 import random
 import logging
+import threading
 import requests
-from typing import List, Dict
-from pathlib import Path
-from dotenv import load_dotenv
-load_dotenv(Path(__file__).resolve().parent.parent / ".env")
+from requests.adapters import HTTPAdapter
+from typing import Callable, List, Dict, Optional, Tuple
 
 from config import *
+from rate_limit import get_rate_limiter, estimate_tokens
+from metrics import METRICS
+from utils.parser import is_filler_line
+from budget import Budget
+from flow_control import get_circuit_breaker, get_controller, parse_retry_after
 
 logger = logging.getLogger(__name__)
 
+
+def provider_model(provider: str) -> Optional[str]:
+    """Model that answers for a provider (part of the correction cache key)."""
+    return get_settings().llm_providers.get(provider, {}).get("model")
+
+
 def _exp_backoff_sleep(attempt: int, base: float = 1.0, jitter: float = 0.25) -> float:
     """Calculate the number of seconds for exponential backoff with jitter."""
     delay = base * (2 ** attempt)
     return delay + random.uniform(0, base * jitter)
 
-def call_gpt_chat(messages: List[Dict], model: str = OPENAI_MODEL,
-                  api_key: str = OPENAI_API_KEY, base_url: str = OPENAI_BASE_URL,
-                  timeout: int = 60, max_retries: int = 3) -> str:
-    """Invoke OpenAI-compatible chat completion API using logging and backoff mechanisms."""
-    headers = {"Authorization": f"Bearer {api_key}", "Content-Type": "application/json"}
-    payload = {"model": model, "messages": messages, "temperature": 0.0}
 
-    for attempt in range(max_retries + 1):
-        try:
-            t0 = time.time()
-            resp = requests.post(base_url, headers=headers, json=payload, timeout=timeout)
-            resp.raise_for_status()
+# HTTP statuses worth retrying, and the subset that signals an overloaded provider (concurrency is cut)
+RETRYABLE_STATUSES = {408, 409, 425, 429, 500, 502, 503, 504}
+OVERLOAD_STATUSES = {429, 503}
+
+
+class LLMHTTPError(requests.HTTPError):
+    """Error status returned by the provider, with its Retry-After (seconds) if any."""
+
+    def __init__(self, status: int, body: str, retry_after: Optional[float] = None):
+        super().__init__(f"HTTP {status}: {body}")
+        self.status = status
+        self.retry_after = retry_after
+
+
+class StreamAborted(Exception):
+    """A streamed answer was cut off by the caller; content holds what arrived before the abort."""
+
+    def __init__(self, reason: str, content: str):
+        super().__init__(f"stream aborted: {reason}")
+        self.reason = reason
+        self.content = content
+
+
+def _classify_error(error: Exception) -> Tuple[bool, bool, Optional[float]]:
+    """Return (retryable, overload, retry_after seconds) of a failed call."""
+    if isinstance(error, LLMHTTPError):
+        return error.status in RETRYABLE_STATUSES, error.status in OVERLOAD_STATUSES, error.retry_after
+    if isinstance(error, requests.Timeout):
+        return True, True, None
+    # Connection errors and malformed responses
+    return True, False, None
+
+
+class LLMClient:
+    """
+    OpenAI-compatible chat completion client of one provider.
+    Requests go through a keep-alive connection pool, the provider's concurrency controller,
+    circuit breaker and rate limiter, and exponential backoff; token usage reported by the API is
+    accumulated per client.
+    """
+
+    def __init__(self, name: str, api_key: str, base_url: str, model: str,
+                 pool_size: int = 1, timeout: int = 60, max_retries: int = 3):
+        self.name = name
+        self.base_url = base_url
+        self.model = model
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.limiter = get_rate_limiter(name)
+        self.controller = get_controller(name)
+        self.breaker = get_circuit_breaker(name)
+
+        self.session = requests.Session()
+        self.session.headers.update({"Authorization": f"Bearer {api_key}", "Content-Type": "application/json"})
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(1, pool_size))
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+
+    def _record_usage(self, usage: Optional[Dict], estimated: int, dt: float, budget: Optional[Budget] = None):
+        prompt_tokens = int((usage or {}).get("prompt_tokens") or 0)
+        completion_tokens = int((usage or {}).get("completion_tokens") or 0)
+        if budget is not None:
+            # Without a usage field the estimate is charged, so an unmetered provider cannot overrun the cap
+            budget.charge(tokens=prompt_tokens + completion_tokens if usage else estimated)
+        with self._lock:
+            self.calls += 1
+            self.prompt_tokens += prompt_tokens
+            self.completion_tokens += completion_tokens
+        METRICS.inc("prompt_tokens", prompt_tokens)
+        METRICS.inc("completion_tokens", completion_tokens)
+        if usage is None:
+            logger.debug(f"{self.name} call ok in {dt:.2f}s, tokens unknown (no usage field).")
+            return
+        if self.limiter:
+            self.limiter.settle(estimated, prompt_tokens + completion_tokens)
+        logger.debug(f"{self.name} call ok in {dt:.2f}s, tokens: prompt={prompt_tokens}, completion={completion_tokens}.")
+
+    def _send(self, payload: Dict, estimated: int,
+              on_line: Optional[Callable[[str], bool]] = None, max_lines: Optional[int] = None,
+              budget: Optional[Budget] = None) -> str:
+        """One HTTP attempt; raises LLMHTTPError for error statuses."""
+        if self.limiter:
+            with METRICS.time("rate_limit_wait"):
+                self.limiter.acquire(estimated)
+        t0 = time.time()
+        METRICS.inc("llm_requests")
+        if budget is not None:
+            budget.charge(requests=1)
+        with METRICS.inflight("inflight_requests"), METRICS.time("llm_request"):
+            if on_line is not None:
+                return self._send_streaming(payload, estimated, on_line, max_lines, t0, budget)
+            resp = self.session.post(self.base_url, json=payload, timeout=self.timeout)
+            if resp.status_code >= 400:
+                raise LLMHTTPError(resp.status_code, resp.text[:200],
+                                   parse_retry_after(resp.headers.get("Retry-After")))
             data = resp.json()
-            dt = time.time() - t0
-            logger.debug(f"GPT call ok in {dt:.2f}s, tokens unknown (no usage field).")
-            return data["choices"][0]["message"]["content"]
-        except Exception as e:
-            if attempt == max_retries:
-                logger.error(f"GPT call failed after {attempt} retries: {e}")
-                raise
-            sleep_s = _exp_backoff_sleep(attempt)
-            logger.warning(f"GPT call error (attempt {attempt+1}/{max_retries+1}), backing off {sleep_s:.1f}s: {e}")
-            time.sleep(sleep_s)
-    raise ConnectionError("LLM call failed after all retries.")
+        self._record_usage(data.get("usage"), estimated, time.time() - t0, budget)
+        return data["choices"][0]["message"]["content"]
 
+    def _send_streaming(self, payload: Dict, estimated: int, on_line: Callable[[str], bool],
+                        max_lines: Optional[int], t0: float, budget: Optional[Budget] = None) -> str:
+        """
+        Request a server-sent-events stream and hand every complete line of the answer to on_line as it
+        arrives. The stream is abandoned (StreamAborted) as soon as on_line returns False or the answer
+        grows beyond max_lines lines that are not filler (blank lines and code fences do not count).
+        """
+        payload = dict(payload, stream=True, stream_options={"include_usage": True})
+        parts: List[str] = []
+        pending = ""
+        n_lines = 0
+        usage = None
 
-def call_deepseek_chat(messages: List[Dict], model: str = DEEPSEEK_MODEL,
-                       api_key: str = DEEPSEEK_API_KEY, base_url: str = DEEPSEEK_BASE_URL,
-                       timeout: int = 60, max_retries: int = 3) -> str:
-    """Invoke DeepSeek chat Completion API using the log and backoff mechanisms."""
-    headers = {"Authorization": f"Bearer {api_key}", "Content-Type": "application/json"}
-    payload = {"model": model, "messages": messages, "temperature": 0.0}
+        def _emit(line: str):
+            nonlocal n_lines
+            if not is_filler_line(line):
+                if n_lines == 0:
+                    METRICS.observe("llm_first_line", time.time() - t0)
+                n_lines += 1
+            if max_lines is not None and n_lines > max_lines:
+                raise StreamAborted(f"more than {max_lines} line(s)", "".join(parts))
+            if not on_line(line):
+                raise StreamAborted(f"unexpected line {line.strip()[:40]!r}", "".join(parts))
 
-    for attempt in range(max_retries + 1):
         try:
-            t0 = time.time()
-            resp = requests.post(base_url, headers=headers, json=payload, timeout=timeout)
-            resp.raise_for_status()
-            data = resp.json()
-            dt = time.time() - t0
-            logger.debug(f"DeepSeek call ok in {dt:.2f}s.")
-            return data["choices"][0]["message"]["content"]
-        except Exception as e:
-            if attempt == max_retries:
-                logger.error(f"DeepSeek call failed after {attempt} retries: {e}")
-                raise
-            sleep_s = _exp_backoff_sleep(attempt)
-            logger.warning(f"DeepSeek call error (attempt {attempt+1}/{max_retries+1}), backing off {sleep_s:.1f}s: {e}")
+            with self.session.post(self.base_url, json=payload, timeout=self.timeout, stream=True) as resp:
+                if resp.status_code >= 400:
+                    raise LLMHTTPError(resp.status_code, resp.text[:200],
+                                       parse_retry_after(resp.headers.get("Retry-After")))
+                for raw in resp.iter_lines():
+                    # Lines are complete here, so decoding each one cannot split a multi-byte character
+                    event = raw.decode("utf-8").strip()
+                    if not event.startswith("data:"):
+                        continue
+                    data = event[5:].strip()
+                    if data == "[DONE]":
+                        break
+                    chunk = json.loads(data)
+                    usage = chunk.get("usage") or usage
+                    for choice in chunk.get("choices") or ():
+                        delta = (choice.get("delta") or {}).get("content") or ""
+                        parts.append(delta)
+                        pending += delta
+                        while "\n" in pending:
+                            line, pending = pending.split("\n", 1)
+                            _emit(line)
+                if pending:
+                    _emit(pending)
+        except StreamAborted:
+            METRICS.inc("stream_aborts")
+            self._record_usage(None, estimated, time.time() - t0, budget)
+            raise
+        self._record_usage(usage, estimated, time.time() - t0, budget)
+        return "".join(parts)
+
+    def chat(self, messages: List[Dict], on_line: Optional[Callable[[str], bool]] = None,
+             max_lines: Optional[int] = None, budget: Optional[Budget] = None) -> str:
+        """
+        Invoke the chat completion API. Calls share the provider's concurrency controller and circuit
+        breaker; retryable errors back off (at least as long as Retry-After), others fail at once.
+        With on_line the answer is streamed and passed on line by line (see _send_streaming); an aborted
+        stream raises StreamAborted without retrying, so the caller decides what to re-ask.
+        Every attempt is charged to budget, if given.
+        """
+        payload = {"model": self.model, "messages": messages, "temperature": 0.0}
+        estimated = estimate_tokens(messages)
+
+        for attempt in range(self.max_retries + 1):
+            self.breaker.before_call()
+            self.controller.acquire()
+            error = None
+            try:
+                content = self._send(payload, estimated, on_line, max_lines, budget)
+            except Exception as e:
+                error = e
+            finally:
+                self.controller.release()
+
+            if error is None or isinstance(error, StreamAborted):
+                # An aborted stream is a bad answer, not a sign of an unhealthy provider
+                self.controller.on_success()
+                self.breaker.on_success()
+                if error is not None:
+                    raise error
+                return content
+
+            METRICS.inc("llm_errors")
+            retryable, overload, retry_after = _classify_error(error)
+            if overload:
+                self.controller.on_overload(retry_after)
+            if not retryable:
+                # The provider answered, it just rejected this request: no point retrying it
+                self.breaker.on_success()
+                logger.error(f"{self.name} call failed with a non-retryable error: {error}")
+                raise error
+            if isinstance(error, LLMHTTPError) and error.status == 429:
+                self.breaker.release_probe()
+            else:
+                self.breaker.on_failure()
+            if attempt == self.max_retries:
+                logger.error(f"{self.name} call failed after {attempt} retries: {error}")
+                raise error
+            sleep_s = max(_exp_backoff_sleep(attempt), retry_after or 0.0)
+            logger.warning(f"{self.name} call error (attempt {attempt+1}/{self.max_retries+1}), "
+                           f"backing off {sleep_s:.1f}s: {error}")
             time.sleep(sleep_s)
-    raise ConnectionError("LLM call failed after all retries.")
+        raise ConnectionError("LLM call failed after all retries.")
+
+    def usage(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "calls": self.calls,
+                "prompt_tokens": self.prompt_tokens,
+                "completion_tokens": self.completion_tokens,
+            }
+
+
+_clients: Dict[str, LLMClient] = {}
+_clients_lock = threading.Lock()
+
+
+def get_client(provider: str) -> LLMClient:
+    """Return the process-wide client of a provider configured in LLM_PROVIDERS."""
+    with _clients_lock:
+        if provider not in _clients:
+            settings = get_settings()
+            if provider not in settings.llm_providers:
+                raise ValueError(f"provider must be one of {sorted(settings.llm_providers)}, got {provider!r}")
+            conf = settings.llm_providers[provider]
+            _clients[provider] = LLMClient(provider, conf["api_key"], conf["base_url"],
+                                           conf["model"], pool_size=settings.llm_pool_size)
+        return _clients[provider]
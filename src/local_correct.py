@@ -0,0 +1,167 @@
+"""
+Local, deterministic pre-correction of OCR tokens using the rules of the system prompt,
+a lexicon built from the reference GT file and pin/refdes patterns.
+Tokens it cannot resolve unambiguously are left to the LLM.
+"""
+
+import re
+import logging
+import threading
+from collections import Counter, defaultdict
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from config import *
+
+logger = logging.getLogger("pcb-ocr-corrector.local_correct")
+
+# Allowed swaps of the system prompt: O<->0, I/l<->1, S<->5, B<->8, Z<->2, g/q<->9
+CONFUSION_CLASSES = ("O0", "Il1", "S5", "B8", "Z2", "gq9")
+# Case-insensitive like the validator: 'o', 's', 'b', 'z', 'G' are read as O, S, B, Z, g
+_CLASS_OF = {ch: cls for cls in CONFUSION_CLASSES for ch in cls}
+for _cls in CONFUSION_CLASSES:
+    for _ch in _cls:
+        _CLASS_OF.setdefault(_ch.upper(), _cls)
+        _CLASS_OF.setdefault(_ch.lower(), _cls)
+_TO_DIGIT = str.maketrans({ch: cls[-1] for cls in CONFUSION_CLASSES for ch in cls})
+_DIGITISH = "0-9OIlSBZgq"
+
+# Cost of substituting two characters of the same confusion class (any other edit costs 1)
+CONFUSABLE_SUB_COST = 0.25
+
+# Minimal edits allowed when CONF >= 0.92 (see "Confidence rule")
+HIGH_CONF = 0.92
+HIGH_CONF_MAX_SUBS = 2
+
+_GPIO_RE = re.compile(rf"^GP[1Il][O0]([{_DIGITISH}]{{1,2}})$")
+_PA_AMBIGUOUS_RE = re.compile(r"^PA[ABC]$")
+_PIN_RE = re.compile(rf"^P([A-I])([{_DIGITISH}]{{1,2}})$")
+_REFDES_RE = re.compile(rf"^([A-Z]{{1,3}})([0-9][{_DIGITISH}]*)$")
+
+_AMBIGUOUS = object()
+
+
+def confusion_fold(token: str) -> str:
+    """Map every confusable character to its class digit; tokens differing only by allowed swaps fold equal."""
+    return token.translate(_TO_DIGIT)
+
+
+def confusion_distance(a: str, b: str) -> float:
+    """Levenshtein distance where substitutions inside one confusion class cost CONFUSABLE_SUB_COST."""
+    prev = [float(j) for j in range(len(b) + 1)]
+    for i, ca in enumerate(a, start=1):
+        cur = [float(i)] + [0.0] * len(b)
+        for j, cb in enumerate(b, start=1):
+            if ca == cb:
+                sub = 0.0
+            elif _CLASS_OF.get(ca) is not None and _CLASS_OF.get(ca) == _CLASS_OF.get(cb):
+                sub = CONFUSABLE_SUB_COST
+            else:
+                sub = 1.0
+            cur[j] = min(prev[j] + 1.0, cur[j - 1] + 1.0, prev[j - 1] + sub)
+        prev = cur
+    return prev[-1]
+
+
+def _n_subs(a: str, b: str) -> int:
+    """Number of differing positions of two equal-length tokens."""
+    return sum(1 for x, y in zip(a, b) if x != y)
+
+
+def _normalize_spaces(token: str) -> str:
+    """Replace internal spaces with underscores (hard constraint of the system prompt)."""
+    return "_".join(token.split())
+
+
+class LocalCorrector:
+    """
+    Resolve a token without the LLM when the rules give a single answer.
+    resolve() returns the corrected token, or None when the token is ambiguous.
+    """
+
+    def __init__(self, lexicon: Iterable[str]):
+        self.lexicon = set(lexicon)
+        self._by_fold: Dict[str, List[str]] = defaultdict(list)
+        for tok in sorted(self.lexicon):
+            self._by_fold[confusion_fold(tok)].append(tok)
+        self.stats: Counter = Counter()
+        self._lock = threading.Lock()
+
+    def _pattern_rule(self, tok: str):
+        """Pin/refdes patterns: returns a token, _AMBIGUOUS, or None if no pattern applies."""
+        if _PA_AMBIGUOUS_RE.match(tok):
+            # 'PAB' / 'PAC' / 'PAA' is PA6 or PA8 depending on context
+            return _AMBIGUOUS
+        m = _GPIO_RE.match(tok)
+        if m:
+            return "GPIO" + m.group(1).translate(_TO_DIGIT)
+        m = _PIN_RE.match(tok)
+        if m and any(ch.isdigit() for ch in m.group(2)):
+            return "P" + m.group(1) + m.group(2).translate(_TO_DIGIT)
+        m = _REFDES_RE.match(tok)
+        if m:
+            prefix, body = m.groups()
+            # The letters may be misread digits (S12302 vs 512302), a trailing I/S/B/Z may be a
+            # suffix (R17B) or a misread digit, and a confusable right after the letters may
+            # belong to them (TP554331 vs TPS54331, A034O1 vs AO3401): only the LLM can tell.
+            if any(ch in _CLASS_OF for ch in prefix):
+                return _AMBIGUOUS
+            if len(body) > 1 and body[-1] in "ISBZ":
+                return _AMBIGUOUS
+            if len(prefix) < 3 and body[0] in _CLASS_OF:
+                return _AMBIGUOUS
+            return prefix + body.translate(_TO_DIGIT)
+        return None
+
+    def _lexicon_rule(self, tok: str):
+        """Closest lexicon entry reachable by allowed swaps only; _AMBIGUOUS on ties."""
+        candidates = self._by_fold.get(confusion_fold(tok))
+        if not candidates:
+            return None
+        scored = sorted((confusion_distance(tok, c), c) for c in candidates)
+        if len(scored) > 1 and scored[0][0] == scored[1][0]:
+            return _AMBIGUOUS
+        return scored[0][1]
+
+    def _resolve(self, pred: str, conf: float) -> Tuple[Optional[str], str]:
+        if len(pred) <= 2:
+            return pred, "short"
+        tok = _normalize_spaces(pred)
+        if tok in self.lexicon:
+            return tok, "lexicon"
+
+        # A known token reachable by allowed swaps beats the generic patterns (NCD08O5B2 -> NCD0805B2)
+        for rule, fn in (("lexicon_swap", self._lexicon_rule), ("pattern", self._pattern_rule)):
+            fixed = fn(tok)
+            if fixed is _AMBIGUOUS:
+                return None, "ambiguous"
+            if fixed is not None:
+                if conf >= HIGH_CONF and _n_subs(tok, fixed) > HIGH_CONF_MAX_SUBS:
+                    return None, "too_many_edits"
+                return fixed, rule
+
+        if not any(ch in _CLASS_OF for ch in tok):
+            # Nothing the LLM is allowed to swap; only the space rule could apply
+            return tok, "no_confusables"
+        return None, "ambiguous"
+
+    def resolve(self, pred: str, conf: float) -> Optional[str]:
+        fixed, reason = self._resolve(pred, conf)
+        with self._lock:
+            self.stats[reason] += 1
+        return fixed
+
+
+_corrector: Optional[LocalCorrector] = None
+_corrector_lock = threading.Lock()
+
+
+def get_local_corrector() -> Optional[LocalCorrector]:
+    """Return the process-wide local corrector (None if LOCAL_CORRECTION is disabled)."""
+    global _corrector
+    if not get_settings().local_correction:
+        return None
+    with _corrector_lock:
+        if _corrector is None:
+            _corrector = LocalCorrector(get_settings().reference_corpus)
+            logger.info(f"Local corrector lexicon: {len(_corrector.lexicon)} token(s).")
+        return _corrector
@@ -3,14 +3,15 @@
 import logging
 import sys
 from pathlib import Path
-from dotenv import load_dotenv
-load_dotenv(Path(__file__).resolve().parent.parent / ".env")
 
 from config import *
-from pipeline import process_file, process_folder
+from pipeline import process_file, process_folder, process_folder_sharded
+from budget import new_budget
+from prompting import static_prefix_tokens
+from metrics import METRICS
 from utils.logging_setup import *
 
-def run(input_path: Path, output_path: Path, **process_kwargs) -> int:
+def run(input_path: Path, output_path: Path, max_concurrent_files: int = 1, **process_kwargs) -> int:
     logger = logging.getLogger(LOGGER_NAME)
     
     if not input_path.exists():
@@ -22,12 +23,22 @@ def run(input_path: Path, output_path: Path, **process_kwargs) -> int:
             # logger.error("--output must be a DIRECTORY when --input is a DIRECTORY. Got file: %s", output_path)
             return 2
         output_path.mkdir(parents=True, exist_ok=True)
-        process_folder(input_dir=str(input_path), output_dir=str(output_path), **process_kwargs)
+        settings = get_settings()
+        if settings.sharded:
+            process_folder_sharded(input_dir=str(input_path), output_dir=str(output_path),
+                                   worker_id=settings.shard_worker_id, lease_seconds=settings.shard_lease_seconds,
+                                   poll_seconds=settings.shard_poll_seconds, max_concurrent_files=max_concurrent_files,
+                                   **process_kwargs)
+            return 0
+        process_folder(input_dir=str(input_path), output_dir=str(output_path),
+                       max_concurrent_files=max_concurrent_files, incremental=settings.incremental, **process_kwargs)
         # logger.info("All done. Outputs are under: %s", output_path)
         return 0
 
     if input_path.is_file():
-        process_file(input_path=str(input_path), output_path=str(output_path), **process_kwargs)
+        # A single-file run is the whole run, so a "run" budget applies to it too
+        process_file(input_path=str(input_path), output_path=str(output_path),
+                     budget=new_budget("run"), **process_kwargs)
         logger.info("All done. Output wrote to: %s", output_path)
         return 0
 
@@ -36,21 +47,34 @@ def run(input_path: Path, output_path: Path, **process_kwargs) -> int:
 
 
 def main() -> None:
-    setup_logging_original_fix(verbosity=VERBOSITY, log_file=LOG_FILE)
+    settings = get_settings()
+    setup_logging_original_fix(verbosity=settings.verbosity, log_file=settings.log_file)
     logger = logging.getLogger(LOGGER_NAME)
+    if settings.input_path is None or settings.output_path is None:
+        logger.error("INPUT_PATH and OUTPUT_PATH must be set (environment or .env)")
+        sys.exit(2)
 
-    n_inputs = len(list(Path(INPUT_PATH).rglob("*.txt")))
-    print(f"[pcbtagent] INPUT_PATH={INPUT_PATH} | files={n_inputs}")
-    print(f"[pcbtagent] OUTPUT_PATH={OUTPUT_PATH}")
+    n_inputs = len(list(Path(settings.input_path).rglob("*.txt")))
+    print(f"[pcbtagent] INPUT_PATH={settings.input_path} | files={n_inputs}")
+    print(f"[pcbtagent] OUTPUT_PATH={settings.output_path}")
+    print(f"[pcbtagent] static prompt prefix: ~{static_prefix_tokens()} tokens per request")
     
     try:
         process_kwargs = {
-            "provider": PROVIDER,
-            "batch_size": BATCH_SIZE,
-            "threshold": CONFIDENCE_THRESHOLD,
-            "include_gt_in_prompt": INCLUDE_GT_IN_PROMPT,
+            "provider": settings.provider,
+            "batch_size": settings.batch_size,
+            "threshold": settings.confidence_threshold,
+            "include_gt_in_prompt": settings.include_gt_in_prompt,
+            "max_inflight_batches": settings.max_inflight_batches,
+            "streaming": settings.streaming,
+            "resume": settings.resume,
         }
-        code = run(INPUT_PATH, OUTPUT_PATH, **process_kwargs)
+        try:
+            code = run(settings.input_path, settings.output_path, max_concurrent_files=settings.max_concurrent_files,
+                       **process_kwargs)
+        finally:
+            METRICS.log_summary()
+            METRICS.export(settings.metrics_json_path, settings.metrics_prometheus_path)
         sys.exit(code)
     except Exception:
         logger = logging.getLogger("pcb-ocr-corrector.main")
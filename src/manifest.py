@@ -0,0 +1,101 @@
+"""
+Manifest of a folder run: which input (by content hash) produced which output under which settings,
+so that unchanged files can be skipped by the next run.
+"""
+
+import os
+import json
+import hashlib
+import logging
+import threading
+from pathlib import Path
+from typing import Dict, List
+
+logger = logging.getLogger("pcb-ocr-corrector.manifest")
+
+_HASH_CHUNK = 1 << 20
+
+
+def file_sha256(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(_HASH_CHUNK), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _stat_sig(path: str) -> List[int]:
+    st = os.stat(path)
+    return [st.st_size, st.st_mtime_ns]
+
+
+class Manifest:
+    """
+    JSON file mapping the relative path of every processed input to:
+      input_sha256 / input_stat   content hash of the input (re-hashed only when size/mtime changed)
+      settings                    fingerprint of the settings the output was produced with
+      output_stat                 size/mtime of the output when it was written
+    An output is still valid if the input hash, the settings and the output stat all match.
+    """
+
+    def __init__(self, path: Path, settings: str):
+        self.path = Path(path)
+        self.settings = settings
+        self.entries: Dict[str, dict] = {}
+        self._lock = threading.Lock()
+        if self.path.exists():
+            try:
+                with open(self.path, "r", encoding="utf-8") as f:
+                    self.entries = json.load(f).get("files", {})
+            except (OSError, ValueError) as e:
+                logger.warning(f"Ignoring unreadable manifest {self.path}: {e}")
+
+    def input_signature(self, rel: str, input_path: str) -> dict:
+        """
+        Content hash and stat of an input, taken before it is processed. The recorded hash is reused
+        while size and mtime are unchanged, so unchanged files are not re-read.
+        """
+        stat = _stat_sig(input_path)
+        entry = self.entries.get(rel)
+        if entry and entry.get("input_stat") == stat:
+            return {"input_sha256": entry["input_sha256"], "input_stat": stat}
+        return {"input_sha256": file_sha256(input_path), "input_stat": stat}
+
+    def is_up_to_date(self, rel: str, signature: dict, output_path: str) -> bool:
+        entry = self.entries.get(rel)
+        if not entry or entry.get("settings") != self.settings or not os.path.exists(output_path):
+            return False
+        return (entry.get("input_sha256") == signature["input_sha256"]
+                and entry.get("output_stat") == _stat_sig(output_path))
+
+    def record(self, rel: str, signature: dict, output_path: str):
+        """Record a finished file and save the manifest."""
+        entry = dict(signature, settings=self.settings, output_stat=_stat_sig(output_path))
+        with self._lock:
+            self.entries[rel] = entry
+            self._save()
+
+    def orphans(self, output_dir: str, current: List[str]) -> List[str]:
+        """Relative paths of .txt outputs whose input no longer exists."""
+        current = set(current)
+        found = []
+        for root, _, files in os.walk(output_dir):
+            for f in files:
+                if f.lower().endswith(".txt"):
+                    rel = os.path.relpath(os.path.join(root, f), start=output_dir)
+                    if rel not in current:
+                        found.append(rel)
+        return sorted(found)
+
+    def forget(self, rels: List[str]):
+        with self._lock:
+            for rel in rels:
+                self.entries.pop(rel, None)
+            self._save()
+
+    def _save(self):
+        # Write to a temporary file and rename, so a crash never leaves a torn manifest
+        tmp = self.path.with_name(self.path.name + ".tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"files": self.entries}, f, ensure_ascii=False, indent=1, sort_keys=True)
+        os.replace(tmp, self.path)
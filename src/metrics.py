@@ -0,0 +1,168 @@
+"""
+Process-wide run metrics: per-stage timing histograms, counters and in-flight gauges,
+exported as a JSON summary and in the Prometheus text exposition format.
+"""
+
+import json
+import time
+import bisect
+import logging
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, Optional, Tuple
+
+logger = logging.getLogger("pcb-ocr-corrector.metrics")
+
+# Upper bounds (seconds) of the timing histogram buckets; covers sub-ms parsing up to multi-minute files
+TIME_BUCKETS: Tuple[float, ...] = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+                                   30.0, 60.0, 120.0, 300.0, 600.0)
+
+METRIC_PREFIX = "pcbtagent"
+
+
+class Histogram:
+    """Cumulative-bucket histogram (Prometheus semantics) with count, sum and max."""
+
+    def __init__(self, buckets: Tuple[float, ...] = TIME_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)    # last slot: +Inf
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q: float) -> float:
+        """Estimate a quantile by linear interpolation inside its bucket."""
+        if self.count == 0:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            if n and seen + n >= rank:
+                lo = self.buckets[i - 1] if i > 0 else 0.0
+                hi = self.buckets[i] if i < len(self.buckets) else self.max
+                return min(self.max, lo + (hi - lo) * (rank - seen) / n)
+            seen += n
+        return self.max
+
+    def summary(self) -> dict:
+        return {
+            "count": self.count,
+            "sum_s": round(self.sum, 4),
+            "mean_s": round(self.sum / self.count, 4) if self.count else 0.0,
+            "p50_s": round(self.quantile(0.50), 4),
+            "p95_s": round(self.quantile(0.95), 4),
+            "max_s": round(self.max, 4),
+        }
+
+
+class Metrics:
+    """
+    Thread-safe registry. Names are free-form snake_case; stage timings go to histograms,
+    event totals to counters and concurrently running operations to gauges (current and peak).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.started = time.time()
+        self.histograms: Dict[str, Histogram] = {}
+        self.counters: Dict[str, float] = {}
+        self.gauges: Dict[str, int] = {}
+        self.gauge_peaks: Dict[str, int] = {}
+
+    def observe(self, name: str, seconds: float):
+        with self._lock:
+            hist = self.histograms.get(name)
+            if hist is None:
+                hist = self.histograms[name] = Histogram()
+            hist.observe(seconds)
+
+    def inc(self, name: str, amount: float = 1):
+        # Zero increments still register the counter, so it is exported as 0 rather than missing
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def _add_gauge(self, name: str, delta: int):
+        with self._lock:
+            value = self.gauges.get(name, 0) + delta
+            self.gauges[name] = value
+            self.gauge_peaks[name] = max(self.gauge_peaks.get(name, 0), value)
+
+    @contextmanager
+    def time(self, name: str):
+        """Record the duration of the block in the histogram `name`."""
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - t0)
+
+    @contextmanager
+    def inflight(self, name: str):
+        """Count the block as running in the gauge `name` while it executes."""
+        self._add_gauge(name, 1)
+        try:
+            yield
+        finally:
+            self._add_gauge(name, -1)
+
+    def summary(self) -> dict:
+        with self._lock:
+            return {
+                "wall_s": round(time.time() - self.started, 3),
+                "stages": {name: h.summary() for name, h in sorted(self.histograms.items())},
+                "counters": dict(sorted(self.counters.items())),
+                "inflight_peak": dict(sorted(self.gauge_peaks.items())),
+            }
+
+    def to_prometheus(self) -> str:
+        """Render all metrics in the Prometheus text exposition format."""
+        lines = []
+        with self._lock:
+            name = f"{METRIC_PREFIX}_stage_seconds"
+            lines += [f"# HELP {name} Time spent per pipeline stage.", f"# TYPE {name} histogram"]
+            for stage, h in sorted(self.histograms.items()):
+                cumulative = 0
+                for bound, n in zip(h.buckets + (float("inf"),), h.counts):
+                    cumulative += n
+                    le = "+Inf" if bound == float("inf") else f"{bound:g}"
+                    lines.append(f'{name}_bucket{{stage="{stage}",le="{le}"}} {cumulative}')
+                lines.append(f'{name}_sum{{stage="{stage}"}} {h.sum:.6f}')
+                lines.append(f'{name}_count{{stage="{stage}"}} {h.count}')
+            for counter, value in sorted(self.counters.items()):
+                name = f"{METRIC_PREFIX}_{counter}_total"
+                lines += [f"# TYPE {name} counter", f"{name} {value:g}"]
+            for gauge, value in sorted(self.gauges.items()):
+                name = f"{METRIC_PREFIX}_{gauge}"
+                lines += [f"# TYPE {name} gauge", f"{name} {value}",
+                          f"# TYPE {name}_peak gauge", f"{name}_peak {self.gauge_peaks.get(gauge, 0)}"]
+        return "\n".join(lines) + "\n"
+
+    def log_summary(self):
+        stages = self.summary()["stages"]
+        if not stages:
+            return
+        parts = [f"{name} {s['sum_s']:.1f}s/{s['count']} (p95 {s['p95_s']:.2f}s)" for name, s in stages.items()]
+        logger.info("Stage timings: " + ", ".join(parts))
+
+    def export(self, json_path: Optional[Path] = None, prometheus_path: Optional[Path] = None):
+        """Write the JSON summary and/or the Prometheus text file (atomically, for textfile collectors)."""
+        for path, text in ((json_path, lambda: json.dumps(self.summary(), indent=2) + "\n"),
+                           (prometheus_path, self.to_prometheus)):
+            if path:
+                path = Path(path)
+                path.parent.mkdir(parents=True, exist_ok=True)
+                tmp = path.with_name(path.name + ".tmp")
+                tmp.write_text(text(), encoding="utf-8")
+                tmp.replace(path)
+                logger.info(f"Wrote metrics: {path}")
+
+
+# Shared by every module of the run
+METRICS = Metrics()
@@ -4,178 +4,1375 @@ The core processing flow includes the logic for handling individual files and en
 
 import os
 import time
-import math
+import uuid
+import socket
+import hashlib
 import logging
-from typing import List, Dict, Optional
+import itertools
+import threading
+from collections import Counter, OrderedDict, deque
+from dataclasses import fields
+from queue import Empty, SimpleQueue
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
+from pathlib import Path
+from typing import Callable, Iterable, List, Dict, Optional, Tuple
 from tqdm import tqdm
 
 from utils.parser import *
-from llm_clients import call_gpt_chat, call_deepseek_chat
-from prompting import build_prompt
+from llm_clients import StreamAborted, get_client, provider_model
+from config import *
+from prompting import build_prompt, estimate_item_tokens, prompt_fingerprint, static_prefix_tokens
+from cache import CorrectionCache, get_correction_cache, make_cache_key
+from dedup import CorrectionMemo, dedup_key, group_items
+from local_correct import get_local_corrector
+from validation import RULE_HINTS, check_correction
+from recording import get_recorder
+from journal import Journal
+from manifest import Manifest, file_sha256
+from budget import Budget, new_budget
+from metrics import METRICS
+from routing import get_router
+from sharding import SHARD_DIR_NAME, LeaseDir, default_worker_id
 
 logger = logging.getLogger("pcb-ocr-corrector.pipeline")
 
 BATCH_RETRY_ATTEMPTS = 3
 
-def correct_batch(items: List[Dict], provider: str, include_gt: bool) -> List[Optional[str]]:
+# Checkpoint journal of a folder run, kept in the output directory
+JOURNAL_NAME = ".pcbtagent_journal.jsonl"
+# Manifest of an incremental folder run, kept in the output directory
+MANIFEST_NAME = ".pcbtagent_manifest.json"
+# Seconds between output flushes while streamed answers arrive in the streaming file mode
+STREAM_FLUSH_INTERVAL = 0.05
+# Resolved keys remembered in the streaming file mode (memo and repeat lookups), least recently used dropped
+STREAM_RESOLVED_KEYS = 10_000
+
+def _has_answer(raw: str) -> bool:
+    return bool(raw and raw.strip())
+
+
+def _validate_answers(asked: List[Dict], answered: Dict[int, str], settings: Settings) -> List[int]:
+    """
+    Drop answers that break a hard constraint of the system prompt from `answered` and return their
+    IDs. The rejected answer is kept on the item ("rejected"), so its re-ask shows the model what not
+    to repeat and the dispatcher falls it back to the OCR token instead of splitting it further.
+    """
+    if not settings.output_validation:
+        return []
+    rejected = []
+    for item_id, token in list(answered.items()):
+        item = asked[item_id - 1]
+        rule = check_correction(item["pred"], item["conf"], token)
+        if rule is not None:
+            del answered[item_id]
+            item["rejected"] = f"{token} ({RULE_HINTS[rule]})"
+            rejected.append(item_id)
+            METRICS.inc("validation_rejects")
+            METRICS.inc(f"validation_rejects_{rule}")
+            logger.debug(f"Rejected {item['pred']!r} -> {token!r}: breaks the {rule} rule")
+    return rejected
+
+
+def _ask_streaming(provider: str, messages: List[Dict], asked: List[Dict], settings: Settings,
+                   on_item: Optional[Callable[[Dict, str], None]] = None,
+                   budget: Optional[Budget] = None) -> Tuple[Dict[int, str], List[int]]:
+    """
+    Stream the answer to a prompt for `asked` and parse it line by line, reporting every answered item
+    through on_item as it arrives. The stream is aborted on the first chatter or out-of-range line, or
+    once it has more lines than items; the answers received until then are kept, also when the request
+    fails midway after some of them.
+    Returns (valid answers by ID, IDs whose answer failed validation).
+    """
+    expected_n = len(asked)
+    found: Dict[int, str] = {}
+    rejected: List[int] = []
+    lock = threading.Lock()
+    # Set once the answer is returned: a losing hedged stream may still deliver lines afterwards
+    closed = False
+    recorder = get_recorder()
+
+    def _on_line(line: str) -> bool:
+        if is_filler_line(line):
+            return not closed
+        parsed = parse_indexed_line(line)
+        if parsed is None or not (1 <= parsed[0] <= expected_n) or not parsed[1]:
+            return False
+        item_id, token = parsed
+        with lock:
+            if closed:
+                return False
+            # A hedged duplicate stream may answer the same ID again: the first answer wins
+            if item_id in found or item_id in rejected:
+                return True
+            if recorder:
+                recorder.record(provider, asked, {item_id: token})
+            if _validate_answers(asked, {item_id: token}, settings):
+                rejected.append(item_id)
+                return True
+            found[item_id] = token
+            # Reported under the lock, so nothing is reported once the answer has been returned
+            if on_item is not None:
+                on_item(asked[item_id - 1], token)
+        return True
+
+    try:
+        get_router(provider).chat(messages, validate=_has_answer, on_line=_on_line, max_lines=expected_n,
+                                  budget=budget)
+    except StreamAborted as e:
+        logger.info(f"Stopped a bad answer early ({e.reason}); kept {len(found)}/{expected_n} item(s).")
+    except Exception as e:
+        with lock:
+            if not found:
+                closed = True
+                raise
+        # Answers already reported through on_item stay valid
+        logger.warning(f"Stream failed ({e}); kept {len(found)}/{expected_n} item(s).")
+    with lock:
+        closed = True
+        return dict(found), list(rejected)
+
+
+def correct_batch(items: List[Dict], provider: str, include_gt: bool,
+                  on_item: Optional[Callable[[Dict, str], None]] = None,
+                  budget: Optional[Budget] = None, settings: Optional[Settings] = None) -> List[Optional[str]]:
     """
     Correct the data of a batch.
-    If the number of lines returned by the LLM is incorrect, it will automatically retry up to BATCH_RETRY_ATTEMPTS.
+    Every correctly keyed answer is kept; only the missing or malformed items, and those whose answer
+    breaks a hard constraint of the prompt (see validation.check_correction), are re-asked as a
+    smaller follow-up batch, up to BATCH_RETRY_ATTEMPTS requests in total. A re-asked item carries its
+    rejected answer. Items still unanswered after that are returned as None; so are the remaining
+    items when a re-ask fails, while the answers of the earlier attempts are kept.
+    With LLM_STREAM the answer is parsed while it streams in, and on_item(item, corrected) is called
+    for every item as soon as its line arrives.
+    With LLM_RECORD_PATH every parsed answer is recorded before validation (see recording.py).
+    Requests are charged to budget, if given; no re-ask is sent once it is exhausted.
+    LLM_STREAM and OUTPUT_VALIDATION come from settings (default: get_settings()).
     """
-    messages = build_prompt(items, include_gt)
+    settings = settings or get_settings()
     expected_n = len(items)
+    results: List[Optional[str]] = [None] * expected_n
+    remaining = list(range(expected_n))
+    recorder = get_recorder()
 
     for attempt in range(BATCH_RETRY_ATTEMPTS):
         if attempt > 0:
-            logger.info(f"Retrying batch... (Attempt {attempt + 1}/{BATCH_RETRY_ATTEMPTS})")
+            if budget is not None and budget.exhausted:
+                logger.warning(f"Budget exhausted; not re-asking {len(remaining)}/{expected_n} item(s) of the batch.")
+                return results
+            METRICS.inc("batch_reasks")
+            logger.info(f"Re-asking {len(remaining)}/{expected_n} item(s) of the batch... "
+                        f"(Attempt {attempt + 1}/{BATCH_RETRY_ATTEMPTS})")
 
-        if provider == "gpt":
-            raw_output = call_gpt_chat(messages)
-        elif provider == "deepseek":
-            raw_output = call_deepseek_chat(messages)
-        else:
-            raise ValueError("provider must be 'gpt' or 'deepseek'")
+        asked = [items[i] for i in remaining]
+        try:
+            with METRICS.time("build_prompt"):
+                messages = build_prompt(asked, include_gt)
+            if settings.llm_stream:
+                answered, rejected = _ask_streaming(provider, messages, asked, settings, on_item, budget)
+                if len(answered) + len(rejected) != len(asked):
+                    n_missing = len(asked) - len(answered) - len(rejected)
+                    logger.warning(f"LLM answered {len(answered) + len(rejected)}/{len(asked)} items with a valid ID. "
+                                   f"The {n_missing} missing/malformed item(s) will be re-asked.")
+            else:
+                raw_output = get_router(provider).chat(messages, validate=_has_answer, budget=budget)
+                with METRICS.time("parse_response"):
+                    answered = parse_indexed_llm_block(raw_output, expected_n=len(remaining))
+                if recorder:
+                    recorder.record(provider, asked, answered)
+                rejected = _validate_answers(asked, answered, settings)
+        except Exception as e:
+            if attempt == 0:
+                raise
+            # Keep what the earlier attempts answered; the caller only re-sends the None entries
+            logger.warning(f"Re-ask of {len(remaining)}/{expected_n} item(s) failed: {e}. "
+                           f"Keeping the {expected_n - len(remaining)} answer(s) already received.")
+            return results
+        if rejected:
+            logger.info(f"{len(rejected)} answer(s) broke a hard constraint of the prompt.")
 
-        corrected_list = postprocess_llm_block(raw_output, expected_n=expected_n)
+        for item_id, token in answered.items():
+            results[remaining[item_id - 1]] = token
+        remaining = [i for pos, i in enumerate(remaining, start=1) if pos not in answered]
 
-        if corrected_list is not None:
-            return corrected_list
+        if not remaining:
+            return results
         
-        # Failure: corrected_list is None, and the loop will continue with the next retry
         # Before retrying, briefly sleep to avoid making requests too frequently
         if attempt < BATCH_RETRY_ATTEMPTS - 1:
             time.sleep(1)
 
     # If all retries fail
     logger.error(
-        f"Failed to get a valid response for a batch after {BATCH_RETRY_ATTEMPTS} attempts. "
-        "Falling back to original OCR values for this entire batch."
+        f"No valid answer for {len(remaining)}/{expected_n} item(s) of a batch after {BATCH_RETRY_ATTEMPTS} attempts. "
+        "Falling back to original OCR values for these items."
     )
-    # Return a None list to allow the upstream to handle the rollback logic
-    return [None] * expected_n
+    # None entries let the upstream handle the rollback logic
+    return results
+
+
+def _timed_correct_batch(batch: List[Dict], provider: str, include_gt: bool,
+                         on_item: Optional[Callable[[Dict, str], None]] = None,
+                         budget: Optional[Budget] = None,
+                         settings: Optional[Settings] = None) -> Tuple[List[Optional[str]], float]:
+    """Run correct_batch and return its result together with the elapsed seconds."""
+    t0 = time.time()
+    with METRICS.inflight("inflight_batches"):
+        corrected = correct_batch(batch, provider=provider, include_gt=include_gt, on_item=on_item, budget=budget,
+                                  settings=settings)
+    dt = time.time() - t0
+    METRICS.observe("correct_batch", dt)
+    return corrected, dt
+
+
+class AdaptiveBatcher:
+    """
+    Cut batches by estimated prompt tokens instead of item count.
+    The per-batch token budget is halved when a batch has failed items or is slower than
+    the latency target, and grows by the growth factor after clean, fast batches.
+    With adaptive=False it hands out fixed batches of batch_size items.
+    """
+
+    def __init__(self, batch_size: int, include_gt: bool, adaptive: bool = True,
+                 min_tokens: int = 0, max_tokens: int = 0, latency_target: float = 0.0, growth: float = 1.25):
+        self.batch_size = batch_size
+        self.include_gt = include_gt
+        self.adaptive = adaptive
+        self.min_tokens = min_tokens
+        self.max_tokens = max_tokens
+        self.latency_target = latency_target
+        self.growth = growth
+        self.budget: Optional[float] = None
+        self.sizes: List[int] = []
+        self._lock = threading.Lock()
+
+    def item_tokens(self, item: Dict) -> int:
+        if "est_tokens" not in item:
+            item["est_tokens"] = estimate_item_tokens(item, self.include_gt)
+        return item["est_tokens"]
+
+    def take(self, queue: deque) -> List[Dict]:
+        """Pop the next batch from the front of the queue (at least one item)."""
+        with self._lock:
+            if not self.adaptive:
+                batch = [queue.popleft() for _ in range(min(self.batch_size, len(queue)))]
+            else:
+                if self.budget is None:
+                    # Start where the static BATCH_SIZE would be, within the configured bounds
+                    sample = list(itertools.islice(queue, self.batch_size))
+                    start = sum(self.item_tokens(item) for item in sample)
+                    self.budget = float(min(max(start, self.min_tokens), self.max_tokens))
+                batch, used = [], 0
+                while queue and (not batch or used + self.item_tokens(queue[0]) <= self.budget):
+                    item = queue.popleft()
+                    used += self.item_tokens(item)
+                    batch.append(item)
+            self.sizes.append(len(batch))
+            return batch
+
+    def ready(self, n_items: int, n_tokens: int) -> bool:
+        """Whether n_items queued items (n_tokens estimated tokens) fill a whole batch."""
+        if not self.adaptive or self.budget is None:
+            return n_items >= self.batch_size
+        return n_tokens >= self.budget
+
+    def record(self, n_items: int, n_failed: int, latency: float):
+        """Adapt the token budget to the outcome of one batch."""
+        if not self.adaptive or self.budget is None:
+            return
+        with self._lock:
+            old = self.budget
+            if n_failed > 0 or latency > self.latency_target:
+                self.budget = max(self.min_tokens, self.budget * 0.5)
+            elif latency < self.latency_target * 0.5:
+                self.budget = min(self.max_tokens, self.budget * self.growth)
+            if int(old) != int(self.budget):
+                logger.info(f"Batch token budget {old:.0f} -> {self.budget:.0f} "
+                            f"({n_failed}/{n_items} failed, {latency:.1f}s)")
+
+    def summary(self) -> str:
+        if not self.sizes:
+            return "no batches"
+        sizes = sorted(self.sizes)
+        return (f"{len(sizes)} batch(es), size min/median/max = "
+                f"{sizes[0]}/{sizes[len(sizes) // 2]}/{sizes[-1]} items")
+
+
+class BatchDispatcher:
+    """
+    Run correct_batch on a bounded thread pool for batches cut by an AdaptiveBatcher.
+    Items of a failed batch are split in two halves and re-queued (up to batch_split_depth times)
+    before falling back; finished batches are reported through on_result(batch, corrected), where
+    a None/empty entry means "no valid answer". All methods are called from one (the owner) thread.
+    With LLM_STREAM, on_item(item, corrected) is additionally called from worker threads for every
+    item as soon as its answer streams in, before its batch is reported.
+    With a budget, a batch is only started if its estimated tokens fit; once one does not, every
+    queued item (and any item added later) is reported as None without being sent (see skipped).
+    The batching, streaming and validation settings come from settings (default: get_settings()).
+    """
+
+    def __init__(self, provider: str, batch_size: int, include_gt: bool, max_inflight_batches: int,
+                 on_result: Callable[[List[Dict], List[Optional[str]]], None], pbar: Optional[tqdm] = None,
+                 on_item: Optional[Callable[[Dict, str], None]] = None, budget: Optional[Budget] = None,
+                 settings: Optional[Settings] = None):
+        self.provider = provider
+        self.settings = settings = settings or get_settings()
+        self.include_gt = include_gt
+        self.on_result = on_result
+        self.on_item = on_item
+        self.pbar = pbar
+        self.budget = budget
+        # Items left unsent because the budget ran out
+        self.skipped = 0
+        # Items already counted on the progress bar while their batch was streaming (by id())
+        self._streamed: set = set()
+        self._streamed_lock = threading.Lock()
+        self.batcher = AdaptiveBatcher(batch_size, include_gt, adaptive=settings.adaptive_batching,
+                                       min_tokens=settings.batch_min_tokens, max_tokens=settings.batch_max_tokens,
+                                       latency_target=settings.batch_latency_target,
+                                       growth=settings.batch_budget_growth)
+        self.n_workers = max(1, max_inflight_batches)
+        self.queue: deque = deque()
+        self.queued_tokens = 0
+        # Halves of failed batches, sent before new items: (items, split depth)
+        self.retry_queue: deque = deque()
+        self.inflight: Dict = {}
+        self.n_batches = 0
+        self._executor = ThreadPoolExecutor(max_workers=self.n_workers, thread_name_prefix="llm-batch")
+
+    def add(self, item: Dict):
+        self.queue.append(item)
+        self.queued_tokens += self.batcher.item_tokens(item)
+
+    @property
+    def idle(self) -> bool:
+        return not (self.queue or self.retry_queue or self.inflight)
+
+    @property
+    def saturated(self) -> bool:
+        """All slots busy and at least one more full batch queued."""
+        return (len(self.inflight) >= self.n_workers
+                and self.batcher.ready(len(self.queue), self.queued_tokens))
+
+    def submit(self, force: bool = False):
+        """Start batches while slots are free; without force, a partial batch is not started."""
+        if self.budget is not None and self.budget.stop_reason is not None:
+            self._skip_queued()
+            return
+        while len(self.inflight) < self.n_workers:
+            if self.retry_queue:
+                batch, depth = self.retry_queue.popleft()
+            elif self.queue and (force or self.batcher.ready(len(self.queue), self.queued_tokens)):
+                batch, depth = self.batcher.take(self.queue), 0
+                self.queued_tokens -= sum(self.batcher.item_tokens(item) for item in batch)
+            else:
+                return
+            reserved = 0
+            if self.budget is not None:
+                reserved = static_prefix_tokens() + sum(self.batcher.item_tokens(item) for item in batch)
+                if not self.budget.try_reserve(reserved):
+                    # Put the batch back so that it is skipped together with the rest
+                    self.retry_queue.appendleft((batch, depth))
+                    self._skip_queued()
+                    return
+            self.inflight[self._executor.submit(_timed_correct_batch, batch, self.provider, self.include_gt,
+                                                self._item_streamed, self.budget, self.settings)] = (batch, depth, reserved)
+
+    def _skip_queued(self):
+        """Budget exhausted: report every item not yet sent as unanswered (and mark it "skipped")."""
+        skipped = [item for batch, _ in self.retry_queue for item in batch] + list(self.queue)
+        self.retry_queue.clear()
+        self.queue.clear()
+        self.queued_tokens = 0
+        if not skipped:
+            return
+        if not self.skipped:
+            logger.warning(f"Budget exhausted ({self.budget.stop_reason}); remaining items are written unchanged.")
+        for item in skipped:
+            item["skipped"] = True
+        self.skipped += len(skipped)
+        METRICS.inc("budget_skipped_items", len(skipped))
+        self._report(skipped, [None] * len(skipped))
+
+    def _item_streamed(self, item: Dict, corrected: str):
+        with self._streamed_lock:
+            self._streamed.add(id(item))
+            if self.pbar is not None:
+                self.pbar.update(1)
+        if self.on_item is not None:
+            self.on_item(item, corrected)
+
+    def wait(self, timeout: Optional[float] = None):
+        """Wait (at most timeout seconds) for at least one in-flight batch and handle its result."""
+        if not self.inflight:
+            return
+        done, _ = wait(self.inflight, timeout=timeout, return_when=FIRST_COMPLETED)
+        for fut in done:
+            batch, depth, reserved = self.inflight.pop(fut)
+            if reserved:
+                self.budget.release(reserved)
+            self.n_batches += 1
+            try:
+                corrected, dt = fut.result()
+            except Exception as e:
+                METRICS.inc("batch_failures")
+                logger.error(f"Batch of {len(batch)} item(s) failed: {e}")
+                corrected, dt = [None] * len(batch), self.settings.batch_latency_target
+            failed = [item for item, corr in zip(batch, corrected) if not corr]
+            self.batcher.record(len(batch), len(failed), dt)
+            # Items the model kept answering against the prompt rules fall back now; a smaller batch won't fix them
+            retry = [item for item in failed if not item.get("rejected")]
+
+            if retry and len(retry) > 1 and depth < self.settings.batch_split_depth:
+                # Keep the answered items; split the failed ones in two smaller batches instead of resending them whole
+                failed = retry
+                done_items = [(item, corr) for item, corr in zip(batch, corrected) if corr or item.get("rejected")]
+                if done_items:
+                    self._report([item for item, _ in done_items], [corr for _, corr in done_items])
+                half = len(failed) // 2
+                METRICS.inc("batch_splits")
+                self.retry_queue.append((failed[:half], depth + 1))
+                self.retry_queue.append((failed[half:], depth + 1))
+                logger.info(f"Splitting {len(failed)} failed item(s) into batches of {half} and {len(failed) - half}")
+            else:
+                self._report(batch, corrected)
+
+            if self.pbar is not None:
+                self.pbar.set_postfix({"batch": self.n_batches, "size": len(batch), "sec": f"{dt:.1f}"})
+            else:
+                logger.info(f"Batch {self.n_batches} ({len(batch)} items) done in {dt:.1f}s")
+
+    def _report(self, batch: List[Dict], corrected: List[Optional[str]]):
+        self.on_result(batch, corrected)
+        with self._streamed_lock:
+            n_new = sum(1 for item in batch if id(item) not in self._streamed)
+            self._streamed.difference_update(id(item) for item in batch)
+            if self.pbar is not None:
+                self.pbar.update(n_new)
+
+    def run(self):
+        """Send everything that is queued and wait until all of it is answered."""
+        while not self.idle:
+            self.submit(force=True)
+            self.wait()
+
+    def close(self):
+        # Drop batches that have not started yet; in-flight ones are not awaited
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+def run_fingerprint(provider: str, include_gt: bool, threshold: float) -> str:
+    """Settings a checkpoint journal is valid for: provider, model, prompt, GT usage and threshold."""
+    return (f"{provider}|{provider_model(provider)}|{prompt_fingerprint()}|gt={include_gt}"
+            f"|threshold={threshold}")
+
+
+def _manifest_settings(provider: str, batch_size: int, threshold: float, include_gt_in_prompt: bool,
+                       **_ignored) -> str:
+    """Settings an output depends on; a change invalidates every entry of the manifest."""
+    return (f"{run_fingerprint(provider, include_gt_in_prompt, threshold)}|batch={batch_size}"
+            f"|local={get_settings().local_correction}")
+
+
+def _run_memo(streaming: bool) -> CorrectionMemo:
+    """The memo of a run; in the streaming mode it keeps only the last STREAM_RESOLVED_KEYS resolved keys."""
+    return CorrectionMemo(max_resolved=STREAM_RESOLVED_KEYS if streaming else 0)
+
+
+def store_results(batch: List[Dict], corrected: List[Optional[str]],
+                  cache: Optional[CorrectionCache], memo: Optional[CorrectionMemo],
+                  journal: Optional[Journal] = None):
+    """Publish LLM answers to the checkpoint journal, the run-wide memo and the persistent cache."""
+    n_fallback = sum(1 for corr in corrected if not corr)
+    METRICS.inc("llm_items", len(batch))
+    METRICS.inc("fallback_to_ocr", n_fallback)
+    if journal:
+        journal.record_batch(batch, corrected)
+    if memo:
+        for item, corr in zip(batch, corrected):
+            memo.resolve(item["key"], corr or None)
+    if cache:
+        # Fallbacks are not cached so that a later run asks the LLM again
+        cache.put_many({item["cache_key"]: corr for item, corr in zip(batch, corrected) if corr})
+
+
+def resolve_without_llm(unique: List[Dict], key_to_corrected: Dict[Tuple, str], provider: str,
+                        include_gt: bool, cache: Optional[CorrectionCache],
+                        journal: Optional[Journal] = None,
+                        use_local: bool = True) -> Tuple[List[Dict], Dict[str, int]]:
+    """
+    Resolve unique items from the journal of an interrupted run, with the local corrector (unless
+    use_local is False), then with the correction cache. Returns (items still needing the LLM, counts per stage).
+    """
+    counts = {"replayed": 0, "local": 0, "cached": 0}
+    pending = unique
+    if journal:
+        pending = []
+        for item in unique:
+            replayed = journal.lookup(item["key"])
+            if replayed is not None:
+                key_to_corrected[item["key"]] = replayed
+            else:
+                pending.append(item)
+        counts["replayed"] = len(unique) - len(pending)
+
+    # Tokens the prompt rules/lexicon/patterns resolve unambiguously never reach the LLM
+    local = get_local_corrector() if use_local else None
+    n_before = len(pending)
+    if local:
+        candidates, pending = pending, []
+        with METRICS.time("local_correct"):
+            for item in candidates:
+                fixed = local.resolve(item["pred"], item["conf"])
+                if fixed is not None:
+                    key_to_corrected[item["key"]] = fixed
+                else:
+                    pending.append(item)
+    counts["local"] = n_before - len(pending)
+
+    # Serve tokens corrected by earlier runs/files from the cache; only misses go further
+    if cache and pending:
+        model = provider_model(provider)
+        for item in pending:
+            item["cache_key"] = make_cache_key(item["pred"], item["conf"], provider, model,
+                                               item["gt"] if include_gt else None)
+        with METRICS.time("cache_lookup"):
+            hits = cache.get_many(item["cache_key"] for item in pending)
+        misses = []
+        for item in pending:
+            if item["cache_key"] in hits:
+                key_to_corrected[item["key"]] = hits[item["cache_key"]]
+            else:
+                misses.append(item)
+        counts["cached"] = len(pending) - len(misses)
+        pending = misses
+    for stage, n in counts.items():
+        METRICS.inc(f"items_{stage}", n)
+    return pending, counts
+
+
+def _correct_pending(pending: List[Dict], key_to_corrected: Dict[Tuple, str],
+                     provider: str, batch_size: int, include_gt: bool,
+                     max_inflight_batches: int, cache: Optional[CorrectionCache] = None,
+                     memo: Optional[CorrectionMemo] = None, journal: Optional[Journal] = None,
+                     budget: Optional[Budget] = None, progress: bool = True,
+                     settings: Optional[Settings] = None) -> bool:
+    """
+    Send the pending (unique) items to the LLM through a BatchDispatcher and record the results in
+    key_to_corrected; items that got no valid answer are marked "fallback". New corrections are
+    journaled, written to the cache and published to the run-wide memo.
+    Returns False if the run was interrupted or the budget left items unsent.
+    """
+    n_fix = len(pending)
+
+    # Batch processing progress bar
+    pbar = None
+    if progress:
+        pbar = tqdm(total=n_fix, desc=f"LLM({provider})", unit="tok", leave=True)
+
+    def _on_result(batch: List[Dict], corrected: List[Optional[str]]):
+        for item, corr in zip(batch, corrected):
+            # If corr is None (due to retry failure) or an empty string, fall back to the original pred
+            key_to_corrected[item["key"]] = corr if corr is not None and corr != "" else item["pred"]
+            if not corr:
+                item["fallback"] = True
+        store_results(batch, corrected, cache, memo, journal)
+
+    # Results are keyed by item, so completion order does not affect the output order.
+    dispatcher = BatchDispatcher(provider, batch_size, include_gt, max_inflight_batches, _on_result, pbar,
+                                 budget=budget, settings=settings)
+    for item in pending:
+        dispatcher.add(item)
+
+    start_ts = time.time()
+    try:
+        dispatcher.run()
+        total_dt = time.time() - start_ts
+        ips = n_fix / total_dt if total_dt > 0 else 0.0
+        logger.info(f"LLM correction finished in {total_dt:.1f}s, throughput {ips:.2f} item/s "
+                    f"(max in-flight batches: {dispatcher.n_workers}; {dispatcher.batcher.summary()})")
+        router = get_router(provider)
+        for name in router.weights:
+            usage = get_client(name).usage()
+            logger.info(f"LLM usage so far ({name}): {usage['calls']} call(s), "
+                        f"{usage['prompt_tokens']} prompt + {usage['completion_tokens']} completion tokens")
+        if router.hedge or len(router.weights) > 1:
+            st = router.stats()
+            logger.info(f"Routing: {st['requests']} request(s), {st['hedges']} hedged ({st['hedge_rate']:.1%}, "
+                        f"{st['hedge_wins']} won), {st['failovers']} failover(s)")
+        if budget is not None:
+            logger.info(f"Budget: {budget.summary()}; {dispatcher.skipped}/{n_fix} item(s) left unsent.")
+    except KeyboardInterrupt:
+        logger.warning("Interrupted by user (Ctrl-C). Writing partial results...")
+        return False
+    finally:
+        dispatcher.close()
+        if pbar:
+            pbar.close()
+    return dispatcher.skipped == 0
+
+
+def _by_benefit(items: List[Dict], groups: Dict[Tuple, List[Dict]]) -> List[Dict]:
+    """
+    Order unique items for a budgeted run: lowest confidence first, then the tokens occurring most
+    often. Cached, replayed and locally resolved items cost nothing and never get here.
+    """
+    return sorted(items, key=lambda item: (item["conf"], -len(groups.get(item["key"], ()))))
+
+
+class _Record:
+    """One input line held in the streaming window (corrected is None until resolved)."""
+    __slots__ = ("gt", "pred", "conf", "corrected")
+
+    def __init__(self, gt: str, pred: str, conf: float, corrected: Optional[str] = None):
+        self.gt = gt
+        self.pred = pred
+        self.conf = conf
+        self.corrected = corrected
+
+
+def _process_file_streaming(input_path: str, output_path: str,
+                            provider: str, batch_size: int,
+                            threshold: float,
+                            include_gt_in_prompt: bool,
+                            max_inflight_batches: int = 1,
+                            memo: Optional[CorrectionMemo] = None,
+                            journal: Optional[Journal] = None,
+                            budget: Optional[Budget] = None) -> bool:
+    """
+    Constant-memory variant of process_file for very large inputs.
+    Lines are read lazily and written in input order as soon as every line before them is resolved.
+    Only the window from the oldest unresolved line onward is kept in memory: reading pauses while all
+    batch slots are busy and another full batch is queued, or while the window exceeds STREAM_WINDOW_LINES.
+    Items are sent in file order, also with a budget (nothing is held back to rank them).
+    The corrections of the last STREAM_RESOLVED_KEYS keys are remembered, so a repeated token is
+    resolved without another journal, local corrector or cache lookup; older keys go through those again.
+    Returns False if the run was interrupted or the budget left items unsent.
+    """
+    logger.info(f"Streaming: {input_path}")
+    settings = get_settings()
+    cache = get_correction_cache()
+    memo = memo or _run_memo(streaming=True)
+
+    window: deque = deque()
+    # key -> records waiting for the correction of that key (queued, in flight or owned by another file)
+    waiting: Dict[Tuple, List[_Record]] = {}
+    owned: set = set()
+    # key -> valid correction of recently resolved keys (LRU, STREAM_RESOLVED_KEYS)
+    recent: "OrderedDict[Tuple, str]" = OrderedDict()
+    # Results produced on other threads: keys owned by other files, and items streamed out of in-flight batches
+    arrived: SimpleQueue = SimpleQueue()
+    stats = {"lines": 0, "low_conf": 0, "replayed": 0, "local": 0, "cached": 0}
+    completed = True
+
+    def _resolve(key: Tuple, corrected: Optional[str]):
+        if corrected:
+            recent[key] = corrected
+            recent.move_to_end(key)
+            if len(recent) > STREAM_RESOLVED_KEYS:
+                recent.popitem(last=False)
+        for rec in waiting.pop(key, ()):
+            # If corrected is None (due to retry failure) or an empty string, fall back to the original pred
+            rec.corrected = corrected if corrected else rec.pred
+
+    def _on_result(batch: List[Dict], corrected: List[Optional[str]]):
+        store_results(batch, corrected, cache, memo, journal)
+        for item, corr in zip(batch, corrected):
+            owned.discard(item["key"])
+            _resolve(item["key"], corr)
+
+    def _take_arrived(block: bool = False):
+        # Results of keys owned by other files arrive through done-callbacks on their threads,
+        # streamed answers through the dispatcher's on_item
+        while True:
+            try:
+                key, corrected = arrived.get(block=block)
+            except Empty:
+                return
+            _resolve(key, corrected)
+            block = False
+
+    def _enqueue(rec: _Record):
+        item = {"pred": rec.pred, "gt": rec.gt, "conf": rec.conf}
+        key = item["key"] = dedup_key(item, include_gt_in_prompt)
+        if key in waiting:
+            waiting[key].append(rec)
+            return
+        if key in recent:
+            recent.move_to_end(key)
+            rec.corrected = recent[key]
+            return
+        waiting[key] = [rec]
+        resolved: Dict[Tuple, str] = {}
+        pending, counts = resolve_without_llm([item], resolved, provider, include_gt_in_prompt, cache, journal)
+        for stage, n in counts.items():
+            stats[stage] += n
+        if not pending:
+            _resolve(key, resolved[key])
+            return
+        mine, foreign = memo.claim([key])
+        if mine:
+            owned.add(key)
+            dispatcher.add(item)
+        else:
+            foreign[key].add_done_callback(lambda f, k=key: arrived.put((k, f.result())))
+
+    def _flush(out):
+        while window and window[0].corrected is not None:
+            rec = window.popleft()
+            # Updated: The rebuild_line call does not contain left_prefix
+            out.write(rebuild_line(rec.gt, rec.pred, rec.conf, rec.corrected) + "\n")
+
+    def _make_progress():
+        # Move the head of the window forward: send queued items, or wait for a batch / another file
+        if not dispatcher.idle:
+            dispatcher.submit(force=True)
+            # With streamed answers, come back regularly to write lines whose items arrived mid-batch
+            dispatcher.wait(timeout=STREAM_FLUSH_INTERVAL if settings.llm_stream else None)
+        else:
+            _take_arrived(block=True)
+        _take_arrived()
+
+    pbar = tqdm(desc=f"LLM({provider})", unit="tok", leave=True)
+    dispatcher = BatchDispatcher(provider, batch_size, include_gt_in_prompt, max_inflight_batches, _on_result, pbar,
+                                 on_item=lambda item, corrected: arrived.put((item["key"], corrected)),
+                                 budget=budget)
+    start_ts = time.time()
+
+    with open(input_path, "r", encoding="utf-8") as fin, open(output_path, "w", encoding="utf-8") as fout:
+        try:
+            for line in fin:
+                stats["lines"] += 1
+                gt, pred, conf = parse_line(line)
+                rec = _Record(gt, pred, conf)
+                window.append(rec)
+                if conf < threshold:
+                    stats["low_conf"] += 1
+                    _enqueue(rec)
+                else:
+                    rec.corrected = pred
+
+                _take_arrived()
+                dispatcher.submit()
+                while dispatcher.saturated:
+                    dispatcher.wait()
+                    dispatcher.submit()
+                while len(window) > settings.stream_window_lines and window[0].corrected is None:
+                    _make_progress()
+                _flush(fout)
+
+            while waiting:
+                _make_progress()
+                _flush(fout)
+            _flush(fout)
+        except KeyboardInterrupt:
+            logger.warning("Interrupted by user (Ctrl-C). Writing partial results...")
+            completed = False
+            for rec in window:
+                out_token = rec.corrected if rec.corrected is not None else rec.pred
+                fout.write(rebuild_line(rec.gt, rec.pred, rec.conf, out_token) + "\n")
+            window.clear()
+            for line in fin:
+                gt, pred, conf = parse_line(line)
+                fout.write(rebuild_line(gt, pred, conf, pred) + "\n")
+        finally:
+            dispatcher.close()
+            memo.release(owned)
+            pbar.close()
+
+    total_dt = time.time() - start_ts
+    METRICS.inc("lines", stats["lines"])
+    METRICS.inc("low_conf_items", stats["low_conf"])
+    logger.info(f"Streamed {stats['lines']} line(s) in {total_dt:.1f}s: {stats['low_conf']} low-confidence, "
+                f"{stats['replayed']} replayed, {stats['local']} resolved locally, {stats['cached']} cache hit(s), "
+                f"{dispatcher.batcher.summary()}")
+    if budget is not None:
+        logger.info(f"Budget: {budget.summary()}; {dispatcher.skipped} item(s) left unsent.")
+    logger.info(f"Wrote output: {output_path}")
+    return completed and dispatcher.skipped == 0
 
 
 def process_file(input_path: str, output_path: str,
                  provider: str, batch_size: int,
                  threshold: float,
-                 include_gt_in_prompt: bool):
+                 include_gt_in_prompt: bool,
+                 max_inflight_batches: int = 1,
+                 memo: Optional[CorrectionMemo] = None,
+                 streaming: bool = False,
+                 resume: bool = False,
+                 journal: Optional[Journal] = None,
+                 budget: Optional[Budget] = None) -> bool:
     """
     Read the input txt file, correct the low-confidence items in batches, and write the output with additional columns to the txt file.
+    Identical (pred, confidence-bucket) items are sent once. Items resolved by the local corrector,
+    found in the correction cache or in the run-wide memo shared by process_folder are not sent
+    at all. Up to max_inflight_batches batches are sent to the LLM concurrently.
+    With streaming=True the file is processed in bounded memory (see _process_file_streaming).
+    Every batch result is checkpointed to a journal (shared by process_folder, or <output_path>.journal,
+    removed once the output is complete); with resume=True the journal of an interrupted run is replayed
+    and a finished file is skipped.
+    budget caps the LLM spending of this file (default: a fresh one if BUDGET_SCOPE is "file"); items
+    left unsent when it runs out keep their OCR token.
+    Returns True once the output is complete, False if the run was interrupted or the budget ran out.
+    """
+    if budget is None:
+        budget = new_budget("file")
+    own_journal = journal is None and get_settings().checkpoint_journal
+    if own_journal:
+        journal = Journal(Path(f"{output_path}.journal"),
+                          run_fingerprint(provider, include_gt_in_prompt, threshold), resume)
+    completed = False
+    try:
+        if journal and journal.is_file_done(input_path) and os.path.exists(output_path):
+            logger.info(f"Already complete in the journal, skipping: {input_path}")
+            completed = True
+            return completed
+        with METRICS.time("process_file"):
+            if streaming:
+                completed = _process_file_streaming(input_path, output_path, provider, batch_size, threshold,
+                                                    include_gt_in_prompt, max_inflight_batches, memo, journal,
+                                                    budget)
+            else:
+                completed = _process_file_batched(input_path, output_path, provider, batch_size, threshold,
+                                                  include_gt_in_prompt, max_inflight_batches, memo, journal,
+                                                  budget)
+        if journal and completed:
+            journal.record_file(input_path)
+        return completed
+    finally:
+        if own_journal:
+            journal.close()
+            if completed:
+                # Nothing left to resume
+                journal.path.unlink(missing_ok=True)
+
+
+# Fields of the settings given to correct_items that apply to that call; the others are process-wide
+_PER_CALL_SETTINGS = frozenset({
+    "provider", "confidence_threshold", "batch_size", "max_inflight_batches", "include_gt_in_prompt",
+    "local_correction", "correction_cache", "budget_max_tokens", "budget_max_requests",
+    "budget_deadline_seconds", "budget_scope", "output_validation", "llm_stream", "adaptive_batching",
+    "batch_min_tokens", "batch_max_tokens", "batch_latency_target", "batch_budget_growth", "batch_split_depth",
+})
+
+
+def _check_per_call_settings(settings: Settings):
+    """Raise if settings changes a process-wide field, which correct_items would silently ignore."""
+    base = get_settings()
+    ignored = [f.name for f in fields(Settings)
+               if f.init and f.name not in _PER_CALL_SETTINGS and f.name not in settings._derived
+               and getattr(settings, f.name) != getattr(base, f.name)]
+    if ignored:
+        raise ValueError(f"correct_items cannot change process-wide settings per call: {', '.join(ignored)} "
+                         "(set them in the environment or .env instead)")
+
+
+def correct_items(items: Iterable[Dict], settings: Optional[Settings] = None) -> List[Dict]:
     """
+    Correct OCR items in-process, without input or output files: for OCR workers that embed the
+    corrector and call it per schematic. Each item is a dict with "pred", "conf" and optionally "gt".
+    Returns one {"corrected": str, "source": str} per item, in order. The source is one of:
+      confident  conf is at or above the threshold; returned unchanged
+      resolved   answered by the local corrector or the correction cache
+      llm        answered by the LLM
+      fallback   no valid answer; the OCR token is returned
+      unsent     the budget ran out before it was sent; the OCR token is returned
+    settings (default: get_settings()) chooses the provider, threshold, batch size, in-flight batches
+    and GT use of this call, whether it uses the local corrector and the correction cache, its budget
+    (a call counts as a whole run), streaming, answer validation and adaptive batching (see
+    _PER_CALL_SETTINGS). Every other field, e.g. provider endpoints, rate limits, the prompt references
+    and the KB, is process-wide and comes from get_settings(); a settings object that changes one
+    raises ValueError. Identical items are asked once; calls from several threads are independent and
+    share the cache and the provider connections.
+    """
+    if settings is None:
+        settings = get_settings()
+    else:
+        _check_per_call_settings(settings)
+    threshold = settings.confidence_threshold
+    include_gt = settings.include_gt_in_prompt
+    items = [{"idx": n, "pred": str(raw["pred"]), "conf": float(raw["conf"]), "gt": str(raw.get("gt") or "")}
+             for n, raw in enumerate(items)]
+    results = [{"corrected": item["pred"], "source": "confident"} for item in items]
+    to_fix = [item for item in items if item["conf"] < threshold]
+    if not to_fix:
+        return results
+
+    groups = group_items(to_fix, include_gt)
+    unique = [members[0] for members in groups.values()]
+    cache = get_correction_cache() if settings.correction_cache else None
+    key_to_corrected: Dict[Tuple, str] = {}
+    pending, _ = resolve_without_llm(unique, key_to_corrected, settings.provider, include_gt, cache,
+                                     use_local=settings.local_correction)
+    resolved = set(key_to_corrected)
+    if pending:
+        budget = new_budget(settings.budget_scope, settings)
+        if budget is not None:
+            pending = _by_benefit(pending, groups)
+        _correct_pending(pending, key_to_corrected, provider=settings.provider, batch_size=settings.batch_size,
+                         include_gt=include_gt, max_inflight_batches=settings.max_inflight_batches,
+                         cache=cache, budget=budget, progress=False, settings=settings)
+
+    for key, members in groups.items():
+        first = members[0]
+        if key in resolved:
+            source = "resolved"
+        elif first.get("skipped"):
+            source = "unsent"
+        elif first.get("fallback") or key not in key_to_corrected:
+            source = "fallback"
+        else:
+            source = "llm"
+        corrected = key_to_corrected.get(key, first["pred"])
+        for item in members:
+            results[item["idx"]] = {"corrected": corrected, "source": source}
+    return results
+
+
+def _read_low_confidence(input_path: str, threshold: float) -> Tuple[Columns, List[Dict]]:
+    """Parse an input file into (its columns, see parse_lines; the low-confidence items with their line index)."""
     logger.info(f"Reading: {input_path}")
     with open(input_path, "r", encoding="utf-8") as f:
-        raw_lines = f.readlines()
-    n_lines = len(raw_lines)
+        text = f.read()
+
+    t_parse = time.perf_counter()
+    parsed = parse_lines(text)
+    del text
+    gts, preds, confs = parsed
+    to_fix = [{"idx": i, "pred": preds[i], "gt": gts[i], "conf": conf}
+              for i, conf in enumerate(confs) if conf < threshold]
+    METRICS.observe("parse_input", time.perf_counter() - t_parse)
+
+    n_lines = len(confs)
     logger.info(f"Total lines: {n_lines}")
+    METRICS.inc("lines", n_lines)
+    METRICS.inc("low_conf_items", len(to_fix))
+    logger.info(f"Low-confidence items (<{threshold:.2f}): {len(to_fix)}")
+    return parsed, to_fix
+
 
-    # Analyze and collect low-confidence items
-    parsed: List[Dict] = []
-    to_fix: List[Dict] = []
-
-    iterable = enumerate(raw_lines)
-    iterable = tqdm(iterable, total=n_lines, desc="Parse", leave=False)
-    
-    for i, line in iterable:
-        # Updated: The parse_line return value does not contain left_prefix
-        gt, pred, conf = parse_line(line)
-        parsed.append({
-            "i": i, "gt": gt, "pred": pred, "conf": conf
-        })
-        if conf < threshold:
-            to_fix.append({"idx": i, "pred": pred, "gt": gt, "conf": conf})
+def _write_corrected(output_path: str, parsed: Columns, groups: Dict[Tuple, List[Dict]],
+                     key_to_corrected: Dict[Tuple, str]) -> int:
+    """Write every line with the correction of its group (the OCR token if none); returns the corrected count."""
+    gts, preds, confs = parsed
+    corrected = list(preds)
+    n_corrected = 0
+    for key, members in groups.items():
+        if key in key_to_corrected:
+            for item in members:
+                corrected[item["idx"]] = key_to_corrected[key]
+            n_corrected += len(members)
 
+    with METRICS.time("write_output"):
+        with open(output_path, "w", encoding="utf-8") as f:
+            f.write(rebuild_lines(gts, preds, confs, corrected))
+    return n_corrected
+
+
+def _process_file_batched(input_path: str, output_path: str,
+                          provider: str, batch_size: int,
+                          threshold: float,
+                          include_gt_in_prompt: bool,
+                          max_inflight_batches: int = 1,
+                          memo: Optional[CorrectionMemo] = None,
+                          journal: Optional[Journal] = None,
+                          budget: Optional[Budget] = None) -> bool:
+    """
+    In-memory implementation of process_file. With a budget, items are sent lowest confidence first.
+    Returns False if the run was interrupted or the budget left items unsent.
+    """
+    parsed, to_fix = _read_low_confidence(input_path, threshold)
     n_fix = len(to_fix)
-    logger.info(f"Low-confidence items (<{threshold:.2f}): {n_fix}")
     if n_fix == 0:
         logger.info("Nothing to correct. Writing passthrough output.")
-        with open(output_path, "w", encoding="utf-8") as file:
-            for rec in parsed:
-                # Updated: The rebuild_line call does not contain left_prefix
-                file.write(rebuild_line(rec["gt"], rec["pred"], rec["conf"], rec["pred"]) + "\n")
+        _write_corrected(output_path, parsed, {}, {})
         logger.info(f"Done. Wrote: {output_path}")
-        return
+        return True
 
-    # Batch processing progress bar
-    n_batches = math.ceil(n_fix / batch_size)
-    batch_iter = list(chunked(to_fix, batch_size))
+    key_to_corrected: Dict[Tuple, str] = {}
 
-    pbar = None
-    pbar = tqdm(total=n_fix, desc=f"LLM({provider})", unit="tok", leave=True)
+    # Identical (pred, confidence-bucket) items are corrected once and fanned out to every idx
+    groups = group_items(to_fix, include_gt_in_prompt)
+    unique = [members[0] for members in groups.values()]
+    logger.info(f"Unique low-confidence items: {len(unique)}/{n_fix}")
 
-    idx_to_corrected: Dict[int, str] = {}
-    start_ts = time.time()
+    cache = get_correction_cache()
+    pending, counts = resolve_without_llm(unique, key_to_corrected, provider,
+                                          include_gt_in_prompt, cache, journal)
+    if counts["replayed"]:
+        logger.info(f"Replayed from journal: {counts['replayed']}/{len(unique)} unique items")
+    if get_local_corrector():
+        logger.info(f"Resolved locally: {counts['local']}/{len(unique)} unique items")
+    if cache:
+        logger.info(f"Cache hits: {counts['cached']}/{len(unique) - counts['replayed'] - counts['local']} unique items")
 
+    # Keys already claimed by another file of the same folder run are awaited, not re-sent
+    memo = memo or CorrectionMemo()
+    owned, foreign = memo.claim(item["key"] for item in pending)
+    owned_set = set(owned)
+    pending = [item for item in pending if item["key"] in owned_set]
+    if budget is not None:
+        pending = _by_benefit(pending, groups)
+    completed = True
     try:
-        for b_idx, batch in enumerate(batch_iter, start=1):
-            t0 = time.time()
-            corrected = correct_batch(batch, provider=provider, include_gt=include_gt_in_prompt)
-            for item, corr in zip(batch, corrected):
-                # If corr is None (due to retry failure) or an empty string, fall back to the original pred
-                idx_to_corrected[item["idx"]] = corr if corr is not None and corr != "" else item["pred"]
-            dt = time.time() - t0
-            
-            if pbar:
-                pbar.update(len(batch))
-                pbar.set_postfix({"batch": f"{b_idx}/{n_batches}", "sec": f"{dt:.1f}"})
-            else:
-                done = b_idx * batch_size if b_idx < n_batches else n_fix
-                logger.info(f"Batch {b_idx}/{n_batches} done in {dt:.1f}s ({done}/{n_fix} items)")
-
-        total_dt = time.time() - start_ts
-        ips = n_fix / total_dt if total_dt > 0 else 0.0
-        logger.info(f"LLM correction finished in {total_dt:.1f}s, throughput {ips:.2f} item/s")
-    except KeyboardInterrupt:
-        logger.warning("Interrupted by user (Ctrl-C). Writing partial results...")
+        if pending:
+            completed = _correct_pending(pending, key_to_corrected, provider=provider, batch_size=batch_size,
+                                         include_gt=include_gt_in_prompt, max_inflight_batches=max_inflight_batches,
+                                         cache=cache, memo=memo, journal=journal, budget=budget)
     finally:
-        if pbar:
-            pbar.close()
+        memo.release(owned)
 
-    # Build the output line
-    out_lines = []
-    for rec in parsed:
-        corrected_token = idx_to_corrected.get(rec["i"], rec["pred"])
-        # Updated: The rebuild_line call does not contain left_prefix
-        out_lines.append(rebuild_line(rec["gt"], rec["pred"], rec["conf"], corrected_token))
+    if foreign:
+        logger.info(f"Waiting on {len(foreign)} item(s) already in flight for other files...")
+        for key, fut in foreign.items():
+            corrected = fut.result()
+            if corrected is not None:
+                key_to_corrected[key] = corrected
 
-    with open(output_path, "w", encoding="utf-8") as f:
-        f.write("\n".join(out_lines) + "\n")
+    n_done = _write_corrected(output_path, parsed, groups, key_to_corrected)
+    logger.info(f"Wrote output: {output_path} (processed {n_done}/{n_fix} low-confidence items)")
+    return completed
 
-    logger.info(f"Wrote output: {output_path} (processed {len(idx_to_corrected)}/{n_fix} low-confidence items)")
 
-def process_folder(input_dir: str, output_dir: str, **kwargs):
+def _process_folder_budgeted(jobs: List[Tuple[str, str]], budget: Budget,
+                             provider: str, batch_size: int,
+                             threshold: float,
+                             include_gt_in_prompt: bool,
+                             max_inflight_batches: int = 1,
+                             journal: Optional[Journal] = None,
+                             **_ignored) -> List[bool]:
     """
-    Iterate over all.txt files under input_dir and run process_file for each file.
-    Write the output to output_dir with the same file name.
+    Correct the (input, output) jobs of a folder run under one run-wide budget. Every file is read
+    first, so the items of all files compete for the budget by expected benefit (see _by_benefit)
+    rather than by file order; the outputs are written at the end. This holds all files in memory.
+    Returns, per job, whether its output is complete (no item left unsent or interrupted).
     """
-    os.makedirs(output_dir, exist_ok=True)
-    txt_files = sorted([
+    files = []
+    all_groups: Dict[Tuple, List[Dict]] = {}
+    for in_path, out_path in jobs:
+        parsed, to_fix = _read_low_confidence(in_path, threshold)
+        groups = group_items(to_fix, include_gt_in_prompt)
+        for key, members in groups.items():
+            all_groups.setdefault(key, []).extend(members)
+        files.append((out_path, parsed, groups))
+
+    key_to_corrected: Dict[Tuple, str] = {}
+    unique = [members[0] for members in all_groups.values()]
+    cache = get_correction_cache()
+    pending, counts = resolve_without_llm(unique, key_to_corrected, provider, include_gt_in_prompt, cache, journal)
+    logger.info(f"Budgeted run over {len(jobs)} file(s): {len(unique)} unique low-confidence item(s), "
+                f"{len(pending)} for the LLM ({counts['replayed']} replayed, {counts['local']} resolved locally, "
+                f"{counts['cached']} cache hit(s))")
+    if pending:
+        _correct_pending(_by_benefit(pending, all_groups), key_to_corrected, provider=provider,
+                         batch_size=batch_size, include_gt=include_gt_in_prompt,
+                         max_inflight_batches=max_inflight_batches, cache=cache, journal=journal, budget=budget)
+
+    complete = []
+    for out_path, parsed, groups in files:
+        n_done = _write_corrected(out_path, parsed, groups, key_to_corrected)
+        unsent = sum(1 for key in groups if key not in key_to_corrected or all_groups[key][0].get("skipped"))
+        logger.info(f"Wrote output: {out_path} ({n_done} low-confidence item(s), {unsent} left unsent)")
+        complete.append(unsent == 0)
+    return complete
+
+def _list_txt_files(input_dir: str) -> List[str]:
+    return sorted([
         os.path.join(root, f)
         for root, _, files in os.walk(input_dir)
         for f in files
         if f.lower().endswith(".txt")
     ])
 
+
+def process_folder(input_dir: str, output_dir: str, max_concurrent_files: int = 1,
+                   resume: bool = False, incremental: bool = False, **kwargs):
+    """
+    Iterate over all.txt files under input_dir and run process_file for each file.
+    Write the output to output_dir with the same file name.
+    Up to max_concurrent_files files are processed at once; request pacing is left to the
+    per-provider rate limiter shared by all of them (see rate_limit.py). Identical items
+    across files are sent to the LLM only once.
+    Batch results and finished files are checkpointed to <output_dir>/JOURNAL_NAME; with resume=True
+    finished files are skipped and completed batches are replayed instead of re-sent.
+    With incremental=True, files whose content and settings are unchanged since the output was written
+    (see <output_dir>/MANIFEST_NAME) are skipped, and outputs whose input is gone are reported.
+    With a budget and BUDGET_SCOPE "run", the items of all files share it, best first
+    (see _process_folder_budgeted); files left incomplete are not journaled or recorded as done.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    txt_files = _list_txt_files(input_dir)
+
     if not txt_files:
         logger.warning(f"No .txt files found in: {input_dir}")
         return
 
-    logger.info(f"Found {len(txt_files)} txt file(s) in {input_dir}. Outputting to {output_dir}.")
+    # The local corrector and the cache are process-wide: report only what this run adds to their counters
+    local = get_local_corrector()
+    local_before = Counter(local.stats) if local else Counter()
+    cache = get_correction_cache()
+    cache_before = (cache.hits, cache.misses) if cache else (0, 0)
 
-    for idx, fn in enumerate(txt_files, start=1):
-        # fn = 绝对路径（来自上面的列表）
-        in_path = fn
+    manifest = None
+    if incremental:
+        manifest = Manifest(Path(output_dir) / MANIFEST_NAME, _manifest_settings(**kwargs))
+        rels = [os.path.relpath(fn, start=input_dir) for fn in txt_files]
+        orphans = manifest.orphans(output_dir, rels)
+        if orphans:
+            logger.warning(f"{len(orphans)} output(s) have no input any more: {', '.join(orphans[:10])}"
+                           + (" ..." if len(orphans) > 10 else ""))
+            manifest.forget(orphans)
+
+    n_workers = max(1, min(max_concurrent_files, len(txt_files)))
+    logger.info(f"Found {len(txt_files)} txt file(s) in {input_dir}. Outputting to {output_dir} "
+                f"({n_workers} file(s) at a time).")
+    n_skipped = 0
 
+    def _plan(fn: str) -> Optional[Tuple[str, str, Optional[str]]]:
+        """(relative path, output path, input signature) of a file to process, None if it is unchanged."""
+        nonlocal n_skipped
         # 关键：先算出相对 input_dir 的路径，再拼到 output_dir
         rel = os.path.relpath(fn, start=input_dir)
         out_path = os.path.join(output_dir, rel)
 
+        signature = None
+        if manifest:
+            signature = manifest.input_signature(rel, fn)
+            if manifest.is_up_to_date(rel, signature, out_path):
+                logger.debug(f"Unchanged, skipping: {rel}")
+                n_skipped += 1
+                return None
         os.makedirs(os.path.dirname(out_path), exist_ok=True)
+        return rel, out_path, signature
+
+    def _run_one(idx: int, fn: str):
+        # fn = 绝对路径（来自上面的列表）
+        planned = _plan(fn)
+        if planned is None:
+            return
+        rel, out_path, signature = planned
         logger.info(f"--- Processing file {idx}/{len(txt_files)}: {rel} ---")
-        process_file(input_path=in_path, output_path=out_path, **kwargs)
+        completed = process_file(input_path=fn, output_path=out_path, memo=memo, journal=journal, **kwargs)
+        if manifest and completed:
+            manifest.record(rel, signature, out_path)
+
+    def _run_budgeted(budget: Budget):
+        jobs = []
+        for fn in txt_files:
+            planned = _plan(fn)
+            if planned is None:
+                continue
+            if journal and journal.is_file_done(fn) and os.path.exists(planned[1]):
+                logger.info(f"Already complete in the journal, skipping: {fn}")
+                continue
+            jobs.append((fn, planned))
+        complete = _process_folder_budgeted([(fn, out_path) for fn, (_, out_path, _) in jobs], budget, **kwargs)
+        for (fn, (rel, out_path, signature)), done in zip(jobs, complete):
+            if done and journal:
+                journal.record_file(fn)
+            if done and manifest:
+                manifest.record(rel, signature, out_path)
+        n_incomplete = complete.count(False)
+        if n_incomplete:
+            logger.warning(f"Budget: {n_incomplete}/{len(jobs)} file(s) have items left unsent; "
+                           "a later run picks them up again.")
+
+    # One memo for the whole run: a token seen in several files goes to the LLM once
+    memo = _run_memo(kwargs.get("streaming", False))
+    journal = None
+    if get_settings().checkpoint_journal:
+        journal = Journal(Path(output_dir) / JOURNAL_NAME,
+                          run_fingerprint(kwargs["provider"], kwargs["include_gt_in_prompt"], kwargs["threshold"]),
+                          resume)
+    run_budget = new_budget("run")
+    executor = ThreadPoolExecutor(max_workers=n_workers, thread_name_prefix="file")
+    try:
+        if run_budget is not None:
+            _run_budgeted(run_budget)
+        else:
+            futures = [executor.submit(_run_one, idx, fn) for idx, fn in enumerate(txt_files, start=1)]
+            for fut in as_completed(futures):
+                fut.result()
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+        if journal:
+            journal.close()
 
-        if idx < len(txt_files):
-            sleep_duration = 10
-            logger.info(f"Sleeping {sleep_duration}s before next file...")
-            time.sleep(sleep_duration)
-            
+    if manifest:
+        logger.info(f"Incremental run: {n_skipped}/{len(txt_files)} unchanged file(s) skipped.")
+    logger.info(f"Cross-file deduplication: {memo.shared} item(s) shared with other files.")
+    if local:
+        logger.info(f"Local corrector outcomes: {dict(local.stats - local_before)}")
+    if cache:
+        hits, misses = cache.hits - cache_before[0], cache.misses - cache_before[1]
+        hit_rate = hits / (hits + misses) if hits + misses else 0.0
+        logger.info(f"Correction cache: {hits} hit(s), {misses} miss(es), hit rate {hit_rate:.1%}")
     logger.info("Folder processing complete.")
+
+
+def process_folder_sharded(input_dir: str, output_dir: str, worker_id: Optional[str] = None,
+                           lease_seconds: float = 60.0, poll_seconds: float = 5.0,
+                           max_concurrent_files: int = 1, resume: bool = False, **kwargs) -> Dict:
+    """
+    One worker of a sharded folder run. Any number of workers, on this or other machines sharing
+    input_dir and output_dir, run this at the same time. Each claims files through lease files in
+    <output_dir>/SHARD_DIR_NAME (see sharding.LeaseDir), processes up to max_concurrent_files of them
+    at once, and writes every output to a temporary file that is renamed into place once complete
+    (or, if the budget ran out, once it has been written, with a done marker that records it as partial).
+    Files of a worker that stopped renewing its leases for lease_seconds are taken over, and their
+    per-file checkpoint journal is replayed so that answered batches are not re-sent. A worker only
+    returns when every file is done or held by a live worker that finishes it.
+    A file is done when its done marker matches the current settings, the input content and the
+    output on disk, whichever worker or run wrote it: sharded runs are always incremental (remove
+    SHARD_DIR_NAME to start over), and journals always resume, so resume is implied.
+    Identical items are deduplicated within a worker, not across workers (the correction cache, if
+    shared, serves them across workers). A "run" budget applies to each worker separately.
+    Returns this worker's stats; the stats of all workers that finished meanwhile are logged.
+    """
+    worker = worker_id or default_worker_id()
+    txt_files = _list_txt_files(input_dir)
+    if not txt_files:
+        logger.warning(f"No .txt files found in: {input_dir}")
+        return {}
+    os.makedirs(output_dir, exist_ok=True)
+    leases = LeaseDir(Path(output_dir) / SHARD_DIR_NAME, worker, lease_seconds)
+    settings = _manifest_settings(**kwargs)
+    fingerprint = run_fingerprint(kwargs["provider"], kwargs["include_gt_in_prompt"], kwargs["threshold"])
+    started_at = time.time()
+    t0 = time.perf_counter()
+
+    rels = [os.path.relpath(fn, start=input_dir) for fn in txt_files]
+    # Workers start at different offsets of the list, so they rarely contend for the same lease
+    start = int(hashlib.sha1(worker.encode("utf-8")).hexdigest(), 16) % len(rels)
+    order = rels[start:] + rels[:start]
+    input_sha: Dict[str, str] = {}
+    stats = {"files": 0, "takeovers": 0, "skipped": 0, "incomplete": 0, "discarded": 0, "busy_seconds": 0.0}
+    lock = threading.Lock()
+    memo = _run_memo(kwargs.get("streaming", False))
+    run_budget = new_budget("run")
+    logger.info(f"Sharded run, worker {worker}: {len(rels)} txt file(s) in {input_dir}, outputs to {output_dir}.")
+
+    def _is_done(rel: str) -> bool:
+        info = leases.done_info(rel)
+        if not info or info.get("partial") or info.get("settings") != settings:
+            return False
+        try:
+            st = os.stat(os.path.join(output_dir, rel))
+        except FileNotFoundError:
+            return False
+        if info.get("output_stat") != [st.st_size, st.st_mtime_ns]:
+            return False
+        if rel not in input_sha:
+            input_sha[rel] = file_sha256(os.path.join(input_dir, rel))
+        return info.get("input_sha256") == input_sha[rel]
+
+    def _check_replaced(rel: str, out_path: str):
+        """Log what an output about to be written replaces, unless it is an outdated output of this run."""
+        try:
+            st = os.stat(out_path)
+        except FileNotFoundError:
+            return
+        info = leases.done_info(rel)
+        if not info or info.get("output_stat") != [st.st_size, st.st_mtime_ns]:
+            logger.warning(f"Replacing {out_path}, which no worker of this sharded run recorded as written.")
+        elif info.get("partial"):
+            logger.info(f"Replacing the partial output of {rel} left by worker {info.get('worker', '?')}.")
+
+    def _run_one(rel: str, claim: str):
+        in_path = os.path.join(input_dir, rel)
+        out_path = os.path.join(output_dir, rel)
+        tmp_path = f"{out_path}.{uuid.uuid4().hex[:8]}.tmp"
+        journal = None
+        t_file = time.perf_counter()
+        try:
+            # Another worker may have finished it between our check and our claim
+            if _is_done(rel):
+                return
+            # Hashed before processing, so an input changed meanwhile is not marked done
+            sha = input_sha.get(rel) or file_sha256(in_path)
+            os.makedirs(os.path.dirname(out_path), exist_ok=True)
+            if get_settings().checkpoint_journal:
+                journal = Journal(leases.journal_path(rel), fingerprint, resume=True)
+            logger.info(f"--- Processing {rel} ({claim} lease) ---")
+            completed = process_file(input_path=in_path, output_path=tmp_path, memo=memo, journal=journal,
+                                     budget=run_budget, **kwargs)
+            if leases.lost(rel):
+                with lock:
+                    stats["discarded"] += 1
+                return
+            _check_replaced(rel, out_path)
+            os.replace(tmp_path, out_path)
+            # An incomplete output (budget ran out) is published too, but recorded as partial: it is not
+            # done, and whoever processes the file next knows what it replaces
+            st = os.stat(out_path)
+            leases.mark_done(rel, {"settings": settings, "input_sha256": sha, "partial": not completed,
+                                   "output_stat": [st.st_size, st.st_mtime_ns], "finished": time.time()})
+            if completed:
+                if journal:
+                    journal.close()
+                    journal = None
+                    os.unlink(leases.journal_path(rel))
+            with lock:
+                stats["files" if completed else "incomplete"] += 1
+                stats["takeovers"] += claim == "takeover"
+        finally:
+            if journal:
+                journal.close()
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            leases.release(rel)
+            with lock:
+                stats["busy_seconds"] += time.perf_counter() - t_file
+
+    n_workers = max(1, max_concurrent_files)
+    executor = ThreadPoolExecutor(max_workers=n_workers, thread_name_prefix="file")
+    leases.start_heartbeat()
+    try:
+        remaining = list(order)
+        running: Dict = {}
+        while remaining or running:
+            waiting = []
+            for rel in remaining:
+                if _is_done(rel):
+                    with lock:
+                        stats["skipped"] += 1
+                    continue
+                if len(running) >= n_workers:
+                    waiting.append(rel)
+                    continue
+                claim = leases.try_acquire(rel)
+                if claim is None:
+                    waiting.append(rel)
+                    continue
+                running[executor.submit(_run_one, rel, claim)] = rel
+            remaining = waiting
+            if running:
+                done, _ = wait(running, timeout=poll_seconds if remaining else None, return_when=FIRST_COMPLETED)
+                for fut in done:
+                    running.pop(fut)
+                    fut.result()
+            elif remaining:
+                # Everything left is held by other workers; check again for finished or orphaned files
+                time.sleep(poll_seconds)
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+        leases.stop_heartbeat()
+
+    wall = time.perf_counter() - t0
+    lines = int(METRICS.counters.get("lines", 0))
+    stats.update(host=socket.gethostname(), pid=os.getpid(), lines=lines,
+                 low_conf_items=int(METRICS.counters.get("low_conf_items", 0)),
+                 llm_items=int(METRICS.counters.get("llm_items", 0)),
+                 wall_seconds=round(wall, 2), busy_seconds=round(stats["busy_seconds"], 2),
+                 lines_per_s=round(lines / wall, 1) if wall > 0 else 0.0,
+                 started=started_at, finished=time.time())
+    leases.write_worker_stats(stats)
+    # Workers of this run: those that finished after this one started
+    peers = [st for st in leases.worker_stats() if st.get("finished", 0) >= started_at]
+    logger.info(f"Sharded run, worker {worker} done: {stats['files']} file(s) processed "
+                f"({stats['takeovers']} taken over), {stats['skipped']} already done, {lines} line(s) "
+                f"in {wall:.1f}s.")
+    for st in peers:
+        logger.info(f"  worker {st['worker']}: {st['files']} file(s), {st['takeovers']} takeover(s), "
+                    f"{st['lines']} line(s), {st['llm_items']} LLM item(s), {st['lines_per_s']} lines/s "
+                    f"over {st['wall_seconds']}s ({st['busy_seconds']}s busy)")
+    return stats
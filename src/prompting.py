@@ -3,10 +3,127 @@ Build a Prompt to send to the LLM.
 """
 
 import json
+import hashlib
+from functools import lru_cache
 from typing import List, Dict
-from config import REFERENCE_TOKENS, REFERENCE_MAX_TOKENS, RAG_KB_PATH
+from config import get_settings
+from rate_limit import CHARS_PER_TOKEN, estimate_text_tokens
+from retrieval import get_reference_index, select_kb_sections
 # from references import *
 
+SYSTEM_MSG = (
+    "You are a senior PCB schematic engineer and OCR correction expert.\n"
+    "Task: Fix noisy OCR tokens for schematic labels using CONSERVATIVE, CHARACTER-LEVEL edits only.\n"
+    "Allowed swaps: O<->0, I/l<->1, S<->5, B<->8, Z<->2, g/q<->9.\n"
+    "Hard constraints:\n"
+    " - Replace internal spaces with underscores (_); never introduce spaces.\n"
+    " - Do NOT replace '-' with '_' or vice versa.\n"
+    " - Do NOT remove unit/symbols like Ω, µ, °, ±.\n"
+    " - Do NOT convert 3.3V <-> 3V3.\n"
+    " - Keep *_P/*_N suffixes and explicit +/- in diff pairs.\n"
+    "Length rule: if token length <= 2, RETURN THE OCR TOKEN UNCHANGED.\n"
+    "Confidence rule:\n"
+    " - If CONF >= 0.92: at most 0–2 confusable-character substitutions; length must not change (except spaces->underscores).\n"
+    " - If 0.80 <= CONF < 0.92: minimal edits; length change only for spaces->underscores.\n"
+    " - If CONF < 0.80: still conservative; only clear OCR confusions are allowed.\n"
+    "If the OCR token already looks valid or you're unsure, return it unchanged.\n"
+    "Additional guidance:\n"
+    " - If OCR token matches 'PAB', correct it to 'PA6' or 'PA8' based on the number in context.\n"
+    " - For any 'GP' or 'GPIO' confusion, prioritize 'GPIO' over 'GP' and fix errors like 'GP108' to 'GPIO8'.\n"
+    " - If the OCR token matches patterns like 'PAB', 'PAC', or 'PAA', consider it a potential misreading of 'PA6' or 'PA8'.\n"
+    "Output MUST be one line per input item: the item ID, a TAB, then the corrected token (ID<TAB>token). "
+    "Every ID exactly once. No quotes, no extra text."
+)
+
+# Rule boundaries of the "Confidence rule" in SYSTEM_MSG
+CONF_BUCKET_EDGES = (0.80, 0.92)
+
+def confidence_bucket(conf: float) -> str:
+    """Map a confidence score to the SYSTEM_MSG rule band it falls in ('low' / 'mid' / 'high')."""
+    if conf < CONF_BUCKET_EDGES[0]:
+        return "low"
+    if conf < CONF_BUCKET_EDGES[1]:
+        return "mid"
+    return "high"
+
+def render_kb_sections(sections: List[dict]) -> str:
+    """Compact plain-text rendering of knowledge base sections (rules, examples and patterns)."""
+    out = []
+    for sec in sections:
+        out.append(f"[{sec.get('title', sec.get('id', ''))}]")
+        out.extend(f"- {rule}" for rule in sec.get("rules", []))
+        examples = sec.get("examples", {})
+        if examples.get("good"):
+            out.append("good: " + ", ".join(examples["good"]))
+        if examples.get("bad"):
+            out.append("bad: " + ", ".join(examples["bad"]))
+        for name, pattern in sec.get("patterns", {}).items():
+            out.append(f"pattern {name}: {pattern}")
+    return "\n".join(out)
+
+def render_knowledge_base(kb: dict, include_sections: bool = True) -> str:
+    """Compact plain-text rendering of the knowledge base JSON (overview, sections, notes)."""
+    if not kb:
+        return ""
+    out = []
+    if kb.get("overview"):
+        out.append(kb["overview"])
+    if include_sections and kb.get("sections"):
+        out.append(render_kb_sections(kb["sections"]))
+    if kb.get("notes"):
+        out.append(kb["notes"])
+    return "\n".join(out)
+
+@lru_cache(maxsize=1)
+def static_prefix() -> str:
+    """
+    The part of every request that does not depend on the batch: system rules, reference tokens
+    and knowledge base. It is built on first use and sent byte-identical so provider-side prefix
+    caching can hit.
+    With PROMPT_RETRIEVAL, references and KB sections are chosen per batch and only the KB
+    overview stays in the prefix.
+    """
+    settings = get_settings()
+    parts = [SYSTEM_MSG]
+    reference_tokens = settings.reference_tokens if not settings.prompt_retrieval else []
+    if reference_tokens:
+        # Control the length of the context and put a line with commas to save more tokens
+        parts.append("Reference tokens (correct examples; mimic style when similar):\n" +
+                     ", ".join(reference_tokens[:settings.reference_max_tokens]))
+    kb_text = render_knowledge_base(settings.knowledge_base, include_sections=not settings.prompt_retrieval)
+    if kb_text:
+        parts.append("Knowledge Base (context only; do not over-normalize):\n" + kb_text)
+    return "\n\n".join(parts)
+
+def _batch_context(batch_items: List[Dict]) -> str:
+    """Reference tokens nearest to the batch items and the KB sections that apply to them."""
+    settings = get_settings()
+    tokens = [item.get("pred", "") for item in batch_items]
+    context = ""
+    refs = get_reference_index().nearest_for_batch(tokens, settings.reference_per_item, settings.reference_max_tokens)
+    if refs:
+        context += "Reference tokens (correct examples; mimic style when similar):\n" + ", ".join(refs) + "\n\n"
+    sections = select_kb_sections(settings.knowledge_base, tokens)
+    if sections:
+        context += "Applicable rules:\n" + render_kb_sections(sections) + "\n\n"
+    return context
+
+@lru_cache(maxsize=1)
+def static_prefix_tokens() -> int:
+    """Estimated tokens of fixed overhead paid by every request."""
+    return estimate_text_tokens(static_prefix())
+
+@lru_cache(maxsize=1)
+def prompt_fingerprint() -> str:
+    """Hash of everything static that shapes the LLM answer: system prompt, reference tokens and knowledge base."""
+    h = hashlib.sha256(static_prefix().encode("utf-8"))
+    settings = get_settings()
+    if settings.prompt_retrieval:
+        h.update("\n".join(settings.reference_corpus).encode("utf-8"))
+        h.update(json.dumps(settings.knowledge_base, sort_keys=True, ensure_ascii=False).encode("utf-8"))
+        h.update(f"{settings.reference_per_item}/{settings.reference_max_tokens}".encode("utf-8"))
+    return h.hexdigest()[:16]
+
 def _type_mask_string(tok: str) -> str:
     """When include_gt is True, A type mask (A=alpha, D=digit, S=symbol) is generated for the token to guide character-level corrections."""
     if not tok:
@@ -21,73 +138,56 @@ def _type_mask_string(tok: str) -> str:
             mask.append('S')
     return ''.join(mask)
 
+def _format_item(item_id: int, item: Dict, include_gt: bool) -> str:
+    """One numbered item line of the user message (with the answer rejected last time, if any)."""
+    pred = item.get("pred", "")
+    L = len(pred)
+    conf = item.get("conf", None)
+
+    if include_gt and item.get("gt"):
+        tm = _type_mask_string(item["gt"])
+        if conf is None:
+            line = f"{item_id}\tOCR: {pred} ; LEN: {L} ; GT: {item['gt']} ; TYPE_MASK: {tm}"
+        else:
+            line = f"{item_id}\tOCR: {pred} ; LEN: {L} ; CONF: {conf:.4f} ; GT: {item['gt']} ; TYPE_MASK: {tm}"
+    elif conf is None:
+        line = f"{item_id}\tOCR: {pred} ; LEN: {L}"
+    else:
+        line = f"{item_id}\tOCR: {pred} ; LEN: {L} ; CONF: {conf:.4f}"
+    if item.get("rejected"):
+        line += f" ; REJECTED: {item['rejected']}"
+    return line
+
+def estimate_item_tokens(item: Dict, include_gt: bool) -> int:
+    """Estimated tokens one item adds to a request: its prompt line, its retrieved references and its answer line."""
+    pred_len = len(item.get("pred", ""))
+    n_chars = len(_format_item(99, item, include_gt)) + pred_len + 4
+    settings = get_settings()
+    if settings.prompt_retrieval:
+        n_chars += settings.reference_per_item * (pred_len + 2)
+    return max(1, n_chars // CHARS_PER_TOKEN)
+
 def build_prompt(batch_items: List[Dict], include_gt: bool) -> List[Dict]:
     """
     Build a Prompt for OCR post-processing.
+    Items are numbered 1..n in the prompt; the answer is expected as "ID<TAB>token" lines.
+    The system message is always static_prefix(); only the user message depends on the batch.
+    An item whose earlier answer broke a hard constraint shows that answer ("rejected") on its line.
     """
-    kb_snippet = json.dumps(str(RAG_KB_PATH), ensure_ascii=False)
-
-    # Reference word list (sampled from the file, possibly empty)
-    ref_head = ""
-    if REFERENCE_TOKENS:
-        # Control the length of the context and put a line with commas to save more tokens
-        ref_head = "Reference tokens (correct examples; mimic style when similar):\n" + ", ".join(
-            REFERENCE_TOKENS[:REFERENCE_MAX_TOKENS]
-        ) + "\n\n"
-
-    system_msg = (
-        "You are a senior PCB schematic engineer and OCR correction expert.\n"
-        "Task: Fix noisy OCR tokens for schematic labels using CONSERVATIVE, CHARACTER-LEVEL edits only.\n"
-        "Allowed swaps: O<->0, I/l<->1, S<->5, B<->8, Z<->2, g/q<->9.\n"
-        "Hard constraints:\n"
-        " - Replace internal spaces with underscores (_); never introduce spaces.\n"
-        " - Do NOT replace '-' with '_' or vice versa.\n"
-        " - Do NOT remove unit/symbols like Ω, µ, °, ±.\n"
-        " - Do NOT convert 3.3V <-> 3V3.\n"
-        " - Keep *_P/*_N suffixes and explicit +/- in diff pairs.\n"
-        "Length rule: if token length <= 2, RETURN THE OCR TOKEN UNCHANGED.\n"
-        "Confidence rule:\n"
-        " - If CONF >= 0.92: at most 0–2 confusable-character substitutions; length must not change (except spaces->underscores).\n"
-        " - If 0.80 <= CONF < 0.92: minimal edits; length change only for spaces->underscores.\n"
-        " - If CONF < 0.80: still conservative; only clear OCR confusions are allowed.\n"
-        "If the OCR token already looks valid or you're unsure, return it unchanged.\n"
-        "Additional guidance:\n"
-        " - If OCR token matches 'PAB', correct it to 'PA6' or 'PA8' based on the number in context.\n"
-        " - For any 'GP' or 'GPIO' confusion, prioritize 'GPIO' over 'GP' and fix errors like 'GP108' to 'GPIO8'.\n"
-        " - If the OCR token matches patterns like 'PAB', 'PAC', or 'PAA', consider it a potential misreading of 'PA6' or 'PA8'.\n"
-        "Output MUST be tokens only, one per line, exactly matching input order. No numbering, no quotes, no extra text."
-    )
-
-    header = (
-        ref_head +
-        "Knowledge Base (context only; do not over-normalize):\n" +
-        f"{kb_snippet}\n\n" +
+    context = _batch_context(batch_items) if get_settings().prompt_retrieval else ""
+    header = context + (
         "Correct the following OCR tokens.\n"
         "If GT is provided, use it only to guide character types/positions (TYPE_MASK = A/D/S).\n"
-        "Return ONE token per line, same order as input.\n"
+        "Return ONE line per item as ID<TAB>token.\n"
     )
+    if any(item.get("rejected") for item in batch_items):
+        header += "REJECTED shows an earlier answer and, in parentheses, the rule above that it broke; do not repeat it.\n"
 
-    lines = []
-    for item in batch_items:
-        pred = item.get("pred", "")
-        L = len(pred)
-        conf = item.get("conf", None)
-
-        if include_gt and item.get("gt"):
-            tm = _type_mask_string(item["gt"])
-            if conf is None:
-                lines.append(f"- OCR: {pred} ; LEN: {L} ; GT: {item['gt']} ; TYPE_MASK: {tm}")
-            else:
-                lines.append(f"- OCR: {pred} ; LEN: {L} ; CONF: {conf:.4f} ; GT: {item['gt']} ; TYPE_MASK: {tm}")
-        else:
-            if conf is None:
-                lines.append(f"- OCR: {pred} ; LEN: {L}")
-            else:
-                lines.append(f"- OCR: {pred} ; LEN: {L} ; CONF: {conf:.4f}")
+    lines = [_format_item(item_id, item, include_gt) for item_id, item in enumerate(batch_items, start=1)]
 
     user_msg = header + "\n".join(lines)
 
     return [
-        {"role": "system", "content": system_msg},
+        {"role": "system", "content": static_prefix()},
         {"role": "user", "content": user_msg},
     ]
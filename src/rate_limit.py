@@ -0,0 +1,113 @@
+"""
+Token-bucket rate limiting shared by every LLM call made to the same provider.
+"""
+
+import time
+import threading
+import logging
+from typing import Dict, List, Optional
+
+from config import *
+
+logger = logging.getLogger("pcb-ocr-corrector.rate_limit")
+
+# Rough characters-per-token ratio used to estimate request size before sending
+CHARS_PER_TOKEN = 4
+
+
+def estimate_text_tokens(text: str) -> int:
+    """Estimate the token count of a piece of text."""
+    return max(1, len(text) // CHARS_PER_TOKEN)
+
+
+def estimate_tokens(messages: List[Dict]) -> int:
+    """Estimate the prompt token count of a chat message list."""
+    return estimate_text_tokens("".join(m.get("content", "") for m in messages))
+
+
+class TokenBucket:
+    """
+    Classic token bucket: holds at most `capacity` units and refills continuously
+    at `capacity` units per `period` seconds. A capacity <= 0 disables the bucket.
+    """
+
+    def __init__(self, capacity: float, period: float = 60.0):
+        self.capacity = float(capacity)
+        self.rate = self.capacity / period if capacity > 0 else 0.0
+        self.level = self.capacity
+        self.updated = time.monotonic()
+
+    @property
+    def enabled(self) -> bool:
+        return self.capacity > 0
+
+    def _refill(self, now: float):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: float, now: float) -> float:
+        """Seconds until `amount` units are available (0 if available now)."""
+        if not self.enabled:
+            return 0.0
+        self._refill(now)
+        # A single request larger than the bucket only has to wait for a full bucket
+        amount = min(amount, self.capacity)
+        deficit = amount - self.level
+        return deficit / self.rate if deficit > 0 else 0.0
+
+    def consume(self, amount: float):
+        if self.enabled:
+            self.level -= min(amount, self.capacity)
+
+
+class RateLimiter:
+    """
+    Requests/min and tokens/min limits of one provider.
+    acquire() blocks the calling thread until both buckets allow the request.
+    """
+
+    def __init__(self, name: str, rpm: int, tpm: int):
+        self.name = name
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self._lock = threading.Lock()
+        self.total_wait = 0.0
+
+    def acquire(self, n_tokens: int = 0):
+        """Block until one request of about n_tokens tokens may be sent."""
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                wait = max(self.requests.wait_time(1, now), self.tokens.wait_time(n_tokens, now))
+                if wait <= 0:
+                    self.requests.consume(1)
+                    self.tokens.consume(n_tokens)
+                    self.total_wait += waited
+                    if waited > 0:
+                        logger.debug(f"[{self.name}] rate limited for {waited:.2f}s")
+                    return
+            time.sleep(wait)
+            waited += wait
+
+    def settle(self, estimated: int, actual: int):
+        """Charge the tokens/min bucket for the difference between the estimated and the reported usage."""
+        if actual > estimated:
+            with self._lock:
+                self.tokens.consume(actual - estimated)
+
+
+_limiters: Dict[str, RateLimiter] = {}
+_limiters_lock = threading.Lock()
+
+
+def get_rate_limiter(provider: str) -> Optional[RateLimiter]:
+    """Return the process-wide limiter of a provider (None if no limits are configured)."""
+    settings = get_settings().llm_providers.get(provider, {})
+    rpm, tpm = settings.get("rpm", 0), settings.get("tpm", 0)
+    if rpm <= 0 and tpm <= 0:
+        return None
+    with _limiters_lock:
+        if provider not in _limiters:
+            _limiters[provider] = RateLimiter(provider, rpm, tpm)
+        return _limiters[provider]
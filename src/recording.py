@@ -0,0 +1,74 @@
+"""
+Recording of raw LLM answers per item, replayed offline by evaluate.py to score thresholds and settings
+without sending anything to a provider.
+"""
+
+import json
+import time
+import logging
+import threading
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional
+
+from config import *
+
+logger = logging.getLogger("pcb-ocr-corrector.recording")
+
+
+class AnswerRecorder:
+    """
+    Append-only JSONL file, one line per answer as parsed from the LLM output, before validation:
+      {"ts": ..., "provider": "gpt", "pred": "R1O", "conf": 0.62, "gt": "R10", "answer": "R10"}
+    Every answer is recorded, including the ones validation rejects and those of re-asks, so a
+    replay can apply other validation settings. Items the LLM left unanswered are not recorded.
+    """
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._fh = open(self.path, "a", encoding="utf-8")
+        self._lock = threading.Lock()
+
+    def record(self, provider: str, asked: List[Dict], answered: Dict[int, str]):
+        """Append the answers of one LLM response; `answered` maps 1-based IDs into `asked`."""
+        ts = round(time.time(), 3)
+        lines = []
+        for item_id, token in sorted(answered.items()):
+            item = asked[item_id - 1]
+            lines.append(json.dumps({"ts": ts, "provider": provider, "pred": item["pred"], "conf": item["conf"],
+                                     "gt": item.get("gt", ""), "answer": token}, ensure_ascii=False) + "\n")
+        if lines:
+            with self._lock:
+                self._fh.write("".join(lines))
+                self._fh.flush()
+
+    def close(self):
+        with self._lock:
+            self._fh.close()
+
+
+def read_recording(path: Path) -> Iterator[Dict]:
+    """Yield the records of a recording in file order, skipping a torn last line."""
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                yield json.loads(line)
+            except ValueError:
+                continue
+
+
+_recorder: Optional[AnswerRecorder] = None
+_recorder_lock = threading.Lock()
+
+
+def get_recorder() -> Optional[AnswerRecorder]:
+    """Return the process-wide answer recorder (None if LLM_RECORD_PATH is not set)."""
+    global _recorder
+    path = get_settings().llm_record_path
+    if not path:
+        return None
+    with _recorder_lock:
+        if _recorder is None:
+            _recorder = AnswerRecorder(path)
+            logger.info(f"Recording LLM answers to {path}")
+        return _recorder
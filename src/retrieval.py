@@ -0,0 +1,104 @@
+"""
+Per-batch retrieval of the reference tokens and knowledge base sections that are relevant to a batch.
+"""
+
+import re
+import logging
+import threading
+from collections import Counter, defaultdict
+from typing import Dict, Iterable, List, Optional
+
+from config import *
+
+logger = logging.getLogger("pcb-ocr-corrector.retrieval")
+
+# Fold the allowed OCR confusions (O<->0, I/l<->1, S<->5, B<->8, Z<->2, g/q<->9) so that a
+# misread token still lands next to its correct reference spelling.
+_CONFUSION_FOLD = str.maketrans({"O": "0", "I": "1", "L": "1", "S": "5", "B": "8", "Z": "2", "G": "9", "Q": "9", " ": "_"})
+
+
+def _fold(token: str) -> str:
+    return token.upper().translate(_CONFUSION_FOLD)
+
+
+def _ngrams(token: str, n: int) -> List[str]:
+    padded = f"^{_fold(token)}$"
+    if len(padded) <= n:
+        return [padded]
+    return [padded[i:i + n] for i in range(len(padded) - n + 1)]
+
+
+class NgramIndex:
+    """Character n-gram inverted index over a token list, ranked by Dice similarity."""
+
+    def __init__(self, tokens: Iterable[str], n: int = 3):
+        self.n = n
+        self.tokens: List[str] = list(dict.fromkeys(tokens))
+        self._sizes: List[int] = []
+        self._postings: Dict[str, List[int]] = defaultdict(list)
+        for tid, token in enumerate(self.tokens):
+            grams = set(_ngrams(token, n))
+            self._sizes.append(len(grams))
+            for g in grams:
+                self._postings[g].append(tid)
+
+    def query(self, token: str, k: int, min_score: float = 0.3) -> List[str]:
+        """Return up to k reference tokens most similar to token."""
+        grams = set(_ngrams(token, self.n))
+        shared: Counter = Counter()
+        for g in grams:
+            shared.update(self._postings.get(g, ()))
+        scored = [
+            (2.0 * cnt / (len(grams) + self._sizes[tid]), tid)
+            for tid, cnt in shared.items()
+        ]
+        scored = [(score, tid) for score, tid in scored if score >= min_score]
+        scored.sort(key=lambda x: (-x[0], x[1]))
+        return [self.tokens[tid] for _, tid in scored[:k]]
+
+    def nearest_for_batch(self, tokens: Iterable[str], per_item: int, max_total: int) -> List[str]:
+        """Union of the nearest references of every token, in first-seen order, capped at max_total."""
+        selected: Dict[str, None] = {}
+        for token in tokens:
+            for ref in self.query(token, per_item):
+                selected.setdefault(ref, None)
+                if len(selected) >= max_total:
+                    return list(selected)
+        return list(selected)
+
+
+# Which knowledge base sections apply to a batch, by section id. Sections with an unknown id are
+# always included so that new KB content is never silently dropped.
+_VOLTAGE_RE = re.compile(r"\d(\.\d+)?V|\dV\d", re.IGNORECASE)
+_SECTION_TRIGGERS = {
+    "spaces_and_underscores": lambda tok: " " in tok or "_" in tok or "-" in tok,
+    "units_and_symbols": lambda tok: any(ch in tok for ch in "Ωµ°±+/()") or bool(_VOLTAGE_RE.search(tok)),
+    "refdes_and_pairs": lambda tok: bool(re.fullmatch(r"[A-Za-z]{1,3}[0-9]+[A-Za-z]?", tok))
+                                    or tok.endswith(("_P", "_N", "+", "-")),
+    "character_level_only": lambda tok: True,
+    "confidence_guidance": lambda tok: True,
+}
+
+
+def select_kb_sections(kb: dict, tokens: List[str]) -> List[dict]:
+    """Return the knowledge base sections that apply to at least one token of the batch."""
+    selected = []
+    for sec in kb.get("sections", []):
+        trigger = _SECTION_TRIGGERS.get(sec.get("id"))
+        if trigger is None or any(trigger(tok) for tok in tokens):
+            selected.append(sec)
+    return selected
+
+
+_index: Optional[NgramIndex] = None
+_index_lock = threading.Lock()
+
+
+def get_reference_index() -> NgramIndex:
+    """Return the index over the full reference token file, built on first use."""
+    global _index
+    with _index_lock:
+        if _index is None:
+            _index = NgramIndex(get_settings().reference_corpus)
+            logger.info(f"Reference index built over {len(_index.tokens)} token(s).")
+        return _index
@@ -0,0 +1,215 @@
+"""
+Routing of chat requests across the configured providers: weighted load spreading, failover when a
+provider fails or its circuit is open, and hedging of slow requests to a second provider.
+"""
+
+import time
+import random
+import logging
+import threading
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Callable, Deque, Dict, List, Optional, Tuple
+
+from config import *
+from metrics import METRICS
+from llm_clients import StreamAborted, get_client
+from flow_control import get_circuit_breaker
+from rate_limit import estimate_tokens
+
+logger = logging.getLogger("pcb-ocr-corrector.routing")
+
+# Successful request latencies kept per provider for the hedge threshold
+LATENCY_WINDOW = 200
+
+
+class LatencyTracker:
+    """Sliding window of recent request latencies of one provider."""
+
+    def __init__(self, size: int = LATENCY_WINDOW):
+        self._samples: Deque[float] = deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def add(self, seconds: float):
+        with self._lock:
+            self._samples.append(seconds)
+
+    def quantile(self, q: float, min_samples: int) -> Optional[float]:
+        """Latency quantile, or None until min_samples requests have been seen."""
+        with self._lock:
+            if len(self._samples) < max(1, min_samples):
+                return None
+            ordered = sorted(self._samples)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+class ProviderRouter:
+    """
+    Send a chat request to one of `weights` (provider -> weight), chosen by weight among providers
+    whose circuit is not open. If the request is still unanswered after the provider's HEDGE_QUANTILE
+    latency, a duplicate goes to the next provider and the first valid answer wins; hedges are capped
+    at max_hedge_rate of all requests. A failed request fails over to the next provider.
+    """
+
+    def __init__(self, weights: Dict[str, float], hedge: bool = False, hedge_quantile: float = 0.95,
+                 min_samples: int = 20, initial_delay: float = 15.0, min_delay: float = 1.0,
+                 max_hedge_rate: float = 0.1, max_workers: int = 16):
+        self.weights = {name: w for name, w in weights.items() if w > 0}
+        if not self.weights:
+            raise ValueError("at least one provider needs a positive weight")
+        self.hedge = hedge
+        self.hedge_quantile = hedge_quantile
+        self.min_samples = min_samples
+        self.initial_delay = initial_delay
+        self.min_delay = min_delay
+        self.max_hedge_rate = max_hedge_rate
+        self.latency = {name: LatencyTracker() for name in self.weights}
+        self._rng = random.Random()
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.failovers = 0
+        # Only needed to race requests; a single-provider router without hedging calls in the caller's thread
+        self._executor = None
+        if hedge or len(self.weights) > 1:
+            self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="route")
+
+    def _order(self) -> List[str]:
+        """Providers to try, first chosen by weight, the rest by decreasing weight; open circuits last."""
+        names = list(self.weights)
+        with self._lock:
+            first = self._rng.choices(names, weights=[self.weights[n] for n in names])[0]
+        rest = sorted((n for n in names if n != first), key=lambda n: -self.weights[n])
+        order = [first] + rest
+        healthy = [n for n in order if not get_circuit_breaker(n).is_open]
+        return healthy + [n for n in order if n not in healthy]
+
+    def _hedge_delay(self, provider: str) -> Optional[float]:
+        """Seconds after which a request to provider is hedged (None: do not hedge this one)."""
+        if not self.hedge:
+            return None
+        with self._lock:
+            if self.hedges >= self.max_hedge_rate * max(1, self.requests):
+                return None
+        q = self.latency[provider].quantile(self.hedge_quantile, self.min_samples)
+        return max(self.min_delay, q if q is not None else self.initial_delay)
+
+    def _call(self, provider: str, messages: List[Dict], chat_kwargs: Dict) -> str:
+        t0 = time.perf_counter()
+        content = get_client(provider).chat(messages, **chat_kwargs)
+        self.latency[provider].add(time.perf_counter() - t0)
+        return content
+
+    def chat(self, messages: List[Dict], validate: Optional[Callable[[str], bool]] = None, **chat_kwargs) -> str:
+        """
+        Return the first valid answer; raises the last error if every provider failed.
+        chat_kwargs go to LLMClient.chat. An aborted stream is not failed over (the prompt, not the
+        provider, is the problem): it is raised once no other request for the same prompt is outstanding.
+        """
+        with self._lock:
+            self.requests += 1
+        order = self._order()
+        if self._executor is None:
+            METRICS.inc(f"routed_{order[0]}")
+            return self._call(order[0], messages, chat_kwargs)
+
+        # A single provider may still be hedged: the duplicate usually lands on another backend
+        candidates = order if len(order) > 1 or not self.hedge else order * 2
+        outstanding: Dict[Future, Tuple[str, bool]] = {}
+        last_error: Optional[Exception] = None
+        hedged = False
+        aborted = False
+
+        def _launch(is_hedge: bool):
+            provider = candidates.pop(0)
+            METRICS.inc(f"routed_{provider}")
+            outstanding[self._executor.submit(self._call, provider, messages, chat_kwargs)] = (provider, is_hedge)
+
+        _launch(False)
+        primary = order[0]
+        while outstanding:
+            timeout = None if hedged or not candidates else self._hedge_delay(primary)
+            done, _ = wait(outstanding, timeout=timeout, return_when=FIRST_COMPLETED)
+            if not done:
+                # Slow request: race a duplicate on the next provider
+                hedged = True
+                with self._lock:
+                    self.hedges += 1
+                METRICS.inc("hedge_requests")
+                METRICS.inc("hedge_extra_prompt_tokens", estimate_tokens(messages))
+                logger.debug(f"Hedging a request to {primary} after {timeout:.1f}s to {candidates[0]}")
+                _launch(True)
+                continue
+            for fut in done:
+                provider, is_hedge = outstanding.pop(fut)
+                try:
+                    content = fut.result()
+                except StreamAborted as e:
+                    last_error, aborted = e, True
+                    continue
+                except Exception as e:
+                    last_error = e
+                    logger.warning(f"Request to {provider} failed: {e}")
+                    continue
+                if validate is not None and not validate(content):
+                    last_error = ValueError(f"invalid answer from {provider}")
+                    continue
+                if is_hedge:
+                    with self._lock:
+                        self.hedge_wins += 1
+                    METRICS.inc("hedge_wins")
+                return content
+            if not outstanding and candidates and not aborted:
+                with self._lock:
+                    self.failovers += 1
+                METRICS.inc("failovers")
+                logger.warning(f"Failing over to {candidates[0]}")
+                _launch(False)
+        raise last_error or ConnectionError("no provider answered")
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            return {
+                "requests": self.requests,
+                "hedges": self.hedges,
+                "hedge_rate": self.hedges / self.requests if self.requests else 0.0,
+                "hedge_wins": self.hedge_wins,
+                "failovers": self.failovers,
+            }
+
+
+def parse_route_weights(spec: str, default_provider: str) -> Dict[str, float]:
+    """'gpt:3,deepseek:1' -> {'gpt': 3.0, 'deepseek': 1.0}; empty -> {default_provider: 1.0}."""
+    weights: Dict[str, float] = {}
+    for part in filter(None, (p.strip() for p in (spec or "").split(","))):
+        name, _, weight = part.partition(":")
+        name = name.strip()
+        known = get_settings().llm_providers
+        if name not in known:
+            raise ValueError(f"unknown provider {name!r} in LLM_ROUTE_WEIGHTS; known: {sorted(known)}")
+        weights[name] = float(weight) if weight else 1.0
+    return weights or {default_provider: 1.0}
+
+
+_routers: Dict[str, ProviderRouter] = {}
+_routers_lock = threading.Lock()
+
+
+def get_router(provider: str) -> ProviderRouter:
+    """
+    Return the process-wide router of a run whose provider is `provider`. LLM_ROUTE_WEIGHTS spreads
+    requests over several providers; without it every request goes to `provider`.
+    """
+    with _routers_lock:
+        if provider not in _routers:
+            settings = get_settings()
+            weights = parse_route_weights(settings.llm_route_weights, provider)
+            _routers[provider] = ProviderRouter(
+                weights, hedge=settings.hedge_enabled, hedge_quantile=settings.hedge_quantile,
+                min_samples=settings.hedge_min_samples, initial_delay=settings.hedge_initial_delay,
+                min_delay=settings.hedge_min_delay, max_hedge_rate=settings.hedge_max_rate,
+                max_workers=2 * settings.llm_pool_size)
+            if len(weights) > 1 or settings.hedge_enabled:
+                logger.info(f"Routing requests over {weights} (hedging: {'on' if settings.hedge_enabled else 'off'})")
+        return _routers[provider]
@@ -0,0 +1,344 @@
+"""
+Resident correction service: an asyncio HTTP server (TCP or Unix socket) that corrects OCR items sent by
+many clients. Low-confidence items of concurrent requests are merged into micro-batches within a short
+window, identical items are asked once, and prompts, the correction cache, the local corrector and the
+provider connection pools stay warm across requests. Run from src/:
+
+    python service.py --port 8080
+    python service.py --unix /run/pcbtagent.sock
+
+POST /v1/correct  {"items": [{"pred": "R1O", "conf": 0.62, "gt": ""}, ...], "threshold": 0.95}
+             ->   {"results": [{"corrected": "R10", "source": "llm"}, ...]}
+GET  /healthz, GET /stats (JSON run metrics), GET /metrics (Prometheus text)
+"""
+
+import os
+import json
+import time
+import signal
+import asyncio
+import logging
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+from config import *
+from cache import get_correction_cache
+from dedup import dedup_key
+from local_correct import get_local_corrector
+from metrics import METRICS
+from pipeline import BatchDispatcher, resolve_without_llm, store_results
+from routing import get_router
+from utils.logging_setup import *
+
+logger = logging.getLogger("pcb-ocr-corrector.service")
+
+HTTP_REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+                413: "Payload Too Large", 500: "Internal Server Error", 503: "Service Unavailable"}
+
+
+class RequestError(Exception):
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+class MicroBatcher:
+    """
+    Queue of low-confidence items shared by all requests. A batch is cut once max_batch items are
+    queued or the oldest one has waited `window` seconds, and up to max_inflight batches are corrected
+    at the same time on worker threads. Items with the same dedup key share one answer, whether the
+    duplicate is queued or already in flight.
+    """
+
+    def __init__(self, provider: str, include_gt: bool, max_batch: int, window: float, max_inflight: int):
+        self.provider = provider
+        self.include_gt = include_gt
+        self.max_batch = max(1, max_batch)
+        self.window = window
+        self.cache = get_correction_cache()
+        self._queue: List[Dict] = []
+        self._first_queued = 0.0
+        # Dedup key -> future of its (corrected, source), while queued or in flight
+        self._waiting: Dict[Tuple, asyncio.Future] = {}
+        self._more = asyncio.Event()
+        self._slots = asyncio.Semaphore(max(1, max_inflight))
+        self._executor = ThreadPoolExecutor(max_workers=max(1, max_inflight), thread_name_prefix="svc-batch")
+        self._tasks: set = set()
+        self._loop_task: Optional[asyncio.Task] = None
+
+    def start(self):
+        self._loop_task = asyncio.get_running_loop().create_task(self._batch_loop())
+
+    def submit(self, item: Dict) -> asyncio.Future:
+        key = dedup_key(item, self.include_gt)
+        fut = self._waiting.get(key)
+        if fut is not None:
+            METRICS.inc("service_items_shared")
+            return fut
+        fut = asyncio.get_running_loop().create_future()
+        self._waiting[key] = fut
+        if not self._queue:
+            self._first_queued = time.monotonic()
+        self._queue.append(dict(item, key=key))
+        self._more.set()
+        return fut
+
+    async def _batch_loop(self):
+        while True:
+            await self._more.wait()
+            # Wait for a full batch or the end of the window of the oldest queued item
+            while len(self._queue) < self.max_batch:
+                remaining = self._first_queued + self.window - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._more.clear()
+                try:
+                    await asyncio.wait_for(self._more.wait(), remaining)
+                except asyncio.TimeoutError:
+                    break
+            # While every slot is busy, items keep queueing up into a larger next batch
+            await self._slots.acquire()
+            # Items left over have waited at least as long as this batch, so they go out as soon as a slot frees
+            batch, self._queue = self._queue[:self.max_batch], self._queue[self.max_batch:]
+            if not self._queue:
+                self._more.clear()
+            task = asyncio.get_running_loop().create_task(self._run_batch(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _run_batch(self, batch: List[Dict]):
+        METRICS.inc("service_batches")
+        try:
+            results = await asyncio.get_running_loop().run_in_executor(self._executor, self._correct, batch)
+        except Exception as e:
+            logger.error(f"Micro-batch of {len(batch)} item(s) failed: {e}")
+            results = {item["key"]: (item["pred"], "fallback") for item in batch}
+        finally:
+            self._slots.release()
+        for item in batch:
+            fut = self._waiting.pop(item["key"], None)
+            if fut is not None and not fut.done():
+                fut.set_result(results[item["key"]])
+
+    def _correct(self, batch: List[Dict]) -> Dict[Tuple, Tuple[str, str]]:
+        """
+        Worker thread: local corrector and cache first, then the rest through a BatchDispatcher, so that
+        failed items are split and re-asked like in a file run. The dispatcher runs one batch at a time
+        to stay within the max_inflight slot this micro-batch holds.
+        """
+        key_to_corrected: Dict[Tuple, str] = {}
+        pending, _ = resolve_without_llm(batch, key_to_corrected, self.provider, self.include_gt, self.cache)
+        results = {key: (corrected, "resolved") for key, corrected in key_to_corrected.items()}
+        if pending:
+            def _on_result(answered: List[Dict], corrected: List[Optional[str]]):
+                store_results(answered, corrected, self.cache, None)
+                for item, corr in zip(answered, corrected):
+                    results[item["key"]] = (corr, "llm") if corr else (item["pred"], "fallback")
+
+            dispatcher = BatchDispatcher(self.provider, len(pending), self.include_gt, 1, on_result=_on_result)
+            for item in pending:
+                dispatcher.add(item)
+            try:
+                dispatcher.run()
+            finally:
+                dispatcher.close()
+        return results
+
+    async def close(self):
+        if self._loop_task:
+            self._loop_task.cancel()
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._executor.shutdown(wait=True)
+
+
+class CorrectionService:
+    """Request handling on top of a MicroBatcher; items at or above the threshold are returned unchanged."""
+
+    def __init__(self, provider: str, threshold: float, include_gt: bool, max_batch: int,
+                 window: float, max_inflight: int, max_items: int = 10000):
+        self.provider = provider
+        self.threshold = threshold
+        self.include_gt = include_gt
+        self.max_items = max_items
+        self.batcher = MicroBatcher(provider, include_gt, max_batch, window, max_inflight)
+
+    def warm_up(self):
+        """Load everything a first request would otherwise pay for."""
+        get_local_corrector()
+        get_router(self.provider)
+        logger.info(f"Service ready: provider={self.provider}, threshold={self.threshold}, "
+                    f"micro-batch={self.batcher.max_batch} items/{self.batcher.window * 1000:.0f}ms")
+
+    async def correct(self, body: Dict) -> Dict:
+        items = body.get("items")
+        if not isinstance(items, list):
+            raise RequestError(400, "'items' must be a list")
+        if len(items) > self.max_items:
+            raise RequestError(413, f"at most {self.max_items} items per request")
+        try:
+            threshold = float(body.get("threshold", self.threshold))
+        except (TypeError, ValueError):
+            raise RequestError(400, "'threshold' must be a number")
+        METRICS.inc("service_requests")
+        METRICS.inc("service_items", len(items))
+
+        results: List[Optional[Dict]] = [None] * len(items)
+        waiting: List[Tuple[int, asyncio.Future]] = []
+        for n, raw in enumerate(items):
+            try:
+                item = {"pred": str(raw["pred"]), "conf": float(raw["conf"]), "gt": str(raw.get("gt") or "")}
+            except (KeyError, TypeError, ValueError):
+                raise RequestError(400, f"item {n}: expected {{'pred': str, 'conf': float}}")
+            if item["conf"] >= threshold:
+                results[n] = {"corrected": item["pred"], "source": "confident"}
+            else:
+                waiting.append((n, self.batcher.submit(item)))
+
+        for n, fut in waiting:
+            # Shielded: a client that disconnects must not cancel a result other clients share
+            corrected, source = await asyncio.shield(fut)
+            results[n] = {"corrected": corrected, "source": source}
+        return {"results": results}
+
+
+async def _read_request(reader: asyncio.StreamReader, max_body: int) -> Optional[Tuple[str, str, Dict, bytes]]:
+    """Read one HTTP/1.1 request: (method, path, lower-cased headers, body), None on a closed connection."""
+    line = await reader.readline()
+    if not line:
+        return None
+    try:
+        method, path, _ = line.decode("latin-1").split(" ", 2)
+    except ValueError:
+        raise RequestError(400, "malformed request line")
+    headers: Dict[str, str] = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+    length = int(headers.get("content-length") or 0)
+    if length > max_body:
+        raise RequestError(413, f"body larger than {max_body} bytes")
+    body = await reader.readexactly(length) if length else b""
+    return method, path.split("?", 1)[0], headers, body
+
+
+def _response(status: int, payload, content_type: str = "application/json", keep_alive: bool = True) -> bytes:
+    data = payload if isinstance(payload, bytes) else json.dumps(payload, ensure_ascii=False).encode("utf-8")
+    head = (f"HTTP/1.1 {status} {HTTP_REASONS.get(status, '')}\r\n"
+            f"Content-Type: {content_type}\r\nContent-Length: {len(data)}\r\n"
+            f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n")
+    return head.encode("latin-1") + data
+
+
+class ServiceServer:
+    """Minimal keep-alive HTTP/1.1 front end of a CorrectionService."""
+
+    def __init__(self, service: CorrectionService, max_body: int):
+        self.service = service
+        self.max_body = max_body
+
+    async def _route(self, method: str, path: str, body: bytes) -> bytes:
+        if path == "/v1/correct":
+            if method != "POST":
+                raise RequestError(405, "use POST")
+            try:
+                payload = json.loads(body or b"{}")
+            except ValueError:
+                raise RequestError(400, "invalid JSON body")
+            if not isinstance(payload, dict):
+                raise RequestError(400, "expected a JSON object")
+            with METRICS.time("service_request"), METRICS.inflight("service_inflight_requests"):
+                return _response(200, await self.service.correct(payload))
+        if method != "GET":
+            raise RequestError(405, "use GET")
+        if path == "/healthz":
+            return _response(200, {"status": "ok"})
+        if path == "/stats":
+            return _response(200, METRICS.summary())
+        if path == "/metrics":
+            return _response(200, METRICS.to_prometheus().encode("utf-8"), "text/plain; version=0.0.4")
+        raise RequestError(404, f"no route {path}")
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                keep_alive = True
+                try:
+                    request = await _read_request(reader, self.max_body)
+                    if request is None:
+                        break
+                    method, path, headers, body = request
+                    keep_alive = headers.get("connection", "").lower() != "close"
+                    data = await self._route(method, path, body)
+                except RequestError as e:
+                    # The rest of a rejected request may still be unread, so the connection is not reused
+                    keep_alive = False
+                    data = _response(e.status, {"error": {"message": str(e)}}, keep_alive=False)
+                except (asyncio.IncompleteReadError, ConnectionError):
+                    break
+                except Exception as e:
+                    logger.exception("Unhandled error in a service request")
+                    keep_alive = False
+                    data = _response(500, {"error": {"message": str(e)}}, keep_alive=False)
+                writer.write(data)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+
+async def serve(host: str, port: int, unix_socket: Optional[str] = None):
+    """Run the service until SIGINT/SIGTERM, then finish the batches in flight."""
+    settings = get_settings()
+    service = CorrectionService(settings.provider, settings.confidence_threshold, settings.include_gt_in_prompt,
+                                max_batch=settings.service_max_batch, window=settings.service_batch_window_ms / 1000.0,
+                                max_inflight=settings.max_inflight_batches)
+    service.warm_up()
+    service.batcher.start()
+    front = ServiceServer(service, settings.service_max_body_bytes)
+    if unix_socket:
+        if os.path.exists(unix_socket):
+            os.unlink(unix_socket)
+        server = await asyncio.start_unix_server(front.handle, path=unix_socket)
+        logger.info(f"Listening on unix:{unix_socket}")
+    else:
+        server = await asyncio.start_server(front.handle, host, port)
+        logger.info(f"Listening on http://{host}:{server.sockets[0].getsockname()[1]}")
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    async with server:
+        await stop.wait()
+    logger.info("Shutting down...")
+    await service.batcher.close()
+    if unix_socket and os.path.exists(unix_socket):
+        os.unlink(unix_socket)
+
+
+def main(argv: Optional[List[str]] = None):
+    settings = get_settings()
+    ap = argparse.ArgumentParser(description="Resident OCR correction service with cross-client micro-batching.")
+    ap.add_argument("--host", default=settings.service_host)
+    ap.add_argument("--port", type=int, default=settings.service_port, help="0 picks a free port")
+    ap.add_argument("--unix", default=settings.service_socket, help="listen on this Unix socket instead of TCP")
+    args = ap.parse_args(argv)
+
+    setup_logging_original_fix(verbosity=settings.verbosity, log_file=settings.log_file)
+    try:
+        asyncio.run(serve(args.host, args.port, args.unix))
+    finally:
+        METRICS.log_summary()
+        METRICS.export(settings.metrics_json_path, settings.metrics_prometheus_path)
+
+
+if __name__ == "__main__":
+    main()
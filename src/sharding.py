@@ -0,0 +1,196 @@
+"""
+Lease files of a sharded folder run: worker processes on one or several machines that share the input
+and output directories (e.g. over NFS) split the files of a folder between them, take over the files
+of dead workers, and mark finished outputs, all through files under <output_dir>/SHARD_DIR_NAME.
+"""
+
+import os
+import json
+import time
+import uuid
+import socket
+import hashlib
+import logging
+import threading
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+logger = logging.getLogger("pcb-ocr-corrector.sharding")
+
+SHARD_DIR_NAME = ".pcbtagent_shards"
+
+
+def default_worker_id() -> str:
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+def write_json_atomic(path: Path, obj: dict):
+    """Write to a temporary file next to path, fsync and rename, so readers never see a torn file."""
+    tmp = path.with_name(f".{path.name}.{uuid.uuid4().hex[:8]}.tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(obj, f, ensure_ascii=False, sort_keys=True)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+def _read_json(path: Path) -> Optional[dict]:
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+class LeaseDir:
+    """
+    Shared state of a sharded run, one directory per output directory:
+      leases/<id>.lease      the file is being processed by the worker named inside
+      done/<id>.json         its output was written (settings and input hash it was produced with), and
+                             whether it is partial because the budget ran out before every item was sent
+      journals/<id>.jsonl    checkpoint journal of a file in progress, replayed by whoever takes it over
+      workers/<worker>.json  throughput of a worker, written when it finishes
+    <id> is a hash of the input path relative to the input directory.
+
+    A lease is created with O_CREAT | O_EXCL, which is atomic on local filesystems and NFSv3+.
+    Its holder touches it every lease_seconds / 3. A lease whose mtime has not changed for
+    lease_seconds, as timed by the observer's own clock (so clock skew between machines does not
+    matter), belongs to a dead worker. It is taken over by renaming it to a unique name first: only
+    one of several contenders can win that rename. A holder whose lease was taken over (a stalled, not
+    dead, worker) notices on its next heartbeat and discards its result.
+    """
+
+    def __init__(self, root: Path, worker: str, lease_seconds: float = 60.0):
+        self.root = Path(root)
+        self.worker = worker
+        self.lease_seconds = lease_seconds
+        for sub in ("leases", "done", "journals", "workers"):
+            (self.root / sub).mkdir(parents=True, exist_ok=True)
+        # Leases held by this worker: id -> relative path
+        self._held: Dict[str, str] = {}
+        self._lost = set()
+        # Leases of others: id -> (mtime_ns last seen, monotonic time it was first seen)
+        self._seen: Dict[str, Tuple[int, float]] = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._heartbeat: Optional[threading.Thread] = None
+
+    @staticmethod
+    def unit_id(rel: str) -> str:
+        return hashlib.sha1(rel.replace(os.sep, "/").encode("utf-8")).hexdigest()[:20]
+
+    def _lease_path(self, rel: str) -> Path:
+        return self.root / "leases" / f"{self.unit_id(rel)}.lease"
+
+    def journal_path(self, rel: str) -> Path:
+        return self.root / "journals" / f"{self.unit_id(rel)}.jsonl"
+
+    def _create(self, rel: str) -> bool:
+        path = self._lease_path(rel)
+        try:
+            fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+        except FileExistsError:
+            return False
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump({"worker": self.worker, "rel": rel, "acquired": time.time()}, f)
+        with self._lock:
+            self._held[self.unit_id(rel)] = rel
+        return True
+
+    def try_acquire(self, rel: str) -> Optional[str]:
+        """Take the lease of rel: "new", "takeover" (from a dead worker) or None if someone else holds it."""
+        if self._create(rel):
+            return "new"
+        path = self._lease_path(rel)
+        uid = self.unit_id(rel)
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except FileNotFoundError:
+            # Released meanwhile; picked up on the next pass
+            return None
+        now = time.monotonic()
+        seen = self._seen.get(uid)
+        if seen is None or seen[0] != mtime:
+            self._seen[uid] = (mtime, now)
+            return None
+        if now - seen[1] < self.lease_seconds:
+            return None
+        stale = path.with_name(f"{path.name}.stale-{uuid.uuid4().hex[:8]}")
+        try:
+            os.rename(path, stale)
+        except FileNotFoundError:
+            return None
+        dead = (_read_json(stale) or {}).get("worker", "?")
+        os.unlink(stale)
+        self._seen.pop(uid, None)
+        if not self._create(rel):
+            return None
+        logger.warning(f"Took over {rel} from worker {dead} (no heartbeat for {self.lease_seconds:g}s)")
+        return "takeover"
+
+    def release(self, rel: str):
+        uid = self.unit_id(rel)
+        with self._lock:
+            self._held.pop(uid, None)
+            lost = uid in self._lost
+            self._lost.discard(uid)
+        if not lost:
+            try:
+                os.unlink(self._lease_path(rel))
+            except FileNotFoundError:
+                pass
+
+    def lost(self, rel: str) -> bool:
+        """True if the lease of rel was taken over by another worker while this one held it."""
+        self._renew(self.unit_id(rel))
+        with self._lock:
+            return self.unit_id(rel) in self._lost
+
+    def _renew(self, uid: str):
+        with self._lock:
+            rel = self._held.get(uid)
+        if rel is None:
+            return
+        path = self._lease_path(rel)
+        owner = (_read_json(path) or {}).get("worker")
+        if owner != self.worker:
+            with self._lock:
+                if uid not in self._lost:
+                    logger.error(f"Lease of {rel} was taken over by {owner or 'another worker'}; "
+                                 "its result will be discarded.")
+                self._lost.add(uid)
+            return
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+
+    def _beat(self):
+        while not self._stop.wait(self.lease_seconds / 3):
+            with self._lock:
+                held = list(self._held)
+            for uid in held:
+                self._renew(uid)
+
+    def start_heartbeat(self):
+        self._heartbeat = threading.Thread(target=self._beat, name="lease-heartbeat", daemon=True)
+        self._heartbeat.start()
+
+    def stop_heartbeat(self):
+        self._stop.set()
+        if self._heartbeat is not None:
+            self._heartbeat.join()
+
+    def done_info(self, rel: str) -> Optional[dict]:
+        return _read_json(self.root / "done" / f"{self.unit_id(rel)}.json")
+
+    def mark_done(self, rel: str, info: dict):
+        write_json_atomic(self.root / "done" / f"{self.unit_id(rel)}.json", dict(info, rel=rel, worker=self.worker))
+
+    def write_worker_stats(self, stats: dict):
+        write_json_atomic(self.root / "workers" / f"{self.worker}.json", dict(stats, worker=self.worker))
+
+    def worker_stats(self) -> List[dict]:
+        """Stats of every worker that has finished on this output directory, by worker name."""
+        found = (_read_json(path) for path in sorted((self.root / "workers").glob("*.json")))
+        return [stats for stats in found if stats]
@@ -1,8 +1,10 @@
 """
 Auxiliary functions related to data row parsing, reconstruction and batch processing.
 """
+import re
 import logging
-from typing import List, Tuple, Optional
+from operator import itemgetter
+from typing import Dict, List, Tuple, Optional
 
 # 获取一个日志记录器实例，用于在本模块中记录日志
 logger = logging.getLogger("pcb-ocr-corrector.parser")
@@ -56,31 +58,106 @@ def rebuild_line(gt: str, pred: str, conf: float, corrected: str) -> str:
     """
     return f"{gt}||{pred} {conf:.4f} {corrected}".strip()
 
-def chunked(seq: List, size: int):
-    """Divide the sequence into blocks of the specified size."""
-    for i in range(0, len(seq), size):
-        yield seq[i:i+size]
+# Columns of a parsed file: (gts, preds, confs), one entry per line
+Columns = Tuple[List[str], List[str], List[float]]
 
-def postprocess_llm_block(raw_text: str, expected_n: int) -> Optional[List[str]]:
+def parse_lines(text: str) -> Columns:
     """
-    Extract the token of each line from the original output of the LLM and conduct a strict quantity check.
-    
-    - If the number of rows is exactly the same as expected, return the list of extracted tokens.
-    - If the number of lines does not match (too many or too few), record a warning and return None, indicating that this return is invalid and a retry is required.
+    Parse a whole buffer of 'gt||ocr conf' lines (as read in text mode) into columns, with the
+    fields parse_line gives for every line. Well-formed lines are split inline; the others
+    (no '||', no numeric conf) go through parse_line.
     """
-    # Filter out blank lines and common, non-token interfering lines
-    lines = [ln.strip() for ln in raw_text.strip().splitlines() if ln.strip()]
-    common_intros = ["here are the corrected tokens:", "sure, here are the results:"]
-    lines = [ln for ln in lines if ln.lower() not in common_intros]
+    # A multiline regex over the whole buffer is slower: its scan alone costs what this loop does
+    lines = text.split("\n")
+    # What follows the last newline is only a line if it is not empty
+    if lines[-1] == "":
+        lines.pop()
+    gts: List[str] = []
+    preds: List[str] = []
+    confs: List[float] = []
+    add_gt, add_pred, add_conf = gts.append, preds.append, confs.append
+    for line in lines:
+        gt, sep, right = line.partition("||")
+        if sep:
+            tokens = right.split()
+            try:
+                add_conf(float(tokens[-1]))
+            except (ValueError, IndexError):
+                pass
+            else:
+                add_gt(gt.strip())
+                add_pred(" ".join(tokens[:-1]))
+                continue
+        gt, pred, conf = parse_line(line)
+        add_gt(gt)
+        add_pred(pred)
+        add_conf(conf)
+    return gts, preds, confs
 
-    if len(lines) != expected_n:
-        logger.warning(
-            f"LLM returned an incorrect number of lines. "
-            f"Expected: {expected_n}, Got: {len(lines)}. This batch will be retried."
-        )
+def rebuild_lines(gts: List[str], preds: List[str], confs: List[float], corrected: List[str]) -> str:
+    """
+    Rebuild a whole output buffer: rebuild_line of every row, each followed by a newline.
+    Every distinct conf is formatted once, and the strip of each line is skipped when the first
+    and last characters of all lines show that no line starts or ends with whitespace (an empty
+    corrected token only drops its separator).
+    """
+    firsts = "".join(map(itemgetter(slice(0, 1)), gts))
+    lasts = "".join(map(itemgetter(slice(-1, None)), corrected))
+    if any(map(str.isspace, firsts)) or any(map(str.isspace, lasts)):
+        return "".join([rebuild_line(*row) + "\n" for row in zip(gts, preds, confs, corrected)])
+    # Building one string per row is the floor; bulk str.format / %-formatting of all rows is slower
+    formatted = {conf: f"{conf:.4f}" for conf in set(confs)}
+    # 0.0 and -0.0 are one key but format differently
+    formatted.pop(0.0, None)
+    conf_texts = [formatted.get(conf) or f"{conf:.4f}" for conf in confs]
+    return "".join([f"{gt}||{pred} {conf} {corr}\n" if corr else f"{gt}||{pred} {conf}\n"
+                    for gt, pred, conf, corr in zip(gts, preds, conf_texts, corrected)])
+
+# "ID<TAB>token"; a model that drops the TAB usually writes "ID: token", "ID) token" or "ID. token" instead.
+# The separator must end in whitespace, so an unkeyed token such as 3.3V is never read as ID 3 + "3V".
+_INDEXED_LINE_RE = re.compile(r"^\[?(\d+)\]?[ ]*(?:\t|[:).]\s)\s*(.*)$")
+
+def parse_indexed_line(line: str) -> Optional[Tuple[int, str]]:
+    """Parse one "ID<TAB>token" line into (ID, token); None if the line is not keyed."""
+    m = _INDEXED_LINE_RE.match(line.strip())
+    if not m:
         return None
+    return int(m.group(1)), m.group(2).strip()
 
-    return lines
+def is_filler_line(line: str) -> bool:
+    """Blank lines and markdown code fences carry no answer but are not chatter either."""
+    stripped = line.strip()
+    return not stripped or stripped.startswith("```")
+
+def parse_indexed_llm_block(raw_text: str, expected_n: int) -> Dict[int, str]:
+    """
+    Extract "ID<TAB>token" answers from the original output of the LLM, keyed by item ID (1..expected_n).
+
+    - Lines that are not keyed, carry an unknown ID or an empty token are ignored.
+    - An ID answered twice with different tokens is treated as missing.
+    The caller re-asks for every ID that is not in the returned dict.
+    """
+    found: Dict[int, str] = {}
+    conflicting = set()
+    for ln in raw_text.splitlines():
+        parsed = parse_indexed_line(ln)
+        if parsed is None:
+            continue
+        item_id, token = parsed
+        if not (1 <= item_id <= expected_n) or not token:
+            continue
+        if item_id in found and found[item_id] != token:
+            conflicting.add(item_id)
+        found[item_id] = token
+    for item_id in conflicting:
+        del found[item_id]
+
+    if len(found) != expected_n:
+        logger.warning(
+            f"LLM answered {len(found)}/{expected_n} items with a valid ID. "
+            f"The {expected_n - len(found)} missing/malformed item(s) will be re-asked."
+        )
+    return found
 
 ## spn: move parser config to .env
 # spn: split and wrap parser creation    
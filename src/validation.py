@@ -0,0 +1,94 @@
+"""
+Check LLM answers against the hard constraints of the system prompt, so that an answer breaking
+them is re-asked (and finally falls back to the OCR token) instead of reaching the output.
+"""
+
+import re
+from typing import Optional
+
+from local_correct import CONFUSION_CLASSES, HIGH_CONF_MAX_SUBS
+from prompting import CONF_BUCKET_EDGES
+
+# Symbols the answer must keep ("Do NOT remove unit/symbols like Ω, µ, °, ±"); µ and μ count as one
+PROTECTED_SYMBOLS = ("Ω", "µμ", "°", "±")
+# Characters no edit may add, drop or swap for one another ('-' vs '_', diff-pair '+'/'-')
+KEPT_CHARS = "-+_"
+
+# "Additional guidance" of the prompt: PAB / PAC / PAA is a misread PA6 or PA8
+_PA_MISREAD_RE = re.compile(r"^PA[ABC]$")
+_PA_PINS = ("PA6", "PA8")
+
+# Each rule in the wording of the system prompt, shown with a rejected answer when the item is re-asked
+RULE_HINTS = {
+    "short": "length <= 2: return the OCR token unchanged",
+    "space": "never introduce spaces",
+    "symbol": "do not remove unit/symbols like Ω, µ, °, ±",
+    "voltage": "do not convert 3.3V <-> 3V3",
+    "kept_char": "do not replace '-' with '_' or vice versa; keep explicit +/-",
+    "length": "length must not change at this CONF",
+    "swap": "only the allowed swaps",
+    "too_many": "at most 0-2 substitutions at this CONF",
+}
+
+_DOT_VOLTAGE_RE = re.compile(r"\d\.\d+V")    # 3.3V
+_RAIL_VOLTAGE_RE = re.compile(r"\dV\d")      # 3V3
+
+_CLASS_OF = {ch: cls for cls in CONFUSION_CLASSES for ch in cls}
+
+
+def _swap_class(ch: str) -> Optional[str]:
+    """Confusion class of a character, also for the other case of a letter (o -> O0, G -> gq9)."""
+    return _CLASS_OF.get(ch) or _CLASS_OF.get(ch.upper()) or _CLASS_OF.get(ch.lower())
+
+
+def _allowed_swap(a: str, b: str, allow_case: bool) -> bool:
+    if allow_case and a.lower() == b.lower():
+        return True
+    cls = _swap_class(a)
+    return cls is not None and cls == _swap_class(b)
+
+
+def check_correction(pred: str, conf: float, corrected: str) -> Optional[str]:
+    """
+    Return the hard constraint an answer breaks, or None if it is acceptable:
+      short       tokens of length <= 2 must come back unchanged
+      space       no spaces introduced (internal spaces may become underscores)
+      symbol      Ω, µ, °, ± are never removed
+      voltage     3.3V and 3V3 notations are never converted into each other
+      kept_char   '-', '+' and '_' are never added, removed or swapped
+      length      length is kept when CONF >= 0.80 (spaces -> underscores aside)
+      swap        at equal length every changed character is an allowed confusable swap
+                  (below CONF 0.92 a change of letter case is accepted too)
+      too_many    at most HIGH_CONF_MAX_SUBS substitutions when CONF >= 0.92
+    What the prompt's additional guidance asks for (PAB / PAC / PAA -> PA6 / PA8) is always accepted.
+    """
+    if corrected == pred:
+        return None
+    if _PA_MISREAD_RE.match(pred) and corrected in _PA_PINS:
+        return None
+    if len(pred.strip()) <= 2:
+        return "short"
+    if corrected.count(" ") > pred.count(" "):
+        return "space"
+    for symbols in PROTECTED_SYMBOLS:
+        if sum(corrected.count(s) for s in symbols) < sum(pred.count(s) for s in symbols):
+            return "symbol"
+    for regex, other in ((_DOT_VOLTAGE_RE, _RAIL_VOLTAGE_RE), (_RAIL_VOLTAGE_RE, _DOT_VOLTAGE_RE)):
+        if regex.search(pred) and other.search(corrected) and not other.search(pred):
+            return "voltage"
+
+    # The only structural edit the prompt allows is internal spaces -> underscores; compare with both folded
+    base = "_".join(pred.split())
+    corrected = "_".join(corrected.split())
+    if any(corrected.count(ch) != base.count(ch) for ch in KEPT_CHARS):
+        return "kept_char"
+    mid_conf, high_conf = CONF_BUCKET_EDGES
+    if len(corrected) != len(base):
+        return "length" if conf >= mid_conf else None
+
+    changed = [(a, b) for a, b in zip(base, corrected) if a != b]
+    if not all(_allowed_swap(a, b, allow_case=conf < high_conf) for a, b in changed):
+        return "swap"
+    if conf >= high_conf and len(changed) > HIGH_CONF_MAX_SUBS:
+        return "too_many"
+    return None